@@ -7,12 +7,44 @@ import azure.functions as func
 import smart_open
 from azure.storage.blob import BlobClient, BlobServiceClient
 
-from utils import cogsearch_helpers, cosmos_helpers, helpers
+from utils import (chunk_registry, cogsearch_helpers, cosmos_helpers, helpers,
+                   ingestion_pipeline)
 from utils.cogvecsearch_helpers import cogsearch_vecstore
 from utils.env_vars import *
 from utils.kb_doc import KB_Doc
 
 
+def check_sink_results(sink, num_docs, failed):
+    # raising fails the message, so it is retried and the chunk registry is untouched
+    if failed > 0:
+        raise Exception(f"Failed writing {failed} of {num_docs} embeddings to {sink}")
+
+
+def redis_sink(batch, document_name):
+    loaded, failed_ids = helpers.load_embedding_docs_in_redis(
+        batch, document_name=document_name
+    )
+    check_sink_results("redis", len(batch), max(len(failed_ids), len(batch) - loaded))
+
+
+def cogsearch_sink(batch):
+    if USE_COG_VECSEARCH == 1:
+        vs = cogsearch_vecstore.CogSearchVecStore()
+        vs.upload_documents(batch)
+        results = vs.upload_results
+    else:
+        results = cogsearch_helpers.index_semantic_sections(batch)
+
+    check_sink_results(
+        "cogsearch", len(batch), len([r for r in results.values() if r != "ok"])
+    )
+
+
+def cosmos_sink(batch):
+    ret_dict = cosmos_helpers.cosmos_backup_embeddings(batch)
+    check_sink_results("cosmos", len(batch), len(ret_dict["failed_ids"]))
+
+
 def main(msg: func.ServiceBusMessage):
     msg_dict = json.loads(msg.get_body().decode("utf-8"))
 
@@ -34,54 +66,28 @@ def main(msg: func.ServiceBusMessage):
     full_kbd_doc = KB_Doc()
     full_kbd_doc.load(data)
 
-    emb_documents = []
+    # without REDIS_ADDR this loads the local vector store instead
+    sinks = {
+        "redis": lambda batch: redis_sink(batch, json_filename),
+        "cogsearch": cogsearch_sink,
+    }
 
-    emb_documents += helpers.generate_embeddings(
-        full_kbd_doc, CHOSEN_EMB_MODEL, SMALL_EMB_TOKEN_NUM, text_suffix="S"
-    )
+    if USE_COG_VECSEARCH == 1:
+        cogsearch_vecstore.CogSearchVecStore().create_index()
 
-    if MEDIUM_EMB_TOKEN_NUM != 0:
-        emb_documents += helpers.generate_embeddings(
-            full_kbd_doc,
-            CHOSEN_EMB_MODEL,
-            MEDIUM_EMB_TOKEN_NUM,
-            text_suffix="M",
-            previous_max_tokens=SMALL_EMB_TOKEN_NUM,
-        )
-
-    if LARGE_EMB_TOKEN_NUM != 0:
-        emb_documents += helpers.generate_embeddings(
-            full_kbd_doc,
-            CHOSEN_EMB_MODEL,
-            LARGE_EMB_TOKEN_NUM,
-            text_suffix="L",
-            previous_max_tokens=MEDIUM_EMB_TOKEN_NUM,
-        )
-
-    if X_LARGE_EMB_TOKEN_NUM != 0:
-        emb_documents += helpers.generate_embeddings(
-            full_kbd_doc,
-            CHOSEN_EMB_MODEL,
-            X_LARGE_EMB_TOKEN_NUM,
-            text_suffix="XL",
-            previous_max_tokens=LARGE_EMB_TOKEN_NUM,
-        )
+    if DATABASE_MODE == 1:
+        sinks["cosmos"] = cosmos_sink
+
+    emb_documents, stats = ingestion_pipeline.run_ingestion_pipeline(
+        helpers.generate_multi_granularity_embedding_batches(
+            full_kbd_doc, CHOSEN_EMB_MODEL
+        ),
+        sinks,
+        document_name=json_filename,
+    )
 
     logging.info(f"Generated {len(emb_documents)} emb chunks from doc {json_filename}")
 
-    if (REDIS_ADDR is not None) and (REDIS_ADDR != ""):
-        loaded = helpers.load_embedding_docs_in_redis(
-            emb_documents, document_name=json_filename
-        )
-        logging.info(f"Loaded into Redis {loaded} emb chunks from doc {json_filename}")
-        print(f"Loaded into Redis {loaded} emb chunks from doc {json_filename}")
-
-    if USE_COG_VECSEARCH == 1:
-        vs = cogsearch_vecstore.CogSearchVecStore()
-        vs.create_index()
-        docs_dict = vs.upload_documents(emb_documents)
-    else:
-        cogsearch_helpers.index_semantic_sections(emb_documents)
-
-    if DATABASE_MODE == 1:
-        cosmos_helpers.cosmos_backup_embeddings(emb_documents)
+    chunk_registry.replace_document_chunks(
+        full_kbd_doc.id, [e["id"] for e in emb_documents]
+    )
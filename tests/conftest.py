@@ -0,0 +1,158 @@
+import fnmatch
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import openai
+import pytest
+
+# the helpers parse the blob connection string and look up their OpenAI
+# deployments when they are imported
+os.environ.setdefault(
+    "KB_BLOB_CONN_STR",
+    "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=dGVzdA==;EndpointSuffix=core.windows.net",
+)
+mock.patch.object(
+    openai.Deployment,
+    "list",
+    lambda: SimpleNamespace(
+        data=[
+            {"model": os.environ.get(m, d), "id": os.environ.get(m, d)}
+            for m, d in [
+                ("CHOSEN_COMP_MODEL", "gpt-35-turbo"),
+                ("CHOSEN_EMB_MODEL", "text-embedding-ada-002"),
+            ]
+        ]
+    ),
+).start()
+
+
+class FakePipeline:
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.redis_conn, n)(*a, **kw) for n, a, kw in calls]
+
+
+class FakeRedis:
+    # just enough of redis-py for the helpers under test, values are kept as
+    # bytes like a real connection returns them
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+
+    def encode(self, value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode("utf-8")
+
+    def key(self, key):
+        return key.decode("utf-8") if isinstance(key, bytes) else key
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.values.get(self.key(key), None)
+
+    def set(self, key, value, nx=False, xx=False, ex=None):
+        key = self.key(key)
+        if (nx and (key in self.values)) or (xx and (key not in self.values)):
+            return None
+        self.values[key] = self.encode(value)
+        if ex is not None:
+            self.expiry[key] = ex
+        return True
+
+    def exists(self, *keys):
+        return sum([1 for k in keys if self.key(k) in self.values])
+
+    def delete(self, *keys):
+        deleted = 0
+        for k in keys:
+            deleted += 1 if self.values.pop(self.key(k), None) is not None else 0
+        return deleted
+
+    def expire(self, name, time):
+        self.expiry[self.key(name)] = time
+        return self.key(name) in self.values
+
+    def incr(self, key):
+        value = int(self.values.get(self.key(key), b"0")) + 1
+        self.values[self.key(key)] = self.encode(value)
+        return value
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        h = self.values.setdefault(self.key(key), {})
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        for f, v in items.items():
+            h[self.encode(f)] = self.encode(v)
+        return len(items)
+
+    def hget(self, key, field):
+        return self.values.get(self.key(key), {}).get(self.encode(field), None)
+
+    def hmget(self, key, fields):
+        h = self.values.get(self.key(key), {})
+        return [h.get(self.encode(f), None) for f in fields]
+
+    def hgetall(self, key):
+        return dict(self.values.get(self.key(key), {}))
+
+    def hdel(self, key, *fields):
+        h = self.values.get(self.key(key), {})
+        deleted = sum([1 for f in fields if h.pop(self.encode(f), None) is not None])
+        if (len(h) == 0) and (self.key(key) in self.values):
+            del self.values[self.key(key)]
+        return deleted
+
+    def sadd(self, key, *members):
+        s = self.values.setdefault(self.key(key), set())
+        before = len(s)
+        s.update([self.encode(m) for m in members])
+        return len(s) - before
+
+    def srem(self, key, *members):
+        s = self.values.get(self.key(key), set())
+        before = len(s)
+        s.difference_update([self.encode(m) for m in members])
+        if (len(s) == 0) and (self.key(key) in self.values):
+            del self.values[self.key(key)]
+        return before - len(s)
+
+    def smembers(self, key):
+        return set(self.values.get(self.key(key), set()))
+
+    def sunion(self, keys):
+        members = set()
+        for k in keys:
+            members |= self.values.get(self.key(k), set())
+        return members
+
+    def scan_iter(self, match="*", count=None, _type=None):
+        for k in list(self.values.keys()):
+            if fnmatch.fnmatch(k, match):
+                yield k.encode("utf-8")
+
+
+@pytest.fixture
+def redis_conn():
+    return FakeRedis()
+
+
+@pytest.fixture
+def make_redis():
+    # for tests that need more than one node, e.g. shards
+    return FakeRedis
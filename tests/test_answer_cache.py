@@ -0,0 +1,51 @@
+from unittest import mock
+
+from utils import answer_cache
+
+
+def make_cache(redis_conn):
+    with mock.patch.object(answer_cache.openai_helpers, "get_model_dims", lambda m: 4):
+        cache = answer_cache.AnswerCache(redis_conn)
+    cache.index_checked = True
+    return cache
+
+
+def test_cache_is_opt_in():
+    assert answer_cache.USE_ANSWER_CACHE == 0
+    assert answer_cache.get_answer_cache() is None
+    assert answer_cache.get_cached_answer([1.0], "zs", "*") == (None, None)
+
+
+def test_filters_are_part_of_the_lookup():
+    cache = make_cache(mock.MagicMock())
+
+    tenant_a = cache.get_tags_query("zs", "@client:{a}\n@client:{a}", "1")
+    tenant_b = cache.get_tags_query("zs", "@client:{b}\n@client:{b}", "1")
+
+    assert tenant_a != tenant_b
+    assert cache.get_tags_query("zs", None, "1") == cache.get_tags_query("zs", "*", "1")
+
+
+def test_lookup_returns_the_version_it_searched(redis_conn):
+    ft = mock.MagicMock()
+    ft.search.return_value.docs = []
+    redis_conn.ft = lambda name: ft
+    redis_conn.set(answer_cache.KB_VERSION_KEY, 7)
+    cache = make_cache(redis_conn)
+
+    assert cache.lookup([1.0, 0, 0, 0], "zs", "*") == (None, "7")
+    assert "@kb_version:{7}" in ft.search.call_args[0][0].query_string()
+
+
+def test_store_tags_the_answer_with_filter_and_version(redis_conn):
+    cache = make_cache(redis_conn)
+    redis_conn.zadd = mock.MagicMock()
+    redis_conn.zremrangebyscore = mock.MagicMock()
+    redis_conn.zcard = mock.MagicMock(return_value=1)
+
+    cache.store("q", [1.0, 0, 0, 0], "zs", "@client:{a}", "answer", "3")
+
+    entry = [v for k, v in redis_conn.values.items() if k.startswith("answer_cache:")]
+    assert entry[0][b"kb_version"] == b"3"
+    filter_key = answer_cache.get_filter_key("@client:{a}")
+    assert entry[0][b"filter_key"] == filter_key.encode("utf-8")
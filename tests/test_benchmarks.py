@@ -0,0 +1,20 @@
+from unittest import mock
+
+from utils import benchmarks, redis_helpers
+
+
+def test_benchmark_index_stays_out_of_the_production_keyspace():
+    assert benchmarks.BENCH_VECTOR_FIELD != redis_helpers.VECTOR_FIELD_IN_REDIS
+    assert benchmarks.get_benchmark_prefix("bench_sweep").startswith("bench:")
+
+
+def test_benchmark_index_is_deleted_with_its_hashes(redis_conn):
+    redis_conn.ft = mock.MagicMock()
+    redis_conn.hset("bench:bench_sweep:0", "bench_text", "a")
+    redis_conn.hset(redis_helpers.INDEX_CONFIG_PREFIX + "bench_sweep", "m", "16")
+    redis_conn.hset("doc_S_0", "text_en", "kept")
+
+    benchmarks.delete_benchmark_index(redis_conn, "bench_sweep")
+
+    redis_conn.ft("bench_sweep").dropindex.assert_called_with(delete_documents=True)
+    assert list(redis_conn.values.keys()) == ["doc_S_0"]
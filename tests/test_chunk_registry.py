@@ -0,0 +1,60 @@
+import pytest
+
+from utils import answer_cache, chunk_registry, redis_helpers
+
+
+@pytest.fixture
+def registry(monkeypatch, redis_conn):
+    deleted = []
+
+    def delete_chunks(chunk_ids, conn=None):
+        deleted.append(sorted(chunk_ids))
+        conn.delete(*chunk_ids)
+        return {"chunks": len(chunk_ids)}
+
+    for m in [chunk_registry, redis_helpers, answer_cache]:
+        monkeypatch.setattr(m, "REDIS_ADDR", "localhost")
+    monkeypatch.setattr(chunk_registry, "DATABASE_MODE", 0)
+    monkeypatch.setattr(chunk_registry, "delete_chunks", delete_chunks)
+    return deleted
+
+
+def write_chunks(redis_conn, chunk_ids):
+    for c in chunk_ids:
+        redis_conn.hset(c, "text_en", c)
+
+
+def test_stale_chunks_are_removed_once_the_new_ones_are_live(redis_conn, registry):
+    write_chunks(redis_conn, ["a", "b"])
+    chunk_registry.register_document_chunks("doc", ["a", "b"], redis_conn)
+    write_chunks(redis_conn, ["c"])
+
+    ret_dict = chunk_registry.replace_document_chunks("doc", ["b", "c"], redis_conn)
+
+    assert ret_dict == {"chunks": 1}
+    assert registry == [["a"]]
+    assert chunk_registry.get_document_chunks("doc", redis_conn) == {"b", "c"}
+    assert redis_conn.get(answer_cache.KB_VERSION_KEY) == b"1"
+
+
+def test_missing_new_chunks_keep_the_old_ones(redis_conn, registry):
+    write_chunks(redis_conn, ["a", "b"])
+    chunk_registry.register_document_chunks("doc", ["a", "b"], redis_conn)
+    write_chunks(redis_conn, ["c"])
+
+    with pytest.raises(Exception, match="1 of 2 chunks"):
+        chunk_registry.replace_document_chunks("doc", ["c", "d"], redis_conn)
+
+    assert registry == []
+    assert chunk_registry.get_document_chunks("doc", redis_conn) == {"a", "b"}
+    assert redis_conn.exists("a", "b") == 2
+    assert redis_conn.get(answer_cache.KB_VERSION_KEY) is None
+
+
+def test_first_ingestion_has_nothing_to_remove(redis_conn, registry):
+    write_chunks(redis_conn, ["a"])
+
+    chunk_registry.replace_document_chunks("doc", ["a"], redis_conn)
+
+    assert registry == [[]]
+    assert chunk_registry.get_document_chunks("doc", redis_conn) == {"a"}
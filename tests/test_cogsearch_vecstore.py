@@ -0,0 +1,55 @@
+import json
+
+from utils.cogvecsearch_helpers.cogsearch_vecstore import (batch_upload_documents,
+                                                            get_upload_batches)
+
+
+def make_docs(n, text=""):
+    return [{"id": str(i), "text": text} for i in range(n)]
+
+
+def test_batches_are_capped_by_count():
+    batches = list(get_upload_batches(make_docs(5), max_batch_docs=2))
+
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert [d["id"] for b in batches for d in b] == ["0", "1", "2", "3", "4"]
+
+
+def test_batches_are_capped_by_bytes():
+    docs = make_docs(4, text="x" * 100)
+    doc_bytes = len(json.dumps(docs[0]))
+
+    batches = list(
+        get_upload_batches(docs, max_batch_docs=10, max_batch_bytes=2 * doc_bytes)
+    )
+
+    assert [len(b) for b in batches] == [2, 2]
+
+
+def test_oversized_document_gets_its_own_batch():
+    docs = make_docs(1) + make_docs(1, text="x" * 1000) + make_docs(1)
+
+    batches = list(get_upload_batches(docs, max_batch_docs=10, max_batch_bytes=200))
+
+    assert [len(b) for b in batches] == [1, 1, 1]
+
+
+def test_no_documents_no_batches():
+    assert list(get_upload_batches([])) == []
+
+
+def test_failed_documents_are_retried():
+    attempts = {}
+
+    def upload(batch):
+        results = {}
+        for d in batch:
+            attempts[d["id"]] = attempts.get(d["id"], 0) + 1
+            failed = (d["id"] == "1") and (attempts["1"] == 1)
+            results[d["id"]] = "503" if failed else "ok"
+        return results
+
+    results = batch_upload_documents(make_docs(3), upload, retry_rounds=2)
+
+    assert results == {"0": "ok", "1": "ok", "2": "ok"}
+    assert attempts == {"0": 1, "1": 2, "2": 1}
@@ -0,0 +1,253 @@
+import pytest
+from azure.cosmos import exceptions
+
+from utils import cosmos_helpers, redis_helpers
+
+
+class FakePager:
+    def __init__(self, pages, continuation_token):
+        self.pages = pages
+        self.next_page = 0 if continuation_token is None else int(continuation_token)
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_page >= len(self.pages):
+            raise StopIteration
+        page = self.pages[self.next_page]
+        self.next_page += 1
+        self.continuation_token = (
+            str(self.next_page) if self.next_page < len(self.pages) else None
+        )
+        return iter(page)
+
+
+class FakeContainer:
+    def __init__(self, pages):
+        self.pages = pages
+        self.started_from = []
+
+    def query_items(self, **kwargs):
+        return self
+
+    def by_page(self, continuation_token=None):
+        self.started_from.append(continuation_token)
+        return FakePager(self.pages, continuation_token)
+
+
+@pytest.fixture
+def restore(monkeypatch, redis_conn):
+    loaded = []
+
+    def bulk_upsert(conn, docs, document_name=""):
+        failed = [d["id"] for d in docs if d.get("fail", False)]
+        loaded.extend([d["id"] for d in docs if not d.get("fail", False)])
+        return len(docs) - len(failed), failed
+
+    monkeypatch.setattr(redis_helpers, "get_new_conn", lambda: redis_conn)
+    monkeypatch.setattr(redis_helpers, "redis_bulk_upsert_embeddings", bulk_upsert)
+    return loaded
+
+
+def make_pages(n, failing_page=None):
+    return [
+        [{"id": f"{p}_{i}", "fail": p == failing_page} for i in range(2)]
+        for p in range(n)
+    ]
+
+
+def test_failed_restore_keeps_its_checkpoint(monkeypatch, redis_conn, restore):
+    monkeypatch.setattr(
+        cosmos_helpers, "container", FakeContainer(make_pages(3, 1)), raising=False
+    )
+
+    cosmos_helpers.cosmos_restore_embeddings(max_workers=1)
+
+    assert redis_conn.get(cosmos_helpers.RESTORE_CHECKPOINT_KEY) == b"1"
+    progress = cosmos_helpers.get_cosmos_restore_progress(redis_conn)
+    assert progress["status"] == "failed"
+    assert progress["pages"] == "1"
+    assert cosmos_helpers.is_restore_interrupted(redis_conn)
+
+
+def test_restore_resumes_from_the_checkpoint(monkeypatch, redis_conn, restore):
+    container = FakeContainer(make_pages(3))
+    monkeypatch.setattr(cosmos_helpers, "container", container, raising=False)
+    redis_conn.set(cosmos_helpers.RESTORE_CHECKPOINT_KEY, "1")
+    cosmos_helpers.set_cosmos_restore_progress(
+        redis_conn, status="failed", loaded=2, pages=1
+    )
+
+    assert cosmos_helpers.cosmos_restore_embeddings(max_workers=1) == 6
+
+    assert container.started_from == ["1"]
+    assert restore == ["1_0", "1_1", "2_0", "2_1"]
+    assert not redis_conn.exists(cosmos_helpers.RESTORE_CHECKPOINT_KEY)
+    progress = cosmos_helpers.get_cosmos_restore_progress(redis_conn)
+    assert (progress["status"], progress["loaded"], progress["pages"]) == (
+        "done",
+        "6",
+        "3",
+    )
+    assert not cosmos_helpers.is_restore_interrupted(redis_conn)
+
+
+@pytest.fixture
+def readiness(monkeypatch, redis_conn):
+    state = {"has_vectors": True, "started": 0}
+
+    def start(conn):
+        state["started"] += 1
+        conn.set(cosmos_helpers.RESTORE_LOCK_KEY, "token")
+        return True
+
+    monkeypatch.setattr(
+        redis_helpers, "redis_index_has_vectors", lambda conn: state["has_vectors"]
+    )
+    monkeypatch.setattr(cosmos_helpers, "start_background_restore", start)
+    monkeypatch.setattr(cosmos_helpers, "readiness_checked_at", {})
+    return state
+
+
+def test_index_with_vectors_and_no_restore_is_ready(redis_conn, readiness):
+    assert cosmos_helpers.get_index_readiness(redis_conn) == "ready"
+    assert readiness["started"] == 0
+
+
+def test_interrupted_restore_is_resumed_before_ready(redis_conn, readiness):
+    redis_conn.set(cosmos_helpers.RESTORE_CHECKPOINT_KEY, "1")
+
+    assert cosmos_helpers.get_index_readiness(redis_conn) == "restoring"
+    assert readiness["started"] == 1
+    # the restore holds the lock now, nobody starts a second one
+    assert cosmos_helpers.get_index_readiness(redis_conn) == "restoring"
+    assert readiness["started"] == 1
+
+
+def test_failed_restore_without_checkpoint_is_resumed(redis_conn, readiness):
+    cosmos_helpers.set_cosmos_restore_progress(
+        redis_conn, status="failed", loaded=0, pages=0
+    )
+
+    assert cosmos_helpers.get_index_readiness(redis_conn) == "restoring"
+    assert readiness["started"] == 1
+
+
+def test_empty_index_starts_a_restore(redis_conn, readiness):
+    readiness["has_vectors"] = False
+
+    assert cosmos_helpers.get_index_readiness(redis_conn) == "restoring"
+    assert readiness["started"] == 1
+
+
+def test_ready_index_is_only_rechecked_after_the_interval(redis_conn, readiness):
+    assert cosmos_helpers.check_index_readiness(redis_conn) == "ready"
+    redis_conn.set(cosmos_helpers.RESTORE_CHECKPOINT_KEY, "1")
+
+    assert cosmos_helpers.check_index_readiness(redis_conn) == "ready"
+    assert readiness["started"] == 0
+
+
+def make_throttled(retry_after_ms=None):
+    e = exceptions.CosmosHttpResponseError(status_code=429, message="busy")
+    if retry_after_ms is not None:
+        e.headers["x-ms-retry-after-ms"] = str(retry_after_ms)
+    return e
+
+
+class FakeUpsertContainer:
+    def __init__(self, errors):
+        # errors to raise per item id, in order, before the upsert goes through
+        self.errors = {k: list(v) for k, v in errors.items()}
+        self.upserted = []
+
+    def upsert_item(self, item):
+        errors = self.errors.get(item["id"], [])
+        if len(errors) > 0:
+            raise errors.pop(0)
+        self.upserted.append(item["id"])
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(cosmos_helpers.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_throttled_upsert_waits_for_the_retry_after_hint(monkeypatch, sleeps):
+    container = FakeUpsertContainer({"a": [make_throttled(retry_after_ms=250)]})
+    monkeypatch.setattr(cosmos_helpers, "container", container, raising=False)
+    throttle = cosmos_helpers.CosmosThrottle()
+
+    assert cosmos_helpers.cosmos_upsert_with_throttling({"id": "a"}, throttle) == "ok"
+
+    assert container.upserted == ["a"]
+    assert len(sleeps) == 1
+    assert 0.2 < sleeps[0] <= 0.25
+
+
+def test_throttled_upsert_backs_off_without_a_hint(monkeypatch, sleeps):
+    container = FakeUpsertContainer({"a": [make_throttled(), make_throttled()]})
+    monkeypatch.setattr(cosmos_helpers, "container", container, raising=False)
+    throttle = cosmos_helpers.CosmosThrottle()
+
+    assert cosmos_helpers.cosmos_upsert_with_throttling({"id": "a"}, throttle) == "ok"
+
+    assert len(sleeps) == 2
+    assert sleeps[1] > sleeps[0] / 2
+
+
+def test_other_errors_are_not_retried(monkeypatch, sleeps):
+    error = exceptions.CosmosHttpResponseError(status_code=400, message="bad")
+    container = FakeUpsertContainer({"a": [error]})
+    monkeypatch.setattr(cosmos_helpers, "container", container, raising=False)
+    throttle = cosmos_helpers.CosmosThrottle()
+
+    status = cosmos_helpers.cosmos_upsert_with_throttling({"id": "a"}, throttle)
+
+    assert "bad" in status
+    assert (container.upserted, sleeps) == ([], [])
+
+
+def test_upsert_gives_up_after_max_attempts(monkeypatch, sleeps):
+    container = FakeUpsertContainer({"a": [make_throttled(10) for _ in range(3)]})
+    monkeypatch.setattr(cosmos_helpers, "container", container, raising=False)
+    throttle = cosmos_helpers.CosmosThrottle()
+
+    status = cosmos_helpers.cosmos_upsert_with_throttling(
+        {"id": "a"}, throttle, max_attempts=3
+    )
+
+    assert "429" in status
+    assert container.upserted == []
+    assert len(sleeps) == 2
+
+
+def test_back_off_pauses_every_worker_sharing_the_throttle(sleeps):
+    throttle = cosmos_helpers.CosmosThrottle()
+    throttle.back_off(5)
+    throttle.back_off(1)
+
+    throttle.wait()
+    throttle.wait()
+
+    assert len(sleeps) == 2
+    assert all(4 < s <= 5 for s in sleeps)
+
+
+def test_bulk_backup_retries_throttled_items(monkeypatch, sleeps):
+    # the first round runs out of attempts for "1", the second one gets it in
+    attempts = cosmos_helpers.COSMOS_BULK_MAX_ATTEMPTS + 1
+    container = FakeUpsertContainer({"1": [make_throttled(1)] * attempts})
+    monkeypatch.setattr(cosmos_helpers, "container", container, raising=False)
+    monkeypatch.setattr(cosmos_helpers, "COSMOS_BULK_RETRY_ROUNDS", 2)
+    docs = [{"id": str(i)} for i in range(3)]
+
+    ret_dict = cosmos_helpers.cosmos_backup_embeddings(docs)
+
+    assert ret_dict["failed_ids"] == []
+    assert set(ret_dict["results"].values()) == {"ok"}
+    assert sorted(container.upserted) == ["0", "1", "2"]
@@ -0,0 +1,110 @@
+from unittest import mock
+
+import pytest
+
+from utils import dedup
+
+TEXT = "the quick brown fox jumps over the lazy dog while the cat sleeps in the warm sun all afternoon long"
+
+
+def test_simhash_is_stable_and_close_for_near_duplicates():
+    near = TEXT.replace("afternoon", "evening")
+
+    assert dedup.simhash(TEXT) == dedup.simhash(TEXT.upper())
+    assert dedup.hamming_distance(dedup.simhash(TEXT), dedup.simhash(near)) < 32
+    assert dedup.simhash("") == dedup.simhash("   ")
+
+
+def test_get_bands_splits_the_signature():
+    sig = (1 << 63) | 1
+
+    bands = dedup.get_bands(sig)
+
+    assert len(bands) == dedup.SIMHASH_BANDS
+    assert bands[0] == 1
+    assert bands[-1] == 1 << (dedup.SIMHASH_BAND_BITS - 1)
+
+
+def test_signature_index_finds_signatures_within_the_distance():
+    index = dedup.SignatureIndex(max_distance=3)
+    index.add("S", "doc_S_0", 0b1111)
+
+    assert index.find_duplicate("S", 0b1111) == "doc_S_0"
+    assert index.find_duplicate("S", 0b1000) == "doc_S_0"
+    assert index.find_duplicate("S", 0b0000) is None
+    # granularities are deduplicated separately
+    assert index.find_duplicate("M", 0b1111) is None
+
+
+def test_namespace_is_the_text_suffix():
+    assert dedup.get_namespace("doc_with_underscores_S_3") == "S"
+    assert dedup.get_namespace("plain") == ""
+
+
+def test_filter_duplicate_chunks_keeps_the_first_copy():
+    chunks = [
+        ("doc_S_0", TEXT, TEXT),
+        ("doc_S_1", TEXT, TEXT),
+        ("doc_S_2", "something else entirely", "something else entirely"),
+        ("doc_M_0", TEXT, TEXT),
+    ]
+
+    with mock.patch.object(dedup, "USE_DEDUP", 1):
+        unique_chunks = dedup.filter_duplicate_chunks("doc", chunks)
+
+    assert [c[0] for c in unique_chunks] == ["doc_S_0", "doc_S_2", "doc_M_0"]
+
+
+@pytest.fixture
+def persistent_dedup(monkeypatch, redis_conn):
+    monkeypatch.setattr(dedup, "USE_DEDUP", 1)
+    monkeypatch.setattr(dedup, "REDIS_ADDR", "localhost")
+    monkeypatch.setattr(
+        dedup.redis_helpers,
+        "redis_get_missing_keys",
+        lambda conn, keys: [k for k in keys if not conn.exists(k)],
+    )
+    return redis_conn
+
+
+def test_duplicates_across_documents_are_linked(persistent_dedup):
+    redis_conn = persistent_dedup
+    dedup.filter_duplicate_chunks("a", [("a_S_0", TEXT, TEXT)], redis_conn=redis_conn)
+    redis_conn.set("a_S_0", "vector")
+
+    unique_chunks = dedup.filter_duplicate_chunks(
+        "b", [("b_S_0", TEXT, TEXT)], redis_conn=redis_conn
+    )
+
+    assert unique_chunks == []
+    assert redis_conn.hget(dedup.DEDUP_LINKS_KEY, "b_S_0") == b"a_S_0"
+    assert redis_conn.smembers(dedup.DEDUP_LINKED_PREFIX + "a_S_0") == {b"b_S_0"}
+
+
+def test_previous_version_of_the_document_is_not_a_duplicate(persistent_dedup):
+    redis_conn = persistent_dedup
+    dedup.filter_duplicate_chunks("a", [("a_S_0", TEXT, TEXT)], redis_conn=redis_conn)
+    redis_conn.set("a_S_0", "vector")
+
+    chunks = [("a_S_0", TEXT, TEXT)]
+    assert dedup.filter_duplicate_chunks("a", chunks, redis_conn=redis_conn) == chunks
+
+
+def test_missing_canonical_chunk_is_not_a_duplicate(persistent_dedup):
+    redis_conn = persistent_dedup
+    dedup.filter_duplicate_chunks("a", [("a_S_0", TEXT, TEXT)], redis_conn=redis_conn)
+
+    chunks = [("b_S_0", TEXT, TEXT)]
+    assert dedup.filter_duplicate_chunks("b", chunks, redis_conn=redis_conn) == chunks
+
+
+def test_removed_signatures_report_orphaned_duplicates(persistent_dedup):
+    redis_conn = persistent_dedup
+    dedup.filter_duplicate_chunks("a", [("a_S_0", TEXT, TEXT)], redis_conn=redis_conn)
+    redis_conn.set("a_S_0", "vector")
+    dedup.filter_duplicate_chunks("b", [("b_S_0", TEXT, TEXT)], redis_conn=redis_conn)
+    redis_conn.delete("a_S_0")
+
+    assert dedup.remove_signatures(["a_S_0"], redis_conn) == ["b_S_0"]
+
+    assert [k for k in redis_conn.values if k.startswith("dedup:")] == []
@@ -0,0 +1,99 @@
+import numpy as np
+
+from utils import emb_cache
+from utils.emb_cache import (QUERY_EMB_CACHE_PREFIX, MmapEmbeddingStore,
+                             QueryEmbeddingCache)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key, None)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+def test_query_cache_evicts_least_recently_used():
+    cache = QueryEmbeddingCache(capacity=2)
+    cache.set("a", [1.0])
+    cache.set("b", [2.0])
+
+    # reading a makes b the least recently used entry
+    assert cache.get("a") == [1.0]
+    cache.set("c", [3.0])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [1.0]
+    assert cache.get("c") == [3.0]
+
+
+def test_query_cache_falls_back_to_redis():
+    redis_conn = FakeRedis()
+    cache = QueryEmbeddingCache(capacity=1, redis_conn=redis_conn)
+    cache.set("a", [1.0, 2.0])
+    cache.set("b", [3.0, 4.0])
+
+    assert list(cache.embeddings.keys()) == ["b"]
+    assert np.allclose(cache.get("a"), [1.0, 2.0])
+    assert list(cache.embeddings.keys()) == ["a"]
+    assert QUERY_EMB_CACHE_PREFIX + "b" in redis_conn.values
+
+
+def test_mmap_stores_share_slots_across_processes(tmp_path):
+    # two stores on the same directory stand in for two worker processes
+    a = MmapEmbeddingStore(str(tmp_path), "model", 2, 2)
+    b = MmapEmbeddingStore(str(tmp_path), "model", 2, 2)
+
+    a.set("k1", [1.0, 1.0])
+    a.flush()
+    b.set("k2", [2.0, 2.0])
+    b.flush()
+
+    assert a.get("k2") == [2.0, 2.0]
+    assert b.get("k1") == [1.0, 1.0]
+    assert MmapEmbeddingStore(str(tmp_path), "model", 2, 2).get("k1") == [1.0, 1.0]
+
+
+def test_mmap_store_never_returns_a_slot_reused_by_another_process(tmp_path):
+    a = MmapEmbeddingStore(str(tmp_path), "model", 2, 2)
+    b = MmapEmbeddingStore(str(tmp_path), "model", 2, 2)
+    a.set("k1", [1.0, 1.0])
+    a.flush()
+    assert a.get("k1") == [1.0, 1.0]
+
+    b.set("k2", [2.0, 2.0])
+    b.set("k3", [3.0, 3.0])
+    b.flush()
+
+    assert a.get("k1") is None
+    assert a.get("k3") == [3.0, 3.0]
+
+
+def test_only_uncached_texts_are_embedded_in_one_batch(monkeypatch, tmp_path):
+    calls = []
+
+    def get_openai_embeddings(texts, embedding_model):
+        calls.append(list(texts))
+        return [[float(len(t)), 0.0] for t in texts]
+
+    monkeypatch.setattr(emb_cache.openai_helpers, "get_model_dims", lambda m: 2)
+    monkeypatch.setattr(
+        emb_cache.openai_helpers,
+        "get_openai_embeddings",
+        get_openai_embeddings,
+        raising=False,
+    )
+    cache = emb_cache.EmbeddingCache("model", cache_dir=str(tmp_path), capacity=4)
+    monkeypatch.setattr(emb_cache, "USE_EMB_CACHE", 1)
+    monkeypatch.setattr(emb_cache, "get_emb_cache", lambda model: cache)
+
+    first = emb_cache.get_cached_openai_embeddings(["a", "bb"], "model")
+    second = emb_cache.get_cached_openai_embeddings(["bb", "ccc", "a"], "model")
+
+    assert calls == [["a", "bb"], ["ccc"]]
+    assert first == [[1.0, 0.0], [2.0, 0.0]]
+    assert second == [[2.0, 0.0], [3.0, 0.0], [1.0, 0.0]]
+    assert cache.get_stats()["local_hits"] == 2
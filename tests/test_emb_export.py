@@ -0,0 +1,60 @@
+import numpy as np
+import pyarrow.parquet as pq
+
+from utils import emb_export
+from utils.env_vars import VECTOR_FIELD_IN_REDIS
+from utils.kb_doc import KB_Doc
+
+
+def make_doc(doc_id, vector, **fields):
+    kbd_doc = KB_Doc()
+    kbd_doc.load(dict({"id": doc_id, VECTOR_FIELD_IN_REDIS: vector}, **fields))
+    return dict(kbd_doc.get_dict())
+
+
+def test_schema_does_not_depend_on_the_first_batch(tmp_path):
+    docs = [
+        make_doc("a", [1.0, 0.0]),
+        make_doc("b", [0.0, 1.0], keyphrases=["x", "y"]),
+        make_doc("c", [1.0, 1.0], page=3),
+    ]
+
+    assert emb_export.export_embedding_docs(docs, str(tmp_path), batch_size=1) == 3
+
+    _, metadata_file = emb_export.get_export_files(str(tmp_path))
+    schema = pq.ParquetFile(metadata_file).schema_arrow
+    assert set(KB_Doc().get_fields()) - {VECTOR_FIELD_IN_REDIS} < set(schema.names)
+    assert VECTOR_FIELD_IN_REDIS not in schema.names
+
+
+def test_export_round_trip(tmp_path):
+    docs = [
+        make_doc("a", [1.0, 0.0], text_en="first"),
+        make_doc("b", [0.0, 1.0], keyphrases=["x", "y"]),
+    ]
+    emb_export.export_embedding_docs(docs, str(tmp_path), batch_size=1)
+
+    loaded = [
+        e
+        for batch in emb_export.iter_embedding_doc_batches(str(tmp_path))
+        for e in batch
+    ]
+
+    assert [e["id"] for e in loaded] == ["a", "b"]
+    assert loaded[0]["text_en"] == "first"
+    assert loaded[1]["keyphrases"] == ["x", "y"]
+    assert "keyphrases" not in loaded[0]
+    assert np.allclose(loaded[1][VECTOR_FIELD_IN_REDIS], [0.0, 1.0])
+
+
+def test_none_is_exported_as_null(tmp_path):
+    docs = [make_doc("a", [1.0, 0.0], text_en=None, extra=None)]
+    emb_export.export_embedding_docs(docs, str(tmp_path))
+
+    _, metadata_file = emb_export.get_export_files(str(tmp_path))
+    table = pq.read_table(metadata_file)
+    assert table.column("text_en").to_pylist() == [None]
+
+    loaded = next(emb_export.iter_embedding_doc_batches(str(tmp_path)))[0]
+    assert "text_en" not in loaded
+    assert "extra" not in loaded
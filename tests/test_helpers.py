@@ -0,0 +1,134 @@
+import re
+
+import pytest
+
+from utils import helpers
+from utils.kb_doc import KB_Doc
+
+
+class WordEncoder:
+    # one token per word, with the whitespace that follows it
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, text):
+        self.encoded += 1
+        return re.findall(r"\S+\s*", text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+    def decode_with_offsets(self, tokens):
+        offsets = []
+        pos = 0
+        for t in tokens:
+            offsets.append(pos)
+            pos += len(t)
+        return "".join(tokens), offsets
+
+
+@pytest.fixture
+def encoder(monkeypatch):
+    enc = WordEncoder()
+    monkeypatch.setattr(helpers.openai_helpers, "get_encoder", lambda model: enc)
+    monkeypatch.setattr(helpers.language, "detect_content_language", lambda t: "en")
+    return enc
+
+
+def make_doc(num_words):
+    kbd_doc = KB_Doc()
+    kbd_doc.load(
+        {
+            "id": "doc",
+            "text": " ".join([f"w{i}" for i in range(num_words)]),
+            "filename": "doc.pdf",
+        }
+    )
+    return kbd_doc
+
+
+@pytest.mark.parametrize("num_tokens, chunk_length, overlap", [(10, 3, 1), (9, 3, 2)])
+def test_offset_chunks_match_decoded_token_chunks(
+    encoder, num_tokens, chunk_length, overlap
+):
+    tokens = encoder.encode(" ".join([f"w{i}" for i in range(num_tokens)]))
+    text, offsets = encoder.decode_with_offsets(tokens)
+
+    chunks = helpers.chunked_text_by_offsets(
+        text, offsets, len(tokens), chunk_length, overlap
+    )
+    expected = [
+        encoder.decode(c) for c in helpers.chunked_words(tokens, chunk_length, overlap)
+    ]
+
+    assert list(chunks) == expected
+
+
+def get_granularities():
+    # chunks are max_emb_tokens - OVERLAP_TEXT tokens apart
+    overlap = helpers.OVERLAP_TEXT
+    return [
+        ("S", overlap + 10, 0),
+        ("M", overlap + 15, overlap + 10),
+        ("L", overlap + 40, overlap + 15),
+    ]
+
+
+def test_all_granularities_come_from_one_pass(monkeypatch, encoder):
+    monkeypatch.setattr(helpers.dedup, "USE_DEDUP", 0)
+
+    json_object, chunks = helpers.prepare_multi_granularity_chunks(
+        make_doc(20), "model", get_granularities()
+    )
+
+    assert encoder.encoded == 1
+    assert [c[0] for c in chunks] == [
+        "doc_S_0",
+        "doc_S_1",
+        "doc_M_0",
+        "doc_M_1",
+        "doc_L_0",
+    ]
+    assert chunks[1][1].startswith("w10 ")
+    assert chunks[3][1].startswith("w15 ")
+    assert chunks[4][1] == json_object["text"]
+    assert all([c[1] == c[2] for c in chunks])
+    assert json_object["orig_lang"] == "en"
+
+
+def test_short_documents_skip_the_larger_granularities(monkeypatch, encoder):
+    monkeypatch.setattr(helpers.dedup, "USE_DEDUP", 0)
+
+    _, chunks = helpers.prepare_multi_granularity_chunks(
+        make_doc(5), "model", get_granularities()
+    )
+
+    assert [c[0] for c in chunks] == ["doc_S_0"]
+
+
+def test_search_projects_fields_and_loads_the_payload_lazily(
+    monkeypatch, encoder, redis_conn
+):
+    queried = []
+
+    def query(conn, emb, t_id, topK, filter_param, fields):
+        queried.append(fields)
+        return [
+            {"id": str(i), "container": "kb", "filename": f"{i}.pdf", "web_url": ""}
+            for i in range(topK + 2)
+        ]
+
+    monkeypatch.setattr(helpers, "REDIS_HYBRID_SEARCH", 0)
+    monkeypatch.setattr(helpers, "REDIS_VECTOR_TYPE", "FLOAT32")
+    monkeypatch.setattr(helpers.redis_helpers, "redis_query_embedding_index", query)
+    for i in range(helpers.NUM_TOP_MATCHES + 2):
+        redis_conn.hset(str(i), "text_en", f"chunk {i}")
+
+    results = helpers.redis_knn_search(redis_conn, [1.0], helpers.NUM_TOP_MATCHES, "*")
+    context = helpers.process_search_results(results, redis_conn)
+
+    assert queried == [helpers.REDIS_SEARCH_FIELDS]
+    assert "text_en" not in helpers.REDIS_SEARCH_FIELDS
+    assert context[0] == "######\n[kb/0.pdf] chunk 0\n######\n"
+    # only the hits that make it into the context carry their text
+    assert ["text_en" in r for r in results].count(True) == helpers.NUM_TOP_MATCHES
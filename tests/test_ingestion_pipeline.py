@@ -0,0 +1,55 @@
+import pytest
+
+from utils.ingestion_pipeline import run_ingestion_pipeline
+
+
+def make_batches(num_batches, batch_size=2):
+    return [[{"id": f"{b}_{i}"} for i in range(batch_size)] for b in range(num_batches)]
+
+
+def test_every_sink_gets_every_batch():
+    received = {"a": [], "b": []}
+    sinks = {
+        name: (lambda batch, name=name: received[name].extend(batch))
+        for name in received
+    }
+
+    emb_documents, stats = run_ingestion_pipeline(
+        make_batches(5), sinks, max_queue_size=1
+    )
+
+    assert [d["id"] for d in emb_documents] == [d["id"] for d in received["a"]]
+    assert received["a"] == received["b"]
+    assert len(emb_documents) == 10
+    assert stats["a"]["batches"] == 5
+
+
+def test_failed_sink_drains_its_queue_and_reraises_the_first_error():
+    calls = []
+
+    def failing_sink(batch):
+        calls.append(batch)
+        raise ValueError(f"failed {len(calls)}")
+
+    ok = []
+    sinks = {"failing": failing_sink, "ok": ok.extend}
+
+    # a queue of one would block the producer if the failed stage stopped reading
+    with pytest.raises(ValueError, match="failed 1"):
+        run_ingestion_pipeline(make_batches(6), sinks, max_queue_size=1)
+
+    assert len(calls) == 1
+    assert len(ok) == 12
+
+
+def test_producer_error_still_stops_the_stages():
+    def batches():
+        yield make_batches(1)[0]
+        raise RuntimeError("embedding failed")
+
+    received = []
+
+    with pytest.raises(RuntimeError, match="embedding failed"):
+        run_ingestion_pipeline(batches(), {"a": received.extend})
+
+    assert len(received) == 2
@@ -0,0 +1,66 @@
+import pytest
+
+from utils import language
+
+
+@pytest.fixture
+def translator(monkeypatch):
+    calls = []
+
+    def call_translator(path, params, texts):
+        calls.append(list(texts))
+        return [
+            {"translations": [{"text": t.upper()}]} if t != "fail" else {}
+            for t in texts
+        ]
+
+    cache = language.TranslationCache()
+    cache.redis_checked = True
+    monkeypatch.setattr(language, "translation_cache", cache)
+    monkeypatch.setattr(language, "call_translator", call_translator)
+    return calls
+
+
+def test_batches_are_capped_by_elements(monkeypatch):
+    monkeypatch.setitem(language.TRANSLATOR_MAX_ELEMENTS, "detect", 2)
+
+    batches = language.get_translator_batches(["a", "b", "c", "d", "e"], "detect")
+
+    assert list(batches) == [[0, 1], [2, 3], [4]]
+
+
+def test_batches_are_capped_by_characters(monkeypatch):
+    monkeypatch.setattr(language, "TRANSLATOR_MAX_CHARS", 10)
+
+    batches = language.get_translator_batches(["x" * 4, "x" * 4, "x" * 4], "translate")
+
+    assert list(batches) == [[0, 1], [2]]
+
+
+def test_oversized_text_gets_its_own_batch(monkeypatch):
+    monkeypatch.setattr(language, "TRANSLATOR_MAX_CHARS", 10)
+
+    batches = language.get_translator_batches(["a", "x" * 20, "b"], "translate")
+
+    assert list(batches) == [[0], [1], [2]]
+
+
+def test_translations_are_batched_and_cached(monkeypatch, translator):
+    monkeypatch.setitem(language.TRANSLATOR_MAX_ELEMENTS, "translate", 2)
+
+    assert language.translate_batch(["a", "b", "c"], "fr") == ["A", "B", "C"]
+    assert translator == [["a", "b"], ["c"]]
+
+    assert language.translate_batch(["c", "d"], "fr") == ["C", "D"]
+    assert translator[-1] == ["d"]
+
+    # the same text from another language is a different translation
+    language.translate_batch(["a"], "de")
+    assert translator[-1] == ["a"]
+
+
+def test_failed_translations_keep_the_text_and_are_retried(translator):
+    assert language.translate_batch(["fail", "ok"], "fr") == ["fail", "OK"]
+    assert language.translate_batch(["fail", "ok"], "fr") == ["fail", "OK"]
+
+    assert translator == [["fail", "ok"], ["fail"]]
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from utils.env_vars import VECTOR_FIELD_IN_REDIS
+from utils.local_vecstore import LocalVectorStore
+
+
+def make_doc(doc_id, vector, **fields):
+    return dict({"id": doc_id, VECTOR_FIELD_IN_REDIS: vector}, **fields)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalVectorStore(str(tmp_path), 2, initial_capacity=2)
+    store.upsert(
+        [
+            make_doc("a", [1, 0], container="kb", category="x"),
+            make_doc("b", [0, 1], container="kb", category="y"),
+            make_doc("c", [1, 1], container="web", category="y"),
+        ]
+    )
+    return store
+
+
+def get_ids(store, filter_param):
+    mask = store.get_filter_mask(filter_param)
+    return sorted([store.columns["id"][r] for r in np.nonzero(mask)[0]])
+
+
+def test_filter_clauses_are_anded(store):
+    assert get_ids(store, "@container:{kb} @category:{y}") == ["b"]
+
+
+def test_filter_pipe_ors_clauses(store):
+    assert get_ids(store, "@category:{x} | @container:{web}") == ["a", "c"]
+
+
+def test_filter_pipe_inside_tag_ors_values(store):
+    assert get_ids(store, "@category:{x|y} @container:{kb}") == ["a", "b"]
+
+
+def test_filter_parentheses_group_clauses(store):
+    assert get_ids(store, "@container:{kb} (@category:{x} | @category:{z})") == ["a"]
+
+
+def test_filter_without_prefix_and_wildcard(store):
+    assert get_ids(store, "category:{y}") == ["b", "c"]
+    assert get_ids(store, "*") == ["a", "b", "c"]
+
+
+def test_unsupported_filter_raises(store):
+    with pytest.raises(ValueError):
+        store.get_filter_mask("@price:[1 2]")
+    with pytest.raises(ValueError):
+        store.get_filter_mask("(@category:{x}")
+
+
+def test_store_reopens_from_snapshot_and_journal(tmp_path, store):
+    store.delete(["a"])
+    store.upsert([make_doc("d", [0, 2], container="kb", category="x")])
+
+    reopened = LocalVectorStore(str(tmp_path), 2)
+
+    assert reopened.count == 3
+    assert reopened.columns == store.columns
+    assert reopened.rows == store.rows
+    assert np.allclose(reopened.vectors[:3], store.vectors[:3])
+    results = reopened.query([0, 1], None, topK=1)
+    assert results[0]["id"] in ["b", "d"]
+
+
+def test_store_picks_up_writes_from_another_process(tmp_path, store):
+    # a second store on the same directory stands in for another worker
+    other = LocalVectorStore(str(tmp_path), 2)
+
+    other.upsert([make_doc("d", [0, 2], container="kb", category="x")])
+    assert store.query([0, 1], None, topK=4)[0]["id"] in ["b", "d"]
+    assert store.count == 4
+
+    # growing the matrix replaces the vectors file
+    other.upsert([make_doc(str(i), [1, 0]) for i in range(10)])
+    other.delete(["a"])
+    results = store.query([0, 1], None, topK=20)
+    assert store.count == 13
+    assert "a" not in [r["id"] for r in results]
+
+    store.upsert([make_doc("e", [0, 3], container="kb", category="y")])
+    assert other.query([0, 1], None, topK=1, filter_param="@category:{y}")
+    assert other.rows == store.rows
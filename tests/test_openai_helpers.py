@@ -0,0 +1,49 @@
+from unittest import mock
+
+import pytest
+
+from utils import openai_helpers
+
+
+class WordEncoder:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def word_encoder(monkeypatch):
+    monkeypatch.setattr(openai_helpers, "get_encoder", lambda model: WordEncoder())
+
+
+def test_batches_are_capped_by_tokens_and_size():
+    batches = openai_helpers.get_embedding_batches(
+        [3, 3, 3, 1, 1, 1], max_batch_tokens=6, max_batch_size=2
+    )
+
+    assert list(batches) == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_oversized_text_gets_its_own_batch():
+    batches = openai_helpers.get_embedding_batches([1, 10, 1], max_batch_tokens=5)
+
+    assert list(batches) == [[0], [1], [2]]
+
+
+def test_embeddings_come_back_in_input_order():
+    calls = []
+
+    def create(input, engine):
+        calls.append(list(input))
+        # the service does not promise to answer in input order
+        data = [
+            {"index": i, "embedding": [float(len(t.split()))]}
+            for i, t in enumerate(input)
+        ]
+        return {"data": list(reversed(data))}
+
+    texts = ["a", "b b", "c c c", "d d d d"]
+    with mock.patch("openai.Embedding.create", create):
+        embeddings = openai_helpers.get_openai_embeddings(texts)
+
+    assert embeddings == [[1.0], [2.0], [3.0], [4.0]]
+    assert calls == [texts]
@@ -0,0 +1,278 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from utils import redis_helpers
+
+
+def make_match(doc_id, **fields):
+    return SimpleNamespace(id=doc_id, **fields)
+
+
+def test_fusion_rewards_documents_in_both_rankings():
+    knn = [make_match("a", text_en="A"), make_match("b", text_en="B")]
+    bm25 = [make_match("c", text_en="C"), make_match("b", text_en="B")]
+
+    fused = redis_helpers.fuse_rankings([knn, bm25], ["text_en"], 3, k=60)
+
+    assert [r["id"] for r in fused] == ["b", "a", "c"]
+    assert fused[0]["hybrid_score"] == pytest.approx(2 / 62)
+    assert fused[1]["hybrid_score"] == pytest.approx(1 / 61)
+    assert fused[0]["text_en"] == "B"
+
+
+def test_fusion_keeps_top_k_and_known_fields():
+    knn = [make_match(str(i), container="kb") for i in range(5)]
+
+    fused = redis_helpers.fuse_rankings([knn, []], ["container", "text_en"], 2)
+
+    assert [r["id"] for r in fused] == ["0", "1"]
+    assert "text_en" not in fused[0]
+    assert fused[0]["container"] == "kb"
+
+
+@pytest.mark.parametrize(
+    "filter_param, expected",
+    [
+        (None, "*"),
+        ("*", "*"),
+        ("@container:kb-docs", "@container:{kb\\-docs}"),
+        ("container:kb", "@container:{kb}"),
+        ("@container:{kb}", "@container:{kb}"),
+        (
+            "@container:kb | @filename:a.pdf",
+            "@container:{kb} | @filename:{a\\.pdf}",
+        ),
+        ("@text_en:hello", "@text_en:hello"),
+        ("@text_en:e-mail", "@text_en:e\\-mail"),
+        ("@filename:{annual report.pdf}", "@filename:{annual\\ report\\.pdf}"),
+        ("@container:{kb-a|kb\\-b}", "@container:{kb\\-a | kb\\-b}"),
+    ],
+)
+def test_filter_query_rewrites_tag_fields(monkeypatch, filter_param, expected):
+    monkeypatch.setattr(redis_helpers, "REDIS_HYBRID_SEARCH", 1)
+
+    assert redis_helpers.get_filter_query(filter_param) == expected
+
+
+def test_filter_on_a_field_outside_the_schema_is_rejected(monkeypatch):
+    monkeypatch.setattr(redis_helpers, "REDIS_HYBRID_SEARCH", 0)
+
+    with pytest.raises(ValueError, match="doc_url"):
+        redis_helpers.get_filter_query("@doc_url:https://example.com")
+    with pytest.raises(ValueError, match="text_en"):
+        redis_helpers.get_filter_query("@text_en:hello")
+
+
+def make_info(data_type=None):
+    attr = ["identifier", "item_vector", "attribute", "item_vector", "type", "VECTOR"]
+    if data_type is not None:
+        attr += ["data_type", data_type]
+    return {"index_name": "kb_1", "attributes": [attr]}
+
+
+@pytest.fixture
+def index_conn(monkeypatch, redis_conn):
+    monkeypatch.setattr(redis_helpers, "VECTOR_FIELD_IN_REDIS", "item_vector")
+    monkeypatch.setattr(redis_helpers, "index_configs", {})
+    redis_conn.ft = lambda name: SimpleNamespace(info=lambda: redis_conn.info)
+    redis_conn.info = make_info()
+    return redis_conn
+
+
+def test_vector_type_comes_from_the_live_index(index_conn):
+    info = make_info("FLOAT16")
+
+    assert redis_helpers.get_index_vector_type(index_conn, info) == "FLOAT16"
+
+
+def test_vector_type_falls_back_to_the_recorded_config(index_conn):
+    assert redis_helpers.get_index_vector_type(index_conn, make_info()) == "FLOAT32"
+
+    config_key = redis_helpers.INDEX_CONFIG_PREFIX + "kb_1"
+    index_conn.hset(config_key, "vector_type", "FLOAT16")
+    redis_helpers.index_configs.clear()
+
+    assert redis_helpers.get_index_vector_type(index_conn, make_info()) == "FLOAT16"
+
+
+def test_changed_vector_type_rebuilds_the_index(monkeypatch, index_conn):
+    rebuilds = []
+    monkeypatch.setattr(redis_helpers, "REDIS_ADDR", "localhost")
+    monkeypatch.setattr(redis_helpers, "REDIS_VECTOR_TYPE", "FLOAT32")
+    monkeypatch.setattr(
+        redis_helpers,
+        "start_background_rebuild",
+        lambda conn, migrate=False, convert_from=None: rebuilds.append(convert_from),
+    )
+    index_conn.info = make_info("FLOAT16")
+
+    redis_helpers.test_redis(index_conn)
+
+    assert rebuilds == ["FLOAT16"]
+
+
+def test_convert_vectors_reencodes_only_the_old_type(index_conn):
+    dims = redis_helpers.get_model_dims(redis_helpers.CHOSEN_EMB_MODEL)
+    vector = np.arange(dims) / dims
+    index_conn.hset("old", "item_vector", vector.astype(np.float16).tobytes())
+    index_conn.hset("new", "item_vector", vector.astype(np.float32).tobytes())
+    index_conn.hset("other", "text_en", "no vector")
+
+    redis_helpers.redis_convert_vectors(index_conn, "FLOAT16")
+
+    for k in ["old", "new"]:
+        converted = np.frombuffer(index_conn.hget(k, "item_vector"), dtype=np.float32)
+        assert np.allclose(converted, vector, atol=1e-3)
+    assert index_conn.hgetall("other") == {b"text_en": b"no vector"}
+
+
+def test_shard_layout_is_recorded_and_enforced(make_redis):
+    shards = [make_redis(), make_redis()]
+    redis_helpers.check_shard_layout(shards)
+    assert shards[1].get(redis_helpers.SHARD_LAYOUT_KEY) == b"1/2"
+
+    # the same layout starts again
+    redis_helpers.check_shard_layout(shards)
+
+    with pytest.raises(Exception, match="rebalanced"):
+        redis_helpers.check_shard_layout(shards + [make_redis()])
+    with pytest.raises(Exception, match="rebalanced"):
+        redis_helpers.check_shard_layout(list(reversed(shards)))
+
+
+def test_index_config_is_read_per_shard(make_redis, index_conn):
+    other = make_redis()
+    other.ft = index_conn.ft
+    other.hset(redis_helpers.INDEX_CONFIG_PREFIX + "kb_1", "algorithm", "FLAT")
+    index_conn.hset(redis_helpers.INDEX_CONFIG_PREFIX + "kb_1", "algorithm", "HNSW")
+
+    assert redis_helpers.get_ef_runtime(index_conn) is not None
+    assert redis_helpers.get_ef_runtime(other) is None
+
+
+def test_load_fields_only_fetches_what_the_results_lack(monkeypatch, redis_conn):
+    fetched = []
+    hmget = redis_conn.hmget
+
+    def fetch(key, fields):
+        fetched.append(key)
+        return hmget(key, fields)
+
+    monkeypatch.setattr(redis_conn, "hmget", fetch)
+    redis_conn.hset("a", "text_en", "chunk a")
+    results = [{"id": "a"}, {"id": "b", "text_en": "loaded"}, {"id": "gone"}]
+
+    redis_helpers.redis_load_fields(redis_conn, results, ["text_en"])
+
+    assert fetched == ["a", "gone"]
+    assert [r["text_en"] for r in results] == ["chunk a", "loaded", ""]
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    monkeypatch.setattr(redis_helpers, "conn_clients", {})
+    monkeypatch.setattr(redis_helpers, "index_checked_at", {})
+    monkeypatch.setattr(redis_helpers, "REDIS_PASSWORD", "")
+    monkeypatch.setattr(redis_helpers, "REDIS_ADDR", "localhost")
+    monkeypatch.setattr(redis_helpers, "REDIS_PORT", "6379")
+    checks = []
+    monkeypatch.setattr(redis_helpers, "test_redis", lambda c: checks.append("test"))
+    monkeypatch.setattr(
+        redis_helpers, "redis_ensure_index", lambda c: checks.append("ensure")
+    )
+    return checks
+
+
+def test_connections_share_one_pool_per_node(clients):
+    conn = redis_helpers.get_new_conn()
+
+    assert redis_helpers.get_new_conn() is conn
+    assert redis_helpers.get_conn("localhost", 6379) is conn
+    assert redis_helpers.get_conn("localhost", 6380) is not conn
+    max_connections = conn.connection_pool.max_connections
+    assert max_connections == redis_helpers.REDIS_MAX_CONNECTIONS
+
+
+def test_index_is_only_checked_once_per_interval(monkeypatch, clients):
+    conn = redis_helpers.get_new_conn()
+    redis_helpers.get_new_conn()
+    assert clients == ["test"]
+
+    # a failed search forces a check, which only restores a lost index
+    redis_helpers.check_index(conn, force=True)
+    assert clients == ["test", "ensure"]
+
+    monkeypatch.setattr(redis_helpers, "REDIS_INDEX_CHECK_SECS", 0)
+    redis_helpers.get_new_conn()
+    assert clients == ["test", "ensure", "test"]
+
+
+class ScriptRedis:
+    # runs GET_AND_TOUCH_SCRIPT in Python: one HGET per key, and keys that
+    # already expire get the new expiry
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self.registered = []
+        self.calls = []
+
+    def __getattr__(self, name):
+        return getattr(self.redis_conn, name)
+
+    def register_script(self, script):
+        self.registered.append(script)
+        return self.run_script
+
+    def run_script(self, keys, args):
+        self.calls.append((keys, args))
+        values = []
+        for k, f in zip(keys, args[1:]):
+            values.append(self.redis_conn.hget(k, f))
+            if k in self.redis_conn.expiry:
+                self.redis_conn.expire(k, args[0])
+        return values
+
+
+@pytest.fixture
+def cache_conn(monkeypatch, redis_conn):
+    monkeypatch.setattr(redis_helpers, "REDIS_ADDR", "localhost")
+    monkeypatch.setattr(redis_helpers, "USE_REDIS_CACHE", 1)
+    monkeypatch.setattr(redis_helpers, "REDIS_CLIENT_CACHE_SIZE", 0)
+    monkeypatch.setattr(redis_helpers, "cache_scripts", {})
+    return ScriptRedis(redis_conn)
+
+
+def test_set_writes_the_value_and_its_expiry(cache_conn):
+    redis_helpers.redis_set(cache_conn, '"conv"', "history", "h", expiry=60)
+    redis_helpers.redis_set(cache_conn, "other", "history", "o")
+
+    assert cache_conn.hget("conv", "history") == b"h"
+    assert cache_conn.expiry == {"conv": 60}
+
+
+def test_mget_reads_and_touches_in_one_script_call(cache_conn):
+    redis_helpers.redis_set(cache_conn, "conv", "history", "h", expiry=60)
+    redis_helpers.redis_set(cache_conn, "conv", "intent", "i", expiry=60)
+    redis_helpers.redis_set(cache_conn, "other", "history", "o")
+
+    values = redis_helpers.redis_mget(
+        cache_conn,
+        [("conv", "history"), ("other", "history"), ("conv", "intent"), ("x", "y")],
+        expiry=300,
+    )
+
+    assert values == [b"h", b"o", b"i", None]
+    assert cache_conn.calls == [
+        (["conv", "other", "conv", "x"], [300, "history", "history", "intent", "y"])
+    ]
+    # keys without an expiry are left persistent
+    assert cache_conn.expiry == {"conv": 300}
+
+
+def test_script_is_registered_once_per_connection(cache_conn):
+    for _ in range(3):
+        redis_helpers.redis_get(cache_conn, "conv", "history")
+
+    assert cache_conn.registered == [redis_helpers.GET_AND_TOUCH_SCRIPT]
+    assert len(cache_conn.calls) == 3
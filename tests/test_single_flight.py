@@ -0,0 +1,132 @@
+import threading
+import time
+
+from utils import single_flight as sf
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and (key in self.values):
+            return False
+        self.values[key] = value
+        return True
+
+    def exists(self, key):
+        return key in self.values
+
+    def register_script(self, script):
+        def release(keys, args):
+            if self.values.get(keys[0], None) == args[0]:
+                del self.values[keys[0]]
+
+        return release
+
+
+def test_flight_key_uses_the_exact_cache_key():
+    assert sf.get_flight_key("zs: q", "response", "*") != sf.get_flight_key(
+        "zs:  q", "response", "*"
+    )
+    assert sf.get_flight_key("q", "a", "*") != sf.get_flight_key("q", "b", "*")
+
+
+def test_followers_wait_for_the_leader():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(sf.single_flight(None, "q", "f", "*", compute))
+    )
+    leader.start()
+    started.wait(5)
+
+    followers = [
+        threading.Thread(
+            target=lambda: results.append(
+                sf.single_flight(None, "q", "f", "*", compute)
+            )
+        )
+        for _ in range(3)
+    ]
+    for t in followers:
+        t.start()
+    # give the followers time to find the leader's flight
+    time.sleep(0.2)
+    release.set()
+    for t in [leader] + followers:
+        t.join(5)
+
+    assert results == ["answer"] * 4
+    assert len(calls) == 1
+    assert sf.flights == {}
+
+
+def test_leader_error_reaches_followers_which_recompute():
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("search failed")
+
+    errors = []
+
+    def lead():
+        try:
+            sf.single_flight(None, "q", "f", "*", fail)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(5)
+
+    results = []
+    follower = threading.Thread(
+        target=lambda: results.append(
+            sf.single_flight(None, "q", "f", "*", lambda: "retried")
+        )
+    )
+    follower.start()
+    time.sleep(0.2)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 1
+    assert results == ["retried"]
+
+
+def test_remote_follower_reads_the_leaders_cached_result():
+    redis_conn = FakeRedis()
+    lease_key = sf.SINGLE_FLIGHT_PREFIX + sf.get_flight_key("q", "f", "*")
+    redis_conn.values[lease_key] = "other-worker"
+
+    def compute():
+        raise AssertionError("the leader in another worker computes it")
+
+    assert (
+        sf.single_flight(redis_conn, "q", "f", "*", compute, lambda: "cached")
+        == "cached"
+    )
+
+
+def test_leader_releases_its_lease():
+    redis_conn = FakeRedis()
+
+    assert (
+        sf.single_flight(redis_conn, "q", "f", "*", lambda: "answer", lambda: None)
+        == "answer"
+    )
+    assert redis_conn.values == {}
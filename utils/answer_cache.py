@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+from redis.commands.search.field import TagField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition
+from redis.commands.search.query import Query
+
+from utils import openai_helpers, redis_helpers
+from utils.env_vars import *
+
+ANSWER_CACHE_INDEX_NAME = "answer_cache_idx"
+ANSWER_CACHE_PREFIX = "answer_cache:"
+ANSWER_CACHE_LRU_KEY = "answer_cache_lru"
+ANSWER_CACHE_VECTOR_FIELD = "query_vector"
+KB_VERSION_KEY = "kb_version"
+
+
+def get_filter_key(filter_param):
+    if (filter_param is None) or (filter_param.strip() == ""):
+        filter_param = "*"
+    return hashlib.sha256(filter_param.encode("utf-8")).hexdigest()[:16]
+
+
+def get_kb_version(redis_conn):
+    version = redis_conn.get(KB_VERSION_KEY)
+    return version.decode("utf-8") if version is not None else "0"
+
+
+def bump_kb_version(redis_conn=None):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return None
+
+    if redis_conn is None:
+        redis_conn = redis_helpers.get_new_conn()
+
+    try:
+        return redis_conn.incr(KB_VERSION_KEY)
+    except Exception as e:
+        logging.warning(f"Failed to bump the knowledge base version: {e}")
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        redis_conn,
+        embedding_model=CHOSEN_EMB_MODEL,
+        capacity=ANSWER_CACHE_CAPACITY,
+        ttl=ANSWER_CACHE_TTL_SECS,
+        min_similarity=ANSWER_CACHE_MIN_SIMILARITY,
+    ):
+        self.redis_conn = redis_conn
+        self.embedding_model = embedding_model
+        self.capacity = capacity
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.dims = openai_helpers.get_model_dims(embedding_model)
+        self.index_checked = False
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def check_index(self):
+        with self.lock:
+            if self.index_checked:
+                return
+
+            try:
+                self.redis_conn.ft(ANSWER_CACHE_INDEX_NAME).info()
+            except Exception:
+                fields = [
+                    VectorField(
+                        ANSWER_CACHE_VECTOR_FIELD,
+                        "FLAT",
+                        {
+                            "TYPE": "FLOAT32",
+                            "DIM": self.dims,
+                            "DISTANCE_METRIC": "COSINE",
+                            "INITIAL_CAP": self.capacity,
+                        },
+                    ),
+                    TagField("agent"),
+                    TagField("filter_key"),
+                    TagField("kb_version"),
+                ]
+                self.redis_conn.ft(ANSWER_CACHE_INDEX_NAME).create_index(
+                    fields, definition=IndexDefinition(prefix=[ANSWER_CACHE_PREFIX])
+                )
+                logging.info(f"Created Redis index {ANSWER_CACHE_INDEX_NAME}")
+
+            self.index_checked = True
+
+    def get_tags_query(self, agent_name, filter_param, kb_version):
+        tags = {
+            "agent": agent_name,
+            "filter_key": get_filter_key(filter_param),
+            "kb_version": kb_version,
+        }
+        return " ".join(
+            [f"@{t}:{{{redis_helpers.escape_tag_value(v)}}}" for t, v in tags.items()]
+        )
+
+    def lookup(self, query_emb, agent_name, filter_param):
+        self.check_index()
+
+        # the answer is stored under the version it was looked up with, so an
+        # ingestion that lands while it is generated leaves it stale
+        kb_version = get_kb_version(self.redis_conn)
+        tags_query = self.get_tags_query(agent_name, filter_param, kb_version)
+        q = (
+            Query(
+                f"({tags_query})=>[KNN 1 @{ANSWER_CACHE_VECTOR_FIELD} $vec_param AS vector_score]"
+            )
+            .sort_by("vector_score")
+            .paging(0, 1)
+            .return_fields("vector_score", "answer", "query")
+            .dialect(2)
+        )
+        params_dict = {"vec_param": np.array(query_emb, dtype=np.float32).tobytes()}
+
+        try:
+            docs = (
+                self.redis_conn.ft(ANSWER_CACHE_INDEX_NAME)
+                .search(q, query_params=params_dict)
+                .docs
+            )
+        except Exception as e:
+            if redis_helpers.is_missing_index_error(e):
+                with self.lock:
+                    self.index_checked = False
+            logging.warning(f"Answer cache lookup failed: {e}")
+            docs = []
+
+        hit = None
+        if len(docs) > 0:
+            similarity = 1 - float(docs[0].vector_score)
+            if similarity >= self.min_similarity:
+                hit = docs[0]
+
+        with self.lock:
+            self.stats["hits" if hit is not None else "misses"] += 1
+
+        if hit is None:
+            return None, kb_version
+
+        p = self.redis_conn.pipeline(transaction=False)
+        p.zadd(ANSWER_CACHE_LRU_KEY, {hit.id: time.time()})
+        p.expire(hit.id, self.ttl)
+        p.execute()
+
+        logging.info(
+            f"Answer cache hit for a query similar to '{hit.query}' ({similarity:.4f})"
+        )
+
+        return hit.answer, kb_version
+
+    def store(self, query, query_emb, agent_name, filter_param, answer, kb_version):
+        self.check_index()
+
+        key = ANSWER_CACHE_PREFIX + str(uuid.uuid4())
+        now = time.time()
+
+        p = self.redis_conn.pipeline(transaction=False)
+        p.hset(
+            key,
+            mapping={
+                ANSWER_CACHE_VECTOR_FIELD: np.array(
+                    query_emb, dtype=np.float32
+                ).tobytes(),
+                "agent": agent_name,
+                "filter_key": get_filter_key(filter_param),
+                "kb_version": kb_version,
+                "query": query,
+                "answer": answer,
+            },
+        )
+        p.expire(key, self.ttl)
+        p.zadd(ANSWER_CACHE_LRU_KEY, {key: now})
+        # entries that expired on their own only need to leave the LRU set
+        p.zremrangebyscore(ANSWER_CACHE_LRU_KEY, "-inf", now - self.ttl)
+        p.zcard(ANSWER_CACHE_LRU_KEY)
+        size = p.execute()[-1]
+
+        if size > self.capacity:
+            evicted = self.redis_conn.zpopmin(
+                ANSWER_CACHE_LRU_KEY, size - self.capacity
+            )
+            self.redis_conn.delete(*[k for k, _ in evicted])
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total > 0 else 0.0
+        return stats
+
+
+answer_cache = None
+answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    global answer_cache
+
+    if (
+        (USE_ANSWER_CACHE != 1)
+        or (USE_REDIS_CACHE != 1)
+        or (REDIS_ADDR is None)
+        or (REDIS_ADDR == "")
+    ):
+        return None
+
+    with answer_cache_lock:
+        if answer_cache is None:
+            answer_cache = AnswerCache(redis_helpers.get_new_conn())
+
+    return answer_cache
+
+
+def get_cached_answer(query_emb, agent_name, filter_param):
+    cache = get_answer_cache()
+    if cache is None:
+        return None, None
+
+    try:
+        return cache.lookup(query_emb, agent_name, filter_param)
+    except Exception as e:
+        logging.warning(f"Answer cache lookup failed: {e}")
+        return None, None
+
+
+def cache_answer(query, query_emb, agent_name, filter_param, answer, kb_version):
+    cache = get_answer_cache()
+    if (cache is None) or (kb_version is None):
+        return
+
+    try:
+        cache.store(query, query_emb, agent_name, filter_param, answer, kb_version)
+    except Exception as e:
+        logging.warning(f"Answer cache write failed: {e}")
@@ -0,0 +1,307 @@
+import argparse
+import csv
+import hashlib
+import time
+
+import numpy as np
+
+from utils import openai_helpers, redis_helpers
+from utils.env_vars import *
+
+OLYMPICS_CSV = "kb_docs_samples/olympics_sections_text.csv"
+
+# the production index has no prefix and picks up every hash with its vector or
+# text field, so benchmark hashes use their own prefix and field names
+BENCH_PREFIX = "bench:"
+BENCH_VECTOR_FIELD = "bench_vector"
+BENCH_TEXT_FIELD = "bench_text"
+
+
+def load_sample_texts(filename=OLYMPICS_CSV, limit=-1):
+    texts = []
+
+    with open(filename, "r", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if (limit != -1) and (len(texts) >= limit):
+                break
+            texts.append(row["content"])
+
+    return texts
+
+
+def deterministic_embedding(text, dims=ADA_002_EMBED_NUM_DIMS):
+    vector = np.zeros(dims, dtype=np.float32)
+
+    for word in text.lower().split():
+        h = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:8], "big")
+        vector[h % dims] += 1.0 if (h >> 63) & 1 else -1.0
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def benchmark_embeddings(texts, embedding_model=CHOSEN_EMB_MODEL):
+    enc = openai_helpers.get_encoder(embedding_model)
+    texts = [enc.decode(enc.encode(t)[:SMALL_EMB_TOKEN_NUM]) for t in texts]
+
+    b = time.time()
+    for t in texts:
+        openai_helpers.get_openai_embedding(t, embedding_model)
+    per_chunk_secs = time.time() - b
+
+    b = time.time()
+    openai_helpers.get_openai_embeddings(texts, embedding_model)
+    batch_secs = time.time() - b
+
+    results = {
+        "num_chunks": len(texts),
+        "per_chunk_secs": per_chunk_secs,
+        "per_chunk_chunks_per_sec": len(texts) / per_chunk_secs,
+        "batch_secs": batch_secs,
+        "batch_chunks_per_sec": len(texts) / batch_secs,
+        "speedup": per_chunk_secs / batch_secs,
+    }
+
+    print(
+        f"Per-chunk: {results['per_chunk_chunks_per_sec']:.2f} chunks/sec - "
+        f"Batched: {results['batch_chunks_per_sec']:.2f} chunks/sec - "
+        f"Speedup: {results['speedup']:.2f}x"
+    )
+
+    return results
+
+
+def exact_top_k(vectors, query_vectors, k):
+    scores = query_vectors @ vectors.T
+    return [list(np.argsort(-s)[:k]) for s in scores]
+
+
+def recall_at_k(expected, found):
+    hits = [len(set(e) & set(f)) / len(e) for e, f in zip(expected, found)]
+    return sum(hits) / len(hits)
+
+
+def get_benchmark_prefix(index_name):
+    return f"{BENCH_PREFIX}{index_name}:"
+
+
+def delete_benchmark_index(redis_conn, index_name):
+    try:
+        redis_conn.ft(index_name).dropindex(delete_documents=True)
+    except Exception:
+        pass
+    redis_conn.delete(redis_helpers.INDEX_CONFIG_PREFIX + index_name)
+
+    # hashes written before the index existed are not dropped with it
+    keys = list(redis_conn.scan_iter(match=f"{get_benchmark_prefix(index_name)}*"))
+    for i in range(0, len(keys), REDIS_BULK_BATCH_SIZE):
+        redis_conn.delete(*keys[i : i + REDIS_BULK_BATCH_SIZE])
+
+
+def load_benchmark_index(
+    redis_conn, vectors, texts, index_name, vector_type="FLOAT32", **index_params
+):
+    prefix = get_benchmark_prefix(index_name)
+    delete_benchmark_index(redis_conn, index_name)
+
+    b = time.time()
+    redis_helpers.create_search_index(
+        redis_conn,
+        BENCH_VECTOR_FIELD,
+        len(vectors),
+        vectors.shape[1],
+        "COSINE",
+        vector_type=vector_type,
+        index_name=index_name,
+        prefix=prefix,
+        **index_params,
+    )
+
+    dtype = redis_helpers.get_vector_dtype(vector_type)
+    p = redis_conn.pipeline(transaction=False)
+    for i, (v, t) in enumerate(zip(vectors, texts)):
+        p.hset(
+            f"{prefix}{i}",
+            mapping={
+                BENCH_TEXT_FIELD: t,
+                BENCH_VECTOR_FIELD: v.astype(dtype).tobytes(),
+            },
+        )
+        if i % REDIS_BULK_BATCH_SIZE == 0:
+            p.execute()
+    p.execute()
+
+    while int(redis_conn.ft(index_name).info().get("indexing", 0)) == 1:
+        time.sleep(0.1)
+
+    return time.time() - b
+
+
+def get_benchmark_memory_mb(redis_conn, index_name, num_docs, sample=100):
+    info = redis_conn.ft(index_name).info()
+    step = max(num_docs // sample, 1)
+    sampled = [
+        redis_conn.memory_usage(f"{get_benchmark_prefix(index_name)}{i}") or 0
+        for i in range(0, num_docs, step)
+    ]
+    docs_mb = sum(sampled) / len(sampled) * num_docs / (1024 * 1024)
+
+    return {
+        "vector_index_mb": float(info.get("vector_index_sz_mb", 0)),
+        "docs_mb": docs_mb,
+    }
+
+
+def query_benchmark_index(
+    redis_conn, index_name, query_vectors, k, vector_type="FLOAT32", ef_runtime=None
+):
+    dtype = redis_helpers.get_vector_dtype(vector_type)
+    q = redis_helpers.get_knn_query(
+        "*", k, ["vector_score"], ef_runtime, vector_field=BENCH_VECTOR_FIELD
+    )
+    found = []
+    latencies = []
+
+    for qv in query_vectors:
+        params_dict = {"vec_param": qv.astype(dtype).tobytes()}
+
+        b = time.time()
+        results = redis_conn.ft(index_name).search(q, query_params=params_dict)
+        latencies.append(time.time() - b)
+
+        found.append([int(d.id.split(":")[-1]) for d in results.docs])
+
+    return found, latencies
+
+
+def benchmark_quantization(texts, queries, k=NUM_TOP_MATCHES):
+    redis_conn = redis_helpers.get_new_conn()
+    vectors = np.array([deterministic_embedding(t) for t in texts])
+    query_vectors = np.array([deterministic_embedding(q) for q in queries])
+    expected = exact_top_k(vectors, query_vectors, k)
+
+    results = {}
+
+    for vector_type in ["FLOAT32", "FLOAT16"]:
+        index_name = f"bench_{vector_type.lower()}"
+        try:
+            build_secs = load_benchmark_index(
+                redis_conn, vectors, texts, index_name, vector_type
+            )
+            oversample = REDIS_RESCORE_OVERSAMPLE if vector_type != "FLOAT32" else 1
+            found, latencies = query_benchmark_index(
+                redis_conn, index_name, query_vectors, k * oversample, vector_type
+            )
+            memory = get_benchmark_memory_mb(redis_conn, index_name, len(vectors))
+        finally:
+            delete_benchmark_index(redis_conn, index_name)
+
+        rescored = [
+            sorted(f, key=lambda i: -float(vectors[i] @ qv))[:k]
+            for f, qv in zip(found, query_vectors)
+        ]
+
+        results[vector_type] = {
+            "recall_at_k": recall_at_k(expected, [f[:k] for f in found]),
+            "rescored_recall_at_k": recall_at_k(expected, rescored),
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "build_secs": build_secs,
+            **memory,
+        }
+        print(f"{vector_type}: {results[vector_type]}")
+
+    return results
+
+
+def get_index_sweep(m_values, ef_construction_values, ef_runtime_values):
+    sweep = [{"algorithm": "FLAT", "ef_runtime": None}]
+
+    for m in m_values:
+        for ef_construction in ef_construction_values:
+            for ef_runtime in ef_runtime_values:
+                sweep.append(
+                    {
+                        "algorithm": "HNSW",
+                        "m": m,
+                        "ef_construction": ef_construction,
+                        "ef_runtime": ef_runtime,
+                    }
+                )
+
+    return sweep
+
+
+def benchmark_index_params(texts, queries, sweep, k=NUM_TOP_MATCHES):
+    redis_conn = redis_helpers.get_new_conn()
+    vectors = np.array([deterministic_embedding(t) for t in texts])
+    query_vectors = np.array([deterministic_embedding(q) for q in queries])
+    expected = exact_top_k(vectors, query_vectors, k)
+
+    index_name = "bench_sweep"
+    built = None
+    results = []
+
+    try:
+        for params in sweep:
+            index_params = {p: v for p, v in params.items() if p != "ef_runtime"}
+
+            # ef_runtime is a query-time setting, so the index is only rebuilt
+            # when the build parameters change
+            if index_params != built:
+                build_secs = load_benchmark_index(
+                    redis_conn, vectors, texts, index_name, **index_params
+                )
+                memory = get_benchmark_memory_mb(redis_conn, index_name, len(vectors))
+                built = index_params
+
+            found, latencies = query_benchmark_index(
+                redis_conn,
+                index_name,
+                query_vectors,
+                k,
+                ef_runtime=params["ef_runtime"],
+            )
+
+            result = {
+                **params,
+                "recall_at_k": recall_at_k(expected, found),
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "build_secs": build_secs,
+                **memory,
+            }
+            results.append(result)
+            print(result)
+    finally:
+        delete_benchmark_index(redis_conn, index_name)
+
+    return results
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["embeddings", "quantization", "index"])
+    parser.add_argument("--csv", default=OLYMPICS_CSV)
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--num-queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=NUM_TOP_MATCHES)
+    parser.add_argument("--m", type=parse_int_list, default=[16, 40])
+    parser.add_argument("--ef-construction", type=parse_int_list, default=[100, 200])
+    parser.add_argument("--ef-runtime", type=parse_int_list, default=[10, 50, 200])
+    args = parser.parse_args()
+
+    texts = load_sample_texts(args.csv, args.limit)
+
+    if args.benchmark == "embeddings":
+        benchmark_embeddings(texts)
+    elif args.benchmark == "quantization":
+        queries = [t[:200] for t in texts[: args.num_queries]]
+        benchmark_quantization(texts, queries, args.k)
+    elif args.benchmark == "index":
+        queries = [t[:200] for t in texts[: args.num_queries]]
+        sweep = get_index_sweep(args.m, args.ef_construction, args.ef_runtime)
+        benchmark_index_params(texts, queries, sweep, args.k)
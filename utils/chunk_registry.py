@@ -0,0 +1,108 @@
+import logging
+
+from utils import (answer_cache, cogsearch_helpers, cosmos_helpers, dedup,
+                   local_vecstore, redis_helpers)
+from utils.cogvecsearch_helpers import cogsearch_vecstore
+from utils.env_vars import *
+
+
+def register_document_chunks(doc_id, chunk_ids, redis_conn=None):
+    if (REDIS_ADDR is not None) and (REDIS_ADDR != ""):
+        if redis_conn is None:
+            redis_conn = redis_helpers.get_new_conn()
+        redis_helpers.redis_register_chunks(redis_conn, doc_id, chunk_ids)
+
+    if DATABASE_MODE == 1:
+        cosmos_helpers.cosmos_store_chunk_registry(doc_id, chunk_ids)
+
+
+def get_document_chunks(doc_id, redis_conn=None):
+    chunk_ids = None
+
+    if (REDIS_ADDR is not None) and (REDIS_ADDR != ""):
+        if redis_conn is None:
+            redis_conn = redis_helpers.get_new_conn()
+        chunk_ids = redis_helpers.redis_get_chunk_ids(redis_conn, doc_id)
+
+    if (chunk_ids is None) and (DATABASE_MODE == 1):
+        chunk_ids = cosmos_helpers.cosmos_get_chunk_registry(doc_id)
+
+    if chunk_ids is None:
+        return set()
+
+    return chunk_ids
+
+
+def delete_chunks(chunk_ids, redis_conn=None):
+    chunk_ids = list(chunk_ids)
+    ret_dict = {"chunks": len(chunk_ids)}
+
+    if len(chunk_ids) == 0:
+        return ret_dict
+
+    if (REDIS_ADDR is not None) and (REDIS_ADDR != ""):
+        if redis_conn is None:
+            redis_conn = redis_helpers.get_new_conn()
+        ret_dict["redis"] = redis_helpers.redis_bulk_delete(redis_conn, chunk_ids)
+        ret_dict["orphaned_duplicates"] = len(
+            dedup.remove_signatures(chunk_ids, redis_conn)
+        )
+    else:
+        ret_dict["local"] = local_vecstore.get_local_vecstore().delete(chunk_ids)
+
+    if USE_COG_VECSEARCH == 1:
+        results = cogsearch_vecstore.CogSearchVecStore().delete_documents(ids=chunk_ids)
+    else:
+        results = cogsearch_helpers.delete_semantic_sections(chunk_ids)
+    ret_dict["cogsearch"] = len([r for r in results.values() if r == "ok"])
+
+    if DATABASE_MODE == 1:
+        results = cosmos_helpers.cosmos_delete_embeddings(chunk_ids)
+        ret_dict["cosmos"] = len([r for r in results.values() if r == "ok"])
+
+    return ret_dict
+
+
+def delete_document(doc_id, redis_conn=None):
+    chunk_ids = get_document_chunks(doc_id, redis_conn)
+    ret_dict = delete_chunks(chunk_ids, redis_conn)
+    register_document_chunks(doc_id, [], redis_conn)
+    answer_cache.bump_kb_version(redis_conn)
+
+    logging.info(f"Deleted document {doc_id}: {ret_dict}")
+    print(f"Deleted document {doc_id}: {ret_dict}")
+
+    return ret_dict
+
+
+def get_missing_chunks(chunk_ids, redis_conn=None):
+    if (REDIS_ADDR is not None) and (REDIS_ADDR != ""):
+        if redis_conn is None:
+            redis_conn = redis_helpers.get_new_conn()
+        return redis_helpers.redis_get_missing_keys(redis_conn, chunk_ids)
+
+    store = local_vecstore.get_local_vecstore()
+    return [c for c in chunk_ids if c not in store.rows]
+
+
+def replace_document_chunks(doc_id, new_chunk_ids, redis_conn=None):
+    # the old chunks are only purged once every new chunk is live, otherwise a
+    # failed ingestion would leave the document with nothing to retrieve
+    missing = get_missing_chunks(list(new_chunk_ids), redis_conn)
+    if len(missing) > 0:
+        raise Exception(
+            f"{len(missing)} of {len(new_chunk_ids)} chunks of document {doc_id} were not written, keeping the old chunks"
+        )
+
+    old_chunk_ids = get_document_chunks(doc_id, redis_conn)
+    stale_chunk_ids = old_chunk_ids - set(new_chunk_ids)
+
+    ret_dict = delete_chunks(stale_chunk_ids, redis_conn)
+    register_document_chunks(doc_id, list(new_chunk_ids), redis_conn)
+    # cached answers may quote the replaced chunks
+    answer_cache.bump_kb_version(redis_conn)
+
+    logging.info(f"Replaced chunks of document {doc_id}, removed stale: {ret_dict}")
+    print(f"Replaced chunks of document {doc_id}, removed stale: {ret_dict}")
+
+    return ret_dict
@@ -193,8 +193,23 @@ def create_index():
         print(f"Index creation exception:\n{ex}")
 
 
+def upload_semantic_sections_batch(batch):
+    results = sem_search_client.upload_documents(documents=batch)
+    return {r.key: "ok" if r.succeeded else r.error_message for r in results}
+
+
+def delete_semantic_sections_batch(batch):
+    results = sem_search_client.delete_documents(documents=batch)
+    return {r.key: "ok" if r.succeeded else r.error_message for r in results}
+
+
+def delete_semantic_sections(ids):
+    return cogsearch_vecstore.batch_upload_documents(
+        [{"id": i} for i in ids], delete_semantic_sections_batch
+    )
+
+
 def index_semantic_sections(sections):
-    i = 0
     batch = []
     for s in sections:
         dd = {
@@ -209,17 +224,10 @@ def index_semantic_sections(sections):
         }
 
         batch.append(dd)
-        i += 1
-        if i % 1000 == 0:
-            results = sem_search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-            batch = []
 
-    if len(batch) > 0:
-        results = sem_search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    return cogsearch_vecstore.batch_upload_documents(
+        batch, upload_semantic_sections_batch
+    )
 
 
 def create_skillset():
@@ -358,10 +366,10 @@ def process_filter(filter_param=None):
         return None
 
 
-def cog_vecsearch(terms: str, filter_param=None):
+def cog_vecsearch(terms: str, filter_param=None, ctx=None):
     proc_filter = process_filter(filter_param)
     vs = cogsearch_vecstore.CogSearchVecStore()
-    return vs.search(terms, search_type="vector", filter=proc_filter)
+    return vs.search(terms, search_type="vector", filter=proc_filter, ctx=ctx)
 
 
 def cog_search(terms: str, filter_param=None):
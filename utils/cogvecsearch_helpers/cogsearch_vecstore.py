@@ -4,12 +4,76 @@ import logging
 import os
 import re
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import utils.cogvecsearch_helpers.cs_json
-from utils import cv_helpers, helpers, http_helpers, kb_doc, openai_helpers
+from utils import (cv_helpers, helpers, http_helpers, kb_doc, openai_helpers,
+                   retrieval_context)
 from utils.env_vars import *
 
 
+def get_upload_batches(
+    docs,
+    max_batch_docs=COG_SEARCH_UPLOAD_BATCH_SIZE,
+    max_batch_bytes=COG_SEARCH_UPLOAD_MAX_BYTES,
+):
+    batch = []
+    batch_bytes = 0
+
+    for doc in docs:
+        doc_bytes = len(json.dumps(doc))
+
+        if (len(batch) > 0) and (
+            (len(batch) >= max_batch_docs)
+            or (batch_bytes + doc_bytes > max_batch_bytes)
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(doc)
+        batch_bytes += doc_bytes
+
+    if len(batch) > 0:
+        yield batch
+
+
+def batch_upload_documents(
+    docs,
+    upload_func,
+    key_field="id",
+    max_workers=COG_SEARCH_UPLOAD_WORKERS,
+    retry_rounds=COG_SEARCH_UPLOAD_RETRY_ROUNDS,
+):
+    def upload_batch(batch):
+        try:
+            return upload_func(batch)
+        except Exception as e:
+            print(f"Batch upload of {len(batch)} documents failed: {e}")
+            logging.error(f"Batch upload of {len(batch)} documents failed: {e}")
+            return {d[key_field]: str(e) for d in batch}
+
+    results = {}
+    pending = docs
+
+    for _ in range(retry_rounds):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch_results in executor.map(
+                upload_batch, get_upload_batches(pending)
+            ):
+                results.update(batch_results)
+
+        pending = [d for d in pending if results.get(d[key_field], "") != "ok"]
+        if len(pending) == 0:
+            break
+
+    succeeded = len([r for r in results.values() if r == "ok"])
+    print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    logging.info(f"Indexed {len(results)} sections, {succeeded} succeeded")
+
+    return results
+
+
 class CogSearchVecStore:
     def __init__(
         self,
@@ -25,6 +89,7 @@ class CogSearchVecStore:
         self.index_name = index_name
         self.all_fields = ["id", "text", "text_en", "categoryId"]
         self.search_types = ["vector", "hybrid", "semantic_hybrid"]
+        self.upload_results = {}
 
         self.addtl_fields = []
 
@@ -75,23 +140,25 @@ class CogSearchVecStore:
             doc_dict["@search.action"] = "upload"
             docs_dict["value"].append(doc_dict)
 
-        self.http_req.post(op="index", body=docs_dict)
+        self.upload_results = batch_upload_documents(
+            docs_dict["value"], self.post_index_batch
+        )
 
         return docs_dict
 
-    def delete_documents(self, op="index", ids=[]):
-        docs_dict = copy.deepcopy(utils.cogvecsearch_helpers.cs_json.upload_docs_json)
+    def post_index_batch(self, batch):
+        body = copy.deepcopy(utils.cogvecsearch_helpers.cs_json.upload_docs_json)
+        body["value"] = batch
+        response = self.http_req.post(op="index", body=body)
 
-        for i in ids:
-            doc_dict = copy.deepcopy(utils.cogvecsearch_helpers.cs_json.upload_doc_json)
-            doc_dict["id"] = i
-            doc_dict[VECTOR_FIELD_IN_REDIS] = [0] * openai_helpers.get_model_dims(
-                CHOSEN_EMB_MODEL
-            )
-            doc_dict["@search.action"] = "delete"
-            docs_dict["value"].append(doc_dict)
+        return {
+            r["key"]: "ok" if r["status"] else r.get("errorMessage", "failed")
+            for r in response["value"]
+        }
 
-        self.http_req.post(op="index", body=docs_dict)
+    def delete_documents(self, op="index", ids=[]):
+        docs = [{"@search.action": "delete", "id": i} for i in ids]
+        return batch_upload_documents(docs, self.post_index_batch)
 
     def get_search_json(self, query, search_type="vector"):
         if search_type == "vector":
@@ -110,15 +177,11 @@ class CogSearchVecStore:
             query_dict["search"] = query
         return query_dict
 
-    def get_vector_fields(self, query, query_dict, vector_name=None):
+    def get_vector_fields(self, query, query_dict, vector_name=None, ctx=None):
         if (vector_name is None) or (vector_name == VECTOR_FIELD_IN_REDIS):
-            completion_enc = openai_helpers.get_encoder(CHOSEN_COMP_MODEL)
-            embedding_enc = openai_helpers.get_encoder(CHOSEN_EMB_MODEL)
+            ctx = retrieval_context.get_retrieval_context(query, ctx)
             query_dict["vector"]["fields"] = VECTOR_FIELD_IN_REDIS
-            query = embedding_enc.decode(embedding_enc.encode(query)[:MAX_QUERY_TOKENS])
-            query_dict["vector"]["value"] = openai_helpers.get_openai_embedding(
-                query, CHOSEN_EMB_MODEL
-            )
+            query_dict["vector"]["value"] = ctx.get_embedding()
         elif vector_name == "cv_text_vector":
             cvr = cv_helpers.CV()
             query_dict["vector"]["fields"] = vector_name
@@ -140,6 +203,7 @@ class CogSearchVecStore:
         select=None,
         filter=None,
         verbose=False,
+        ctx=None,
     ):
         if search_type not in self.search_types:
             raise Exception(f"search_type must be one of {self.search_types}")
@@ -154,7 +218,7 @@ class CogSearchVecStore:
             query = query.replace(sas_url, "") + "\n" + res["text"]
 
         query_dict = self.get_search_json(query, search_type)
-        query_dict = self.get_vector_fields(query, query_dict, vector_name)
+        query_dict = self.get_vector_fields(query, query_dict, vector_name, ctx)
         query_dict["vector"]["k"] = NUM_TOP_MATCHES
         query_dict["filter"] = filter
         query_dict["select"] = ", ".join(self.all_fields) if select is None else select
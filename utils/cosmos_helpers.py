@@ -2,14 +2,18 @@ import copy
 import json
 import logging
 import os
+import random
 import re
+import threading
+import time
 import urllib
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import azure.functions as func
 import numpy as np
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
 
 from utils import redis_helpers
 from utils.env_vars import *
@@ -56,31 +60,317 @@ except:
     logging.error("Failed to initialize Cosmos DB container")
 
 
-def cosmos_restore_embeddings():
+RESTORE_CHECKPOINT_KEY = "cosmos_restore:continuation"
+RESTORE_PROGRESS_KEY = "cosmos_restore:progress"
+RESTORE_LOCK_KEY = "cosmos_restore:lock"
+
+
+def set_cosmos_restore_progress(redis_conn, **progress):
+    progress["updated"] = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
+    redis_conn.hset(RESTORE_PROGRESS_KEY, mapping=progress)
+
+
+def get_cosmos_restore_progress(redis_conn=None):
+    if redis_conn is None:
+        redis_conn = redis_helpers.get_new_conn()
+
+    progress = redis_conn.hgetall(RESTORE_PROGRESS_KEY)
+    return {k.decode("utf-8"): v.decode("utf-8") for k, v in progress.items()}
+
+
+def cosmos_restore_embeddings(
+    page_size=COSMOS_RESTORE_PAGE_SIZE,
+    max_workers=COSMOS_RESTORE_WORKERS,
+    resume=True,
+    lock_token=None,
+):
     QUERY = "SELECT * FROM documents p WHERE p.categoryId = @categoryId"
     params = [dict(name="@categoryId", value=EMBCATEGORYID)]
 
-    embeddings = container.query_items(
-        query=QUERY, parameters=params, enable_cross_partition_query=False
-    )
-
     redis_conn = redis_helpers.get_new_conn()
+
+    continuation_token = None
     counter = 0
+    pages = 0
+    if resume:
+        continuation_token = redis_conn.get(RESTORE_CHECKPOINT_KEY)
+        if continuation_token is not None:
+            continuation_token = continuation_token.decode("utf-8")
+            # the counts carry over so the progress covers the whole restore
+            progress = get_cosmos_restore_progress(redis_conn)
+            counter = int(progress.get("loaded", 0))
+            pages = int(progress.get("pages", 0))
+            print(f"Resuming Cosmos restore from the checkpoint after {pages} pages")
+            logging.info(
+                f"Resuming Cosmos restore from the checkpoint after {pages} pages"
+            )
+
+    pager = container.query_items(
+        query=QUERY,
+        parameters=params,
+        enable_cross_partition_query=False,
+        max_item_count=page_size,
+    ).by_page(continuation_token)
+
+    set_cosmos_restore_progress(
+        redis_conn, status="running", loaded=counter, pages=pages
+    )
 
     try:
-        for e in embeddings:
-            counter += redis_helpers.redis_upsert_embedding(redis_conn, e)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                futures = []
+
+                for page in pager:
+                    futures.append(
+                        executor.submit(
+                            redis_helpers.redis_bulk_upsert_embeddings,
+                            redis_conn,
+                            list(page),
+                            document_name="cosmos_restore",
+                        )
+                    )
+                    if len(futures) >= max_workers:
+                        break
+
+                if len(futures) == 0:
+                    break
+
+                results = [f.result() for f in futures]
+                counter += sum([r[0] for r in results])
+                failed_ids = [i for r in results for i in r[1]]
+
+                # the checkpoint only moves past pages that fully loaded, so a
+                # resumed restore picks the failed documents up again
+                if len(failed_ids) > 0:
+                    raise Exception(
+                        f"{len(failed_ids)} embeddings failed to load into Redis"
+                    )
+
+                pages += len(futures)
+
+                if pager.continuation_token is not None:
+                    redis_conn.set(RESTORE_CHECKPOINT_KEY, pager.continuation_token)
+                set_cosmos_restore_progress(
+                    redis_conn, status="running", loaded=counter, pages=pages
+                )
+                if lock_token is not None:
+                    redis_conn.set(
+                        RESTORE_LOCK_KEY,
+                        lock_token,
+                        xx=True,
+                        ex=COSMOS_RESTORE_LOCK_TTL_SECS,
+                    )
+
+                if pager.continuation_token is None:
+                    break
+
+        redis_conn.delete(RESTORE_CHECKPOINT_KEY)
+        set_cosmos_restore_progress(
+            redis_conn, status="done", loaded=counter, pages=pages
+        )
 
     except Exception as e:
-        print("No Documents found")
+        print(f"Cosmos restore stopped after {pages} pages: {e}")
+        logging.error(f"Cosmos restore stopped after {pages} pages: {e}")
+        set_cosmos_restore_progress(
+            redis_conn, status="failed", loaded=counter, pages=pages
+        )
 
     logging.info(f"Loaded {counter} embeddings from Cosmos into Redis")
     print(f"Loaded {counter} embeddings from Cosmos into Redis")
 
+    return counter
+
+
+def is_restore_interrupted(redis_conn):
+    # a restore that crashed or failed leaves its checkpoint or a status other
+    # than done behind, the next automatic restore resumes from the checkpoint
+    if redis_conn.exists(RESTORE_CHECKPOINT_KEY):
+        return True
+
+    status = get_cosmos_restore_progress(redis_conn).get("status", None)
+    return (status is not None) and (status != "done")
+
+
+def start_background_restore(redis_conn):
+    if DATABASE_MODE != 1:
+        return False
+
+    # only one worker across all instances restores, the others keep serving
+    lock_token = str(uuid.uuid4())
+    if not redis_conn.set(
+        RESTORE_LOCK_KEY, lock_token, nx=True, ex=COSMOS_RESTORE_LOCK_TTL_SECS
+    ):
+        return False
+
+    def run():
+        try:
+            cosmos_restore_embeddings(resume=True, lock_token=lock_token)
+        finally:
+            if redis_conn.get(RESTORE_LOCK_KEY) == lock_token.encode("utf-8"):
+                redis_conn.delete(RESTORE_LOCK_KEY)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    print("Started background restore of embeddings from Cosmos")
+    logging.info("Started background restore of embeddings from Cosmos")
+
+    return True
+
+
+def get_index_readiness(redis_conn):
+    if redis_conn.exists(RESTORE_LOCK_KEY):
+        return "restoring"
 
-def cosmos_backup_embeddings(emb_documents):
+    # a partially restored index has vectors, but is only ready once the
+    # interrupted restore has been resumed and finished
+    interrupted = is_restore_interrupted(redis_conn)
+    if (not interrupted) and redis_helpers.redis_index_has_vectors(redis_conn):
+        return "ready"
+
+    if start_background_restore(redis_conn):
+        return "restoring"
+
+    # either Cosmos is not configured or another worker just took the lock
+    if redis_conn.exists(RESTORE_LOCK_KEY):
+        return "restoring"
+    if interrupted and redis_helpers.redis_index_has_vectors(redis_conn):
+        return "ready"
+    return "empty"
+
+
+readiness_checked_at = {}
+readiness_checked_lock = threading.Lock()
+
+
+def check_index_readiness(redis_conn):
+    # queries that found results only look for an interrupted restore once per
+    # interval, a ready index stays ready until then
+    now = time.time()
+    with readiness_checked_lock:
+        checked_at = readiness_checked_at.get(redis_conn, None)
+        if (checked_at is not None) and (now - checked_at < REDIS_INDEX_CHECK_SECS):
+            return "ready"
+
+    readiness = get_index_readiness(redis_conn)
+    if readiness == "ready":
+        with readiness_checked_lock:
+            readiness_checked_at[redis_conn] = now
+
+    return readiness
+
+
+class CosmosThrottle:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+
+    def wait(self):
+        with self.lock:
+            delay = self.paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def back_off(self, secs):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + secs)
+
+
+def cosmos_upsert_with_throttling(
+    item, throttle, max_attempts=COSMOS_BULK_MAX_ATTEMPTS
+):
+    for attempt in range(max_attempts):
+        throttle.wait()
+
+        try:
+            container.upsert_item(item)
+            return "ok"
+        except exceptions.CosmosHttpResponseError as e:
+            if (e.status_code != 429) or (attempt == max_attempts - 1):
+                return str(e)
+
+            retry_after_ms = e.headers.get("x-ms-retry-after-ms", None)
+            if retry_after_ms is not None:
+                secs = float(retry_after_ms) / 1000
+            else:
+                secs = min(2**attempt * 0.1, 10) * (1 + random.random())
+            throttle.back_off(secs)
+        except Exception as e:
+            return str(e)
+
+
+def cosmos_bulk_backup_embeddings(emb_documents, max_workers=COSMOS_BULK_WORKERS):
+    throttle = CosmosThrottle()
+    items = {}
+
+    for e in emb_documents:
+        e["categoryId"] = EMBCATEGORYID
+        items[e["id"]] = e
+
+    results = {}
+    pending = list(items.keys())
+    start = time.time()
+
+    for _ in range(COSMOS_BULK_RETRY_ROUNDS):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            statuses = executor.map(
+                lambda i: cosmos_upsert_with_throttling(items[i], throttle), pending
+            )
+            for i, status in zip(pending, statuses):
+                results[i] = status
+
+        pending = [i for i in pending if results[i] != "ok"]
+        if len(pending) == 0:
+            break
+
+    secs = time.time() - start
+    succeeded = len(items) - len(pending)
+    print(
+        f"Bulk upserted {succeeded} of {len(items)} embedding documents into Cosmos in {secs:.2f} secs"
+    )
+    logging.info(
+        f"Bulk upserted {succeeded} of {len(items)} embedding documents into Cosmos in {secs:.2f} secs"
+    )
+
+    return results
+
+
+def cosmos_get_embeddings(ids, max_workers=COSMOS_BULK_WORKERS):
+    def read(item_id):
+        try:
+            item = container.read_item(item=item_id, partition_key=EMBCATEGORYID)
+            return item_id, item.get(VECTOR_FIELD_IN_REDIS, None)
+        except exceptions.CosmosResourceNotFoundError:
+            return item_id, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(read, ids))
+
+    return {i: v for i, v in results if v is not None}
+
+
+def cosmos_backup_embeddings(emb_documents, bulk=True):
     ret_dict = {}
 
+    if bulk:
+        results = cosmos_bulk_backup_embeddings(emb_documents)
+        failed_ids = [i for i, r in results.items() if r != "ok"]
+
+        ret_dict["results"] = results
+        ret_dict["failed_ids"] = failed_ids
+
+        if len(failed_ids) == 0:
+            ret_dict[
+                "status"
+            ] = f"Successfully loaded {len(results)} embedding documents into Cosmos"
+        else:
+            ret_dict[
+                "status"
+            ] = f"Failed loading {len(failed_ids)} of {len(results)} embeddings into Cosmos"
+
+        return ret_dict
+
     try:
         for e in emb_documents:
             # e[VECTOR_FIELD_IN_REDIS] = np.array(e[VECTOR_FIELD_IN_REDIS]).astype(np.float32).tobytes()
@@ -101,6 +391,69 @@ def cosmos_backup_embeddings(emb_documents):
     return ret_dict
 
 
+def cosmos_delete_with_throttling(
+    item_id, throttle, max_attempts=COSMOS_BULK_MAX_ATTEMPTS
+):
+    for attempt in range(max_attempts):
+        throttle.wait()
+
+        try:
+            container.delete_item(item=item_id, partition_key=EMBCATEGORYID)
+            return "ok"
+        except exceptions.CosmosResourceNotFoundError:
+            return "ok"
+        except exceptions.CosmosHttpResponseError as e:
+            if (e.status_code != 429) or (attempt == max_attempts - 1):
+                return str(e)
+
+            retry_after_ms = e.headers.get("x-ms-retry-after-ms", None)
+            if retry_after_ms is not None:
+                secs = float(retry_after_ms) / 1000
+            else:
+                secs = min(2**attempt * 0.1, 10) * (1 + random.random())
+            throttle.back_off(secs)
+        except Exception as e:
+            return str(e)
+
+
+def cosmos_delete_embeddings(ids, max_workers=COSMOS_BULK_WORKERS):
+    throttle = CosmosThrottle()
+    ids = list(ids)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = executor.map(
+            lambda i: cosmos_delete_with_throttling(i, throttle), ids
+        )
+        results = dict(zip(ids, statuses))
+
+    failed = len([r for r in results.values() if r != "ok"])
+    logging.info(f"Deleted {len(ids) - failed} of {len(ids)} embeddings from Cosmos")
+    print(f"Deleted {len(ids) - failed} of {len(ids)} embeddings from Cosmos")
+
+    return results
+
+
+def cosmos_store_chunk_registry(doc_id, chunk_ids):
+    container.upsert_item(
+        {
+            "id": f"{CHUNKREGCATEGORYID}_{doc_id}",
+            "categoryId": CHUNKREGCATEGORYID,
+            "doc_id": doc_id,
+            "chunk_ids": list(chunk_ids),
+        }
+    )
+
+
+def cosmos_get_chunk_registry(doc_id):
+    try:
+        item = container.read_item(
+            item=f"{CHUNKREGCATEGORYID}_{doc_id}", partition_key=CHUNKREGCATEGORYID
+        )
+        return set(item["chunk_ids"])
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+
+
 def cosmos_store_contents(data_dict):
     ret_dict = {}
 
@@ -0,0 +1,241 @@
+import hashlib
+import logging
+import re
+import threading
+
+from utils import openai_helpers, redis_helpers
+from utils.env_vars import *
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+SIMHASH_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+
+DEDUP_SIG_KEY = "dedup:sig"
+DEDUP_BAND_PREFIX = "dedup:band:"
+DEDUP_LINKS_KEY = "dedup:links"
+DEDUP_LINKED_PREFIX = "dedup:linked:"
+
+word_regex = re.compile(r"\w+", re.UNICODE)
+
+
+def get_shingles(text, n=3):
+    words = word_regex.findall(text.lower())
+    if len(words) < n:
+        return [" ".join(words)]
+    return [" ".join(words[i : i + n]) for i in range(len(words) - n + 1)]
+
+
+def simhash(text):
+    weights = [0] * SIMHASH_BITS
+
+    for shingle in get_shingles(text):
+        h = int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        for i in range(SIMHASH_BITS):
+            weights[i] += 1 if (h >> i) & 1 else -1
+
+    return sum([1 << i for i in range(SIMHASH_BITS) if weights[i] > 0])
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def get_bands(sig):
+    mask = (1 << SIMHASH_BAND_BITS) - 1
+    return [(sig >> (b * SIMHASH_BAND_BITS)) & mask for b in range(SIMHASH_BANDS)]
+
+
+class SignatureIndex:
+    def __init__(self, redis_conn=None, max_distance=DEDUP_MAX_HAMMING_DISTANCE):
+        # with a Redis connection the index persists across documents and
+        # workers, without one it only lives as long as the caller keeps it
+        self.redis_conn = redis_conn
+        self.max_distance = max_distance
+        self.sigs = {}
+        self.bands = {}
+        self.lock = threading.Lock()
+
+    def band_key(self, namespace, b, value):
+        return f"{DEDUP_BAND_PREFIX}{namespace}:{b}:{value}"
+
+    def get_band_keys(self, namespace, sig):
+        return [self.band_key(namespace, b, v) for b, v in enumerate(get_bands(sig))]
+
+    def get_candidates(self, namespace, sig):
+        band_keys = self.get_band_keys(namespace, sig)
+
+        if self.redis_conn is None:
+            with self.lock:
+                candidates = set()
+                for k in band_keys:
+                    candidates |= self.bands.get(k, set())
+                return {c: self.sigs[c] for c in candidates}
+
+        candidates = [c.decode("utf-8") for c in self.redis_conn.sunion(band_keys)]
+        if len(candidates) == 0:
+            return {}
+
+        sigs = self.redis_conn.hmget(DEDUP_SIG_KEY, candidates)
+        return {c: int(s) for c, s in zip(candidates, sigs) if s is not None}
+
+    def find_duplicate(self, namespace, sig, exclude_doc_id=None):
+        # signatures within the distance share at least one band when
+        # max_distance < SIMHASH_BANDS
+        for chunk_id, candidate_sig in self.get_candidates(namespace, sig).items():
+            if get_document_id(chunk_id) == exclude_doc_id:
+                continue
+            if hamming_distance(sig, candidate_sig) <= self.max_distance:
+                return chunk_id
+
+        return None
+
+    def add(self, namespace, chunk_id, sig):
+        band_keys = self.get_band_keys(namespace, sig)
+
+        if self.redis_conn is None:
+            with self.lock:
+                self.sigs[chunk_id] = sig
+                for k in band_keys:
+                    self.bands.setdefault(k, set()).add(chunk_id)
+            return
+
+        # a chunk that used to be a duplicate is canonical from now on
+        canonical_id = self.redis_conn.hget(DEDUP_LINKS_KEY, chunk_id)
+
+        p = self.redis_conn.pipeline(transaction=False)
+        if canonical_id is not None:
+            p.srem(DEDUP_LINKED_PREFIX + canonical_id.decode("utf-8"), chunk_id)
+            p.hdel(DEDUP_LINKS_KEY, chunk_id)
+        p.hset(DEDUP_SIG_KEY, chunk_id, str(sig))
+        for k in band_keys:
+            p.sadd(k, chunk_id)
+        p.execute()
+
+    def link(self, chunk_id, canonical_id):
+        if self.redis_conn is None:
+            return
+
+        p = self.redis_conn.pipeline(transaction=False)
+        p.hset(DEDUP_LINKS_KEY, chunk_id, canonical_id)
+        p.sadd(DEDUP_LINKED_PREFIX + canonical_id, chunk_id)
+        p.execute()
+
+    def remove(self, chunk_ids):
+        chunk_ids = list(chunk_ids)
+        if (self.redis_conn is None) or (len(chunk_ids) == 0):
+            return []
+
+        sigs = self.redis_conn.hmget(DEDUP_SIG_KEY, chunk_ids)
+        canonical_ids = self.redis_conn.hmget(DEDUP_LINKS_KEY, chunk_ids)
+        orphans = set()
+        for c in chunk_ids:
+            orphans |= self.redis_conn.smembers(DEDUP_LINKED_PREFIX + c)
+
+        p = self.redis_conn.pipeline(transaction=False)
+        for c, s, canonical_id in zip(chunk_ids, sigs, canonical_ids):
+            if s is not None:
+                for k in self.get_band_keys(get_namespace(c), int(s)):
+                    p.srem(k, c)
+            if canonical_id is not None:
+                p.srem(DEDUP_LINKED_PREFIX + canonical_id.decode("utf-8"), c)
+            p.delete(DEDUP_LINKED_PREFIX + c)
+        p.hdel(DEDUP_SIG_KEY, *chunk_ids)
+        p.hdel(DEDUP_LINKS_KEY, *chunk_ids)
+        p.execute()
+
+        # duplicates of a removed chunk were never indexed, their documents lost
+        # that content and have to be ingested again
+        orphans = [o.decode("utf-8") for o in orphans]
+        orphans = [o for o in orphans if o not in chunk_ids]
+        if len(orphans) > 0:
+            self.redis_conn.hdel(DEDUP_LINKS_KEY, *orphans)
+        return orphans
+
+
+def get_namespace(chunk_id):
+    # chunk ids look like {doc_id}_{text_suffix}_{n}
+    parts = chunk_id.rsplit("_", 2)
+    return parts[1] if len(parts) == 3 else ""
+
+
+def get_document_id(chunk_id):
+    return chunk_id.rsplit("_", 2)[0]
+
+
+def get_signature_index(redis_conn=None):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return SignatureIndex()
+
+    if redis_conn is None:
+        redis_conn = redis_helpers.get_new_conn()
+    return SignatureIndex(redis_conn)
+
+
+def filter_duplicate_chunks(
+    doc_id, chunks, embedding_model=CHOSEN_EMB_MODEL, redis_conn=None
+):
+    if USE_DEDUP != 1:
+        return chunks
+
+    # a chunk that nearly duplicates a chunk of another document, e.g. the same
+    # brochure page or a shared page footer, is linked to it instead of being
+    # embedded again; the previous version of this document never counts
+    index = get_signature_index(redis_conn)
+    doc_index = SignatureIndex()
+    unique_chunks = []
+    skipped = 0
+    bytes_saved = 0
+    vector_bytes = openai_helpers.get_model_dims(embedding_model) * 4
+
+    for c in chunks:
+        chunk_id, translated_chunk = c[0], c[2]
+        namespace = get_namespace(chunk_id)
+        sig = simhash(translated_chunk)
+
+        duplicate_of = doc_index.find_duplicate(namespace, sig)
+        if duplicate_of is None:
+            duplicate_of = index.find_duplicate(namespace, sig, doc_id)
+            # the canonical chunk may have been added by an ingestion that failed
+            if (duplicate_of is not None) and (index.redis_conn is not None):
+                missing = redis_helpers.redis_get_missing_keys(
+                    index.redis_conn, [duplicate_of]
+                )
+                if len(missing) > 0:
+                    duplicate_of = None
+
+        if duplicate_of is None:
+            doc_index.add(namespace, chunk_id, sig)
+            index.add(namespace, chunk_id, sig)
+            unique_chunks.append(c)
+        else:
+            index.link(chunk_id, duplicate_of)
+            skipped += 1
+            bytes_saved += vector_bytes + len(translated_chunk.encode("utf-8"))
+
+    logging.info(
+        f"Near-duplicate detection for {doc_id}: skipped {skipped} of {len(chunks)} embeddings, saved ~{bytes_saved} bytes of index memory"
+    )
+    print(
+        f"Near-duplicate detection for {doc_id}: skipped {skipped} of {len(chunks)} embeddings, saved ~{bytes_saved} bytes of index memory"
+    )
+
+    return unique_chunks
+
+
+def remove_signatures(chunk_ids, redis_conn=None):
+    if (USE_DEDUP != 1) or (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return []
+
+    orphans = get_signature_index(redis_conn).remove(chunk_ids)
+    if len(orphans) > 0:
+        doc_ids = sorted(set([get_document_id(o) for o in orphans]))
+        logging.warning(
+            f"Deleted chunks were the canonical copy of {len(orphans)} near-duplicates, re-ingest documents {doc_ids} to index them"
+        )
+        print(
+            f"Deleted chunks were the canonical copy of {len(orphans)} near-duplicates, re-ingest documents {doc_ids} to index them"
+        )
+
+    return orphans
@@ -0,0 +1,439 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils import openai_helpers, redis_helpers
+from utils.env_vars import *
+
+EMB_CACHE_PREFIX = "emb_cache:"
+QUERY_EMB_CACHE_PREFIX = "query_emb:"
+
+
+def get_cache_key(text, embedding_model):
+    return hashlib.sha256(f"{embedding_model}\n{text}".encode("utf-8")).hexdigest()
+
+
+class MmapEmbeddingStore:
+    def __init__(self, cache_dir, embedding_model, capacity, dims):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.capacity = capacity
+        self.vectors_file = os.path.join(cache_dir, f"{embedding_model}.npy")
+        self.index_file = os.path.join(cache_dir, f"{embedding_model}.json")
+        # every worker process on the host shares the files, slots are only
+        # assigned under this lock and against the latest index on disk
+        self.lock_file = open(os.path.join(cache_dir, f"{embedding_model}.lock"), "a")
+        self.slots = OrderedDict()
+        self.free_slots = []
+        self.index_version = None
+        self.pending = OrderedDict()
+
+        with self.locked(fcntl.LOCK_EX):
+            if os.path.exists(self.vectors_file) and os.path.exists(self.index_file):
+                self.vectors = np.lib.format.open_memmap(self.vectors_file, mode="r+")
+            else:
+                self.vectors = None
+
+            if (self.vectors is None) or (self.vectors.shape != (capacity, dims)):
+                self.vectors = np.lib.format.open_memmap(
+                    self.vectors_file,
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(capacity, dims),
+                )
+                self.write_index()
+
+            self.index_version = None
+            self.reload()
+
+    @contextmanager
+    def locked(self, operation):
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def get_index_version(self):
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        # the index is replaced on every write, so a new inode means a new index
+        return (st.st_ino, st.st_mtime_ns)
+
+    def reload(self):
+        version = self.get_index_version()
+        if (version is None) or (version == self.index_version):
+            return
+
+        with open(self.index_file, "r") as f:
+            self.slots = OrderedDict(json.load(f))
+        self.free_slots = sorted(set(range(self.capacity)) - set(self.slots.values()))
+        self.index_version = version
+
+    def write_index(self):
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(list(self.slots.items()), f)
+        os.replace(tmp_file, self.index_file)
+        self.index_version = self.get_index_version()
+
+    def get(self, key):
+        if key in self.pending:
+            return list(self.pending[key])
+
+        with self.locked(fcntl.LOCK_SH):
+            self.reload()
+            slot = self.slots.get(key, None)
+            if slot is None:
+                return None
+
+            self.slots.move_to_end(key)
+            return self.vectors[slot].tolist()
+
+    def set(self, key, embedding):
+        self.pending[key] = embedding
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        with self.locked(fcntl.LOCK_EX):
+            self.reload()
+
+            for key, embedding in self.pending.items():
+                if key in self.slots:
+                    slot = self.slots[key]
+                    self.slots.move_to_end(key)
+                elif len(self.free_slots) > 0:
+                    slot = self.free_slots.pop()
+                else:
+                    _, slot = self.slots.popitem(last=False)
+
+                self.vectors[slot] = np.array(embedding, dtype=np.float32)
+                self.slots[key] = slot
+
+            self.vectors.flush()
+            self.write_index()
+
+        self.pending = OrderedDict()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        embedding_model=CHOSEN_EMB_MODEL,
+        cache_dir=EMB_CACHE_DIR,
+        capacity=EMB_CACHE_CAPACITY,
+        redis_conn=None,
+        redis_ttl=EMB_CACHE_REDIS_TTL_SECS,
+    ):
+        self.embedding_model = embedding_model
+        self.local = MmapEmbeddingStore(
+            cache_dir,
+            embedding_model,
+            capacity,
+            openai_helpers.get_model_dims(embedding_model),
+        )
+        self.redis_conn = redis_conn
+        self.redis_ttl = redis_ttl
+        self.lock = threading.Lock()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    def get_many(self, texts):
+        keys = [get_cache_key(t, self.embedding_model) for t in texts]
+        embeddings = [None] * len(texts)
+
+        with self.lock:
+            for i, k in enumerate(keys):
+                embeddings[i] = self.local.get(k)
+                if embeddings[i] is not None:
+                    self.stats["local_hits"] += 1
+
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+
+        if (self.redis_conn is not None) and (len(missing) > 0):
+            try:
+                p = self.redis_conn.pipeline(transaction=False)
+                for i in missing:
+                    p.get(EMB_CACHE_PREFIX + keys[i])
+                values = p.execute()
+            except Exception as e:
+                logging.warning(f"Embedding cache Redis lookup failed: {e}")
+                values = [None] * len(missing)
+
+            with self.lock:
+                for i, v in zip(missing, values):
+                    if v is not None:
+                        embeddings[i] = np.frombuffer(v, dtype=np.float32).tolist()
+                        self.local.set(keys[i], embeddings[i])
+                        self.stats["redis_hits"] += 1
+                self.local.flush()
+
+        with self.lock:
+            self.stats["misses"] += sum([1 for e in embeddings if e is None])
+
+        return embeddings
+
+    def set_many(self, texts, embeddings):
+        keys = [get_cache_key(t, self.embedding_model) for t in texts]
+
+        with self.lock:
+            for k, e in zip(keys, embeddings):
+                self.local.set(k, e)
+            self.local.flush()
+
+        if self.redis_conn is not None:
+            try:
+                p = self.redis_conn.pipeline(transaction=False)
+                for k, e in zip(keys, embeddings):
+                    p.set(
+                        EMB_CACHE_PREFIX + k,
+                        np.array(e, dtype=np.float32).tobytes(),
+                        ex=self.redis_ttl,
+                    )
+                p.execute()
+            except Exception as e:
+                logging.warning(f"Embedding cache Redis write failed: {e}")
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+
+        total = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["local_hits"] + stats["redis_hits"]) / total if total > 0 else 0.0
+        )
+        return stats
+
+
+emb_caches = {}
+emb_caches_lock = threading.Lock()
+
+
+def get_emb_cache(embedding_model=CHOSEN_EMB_MODEL):
+    with emb_caches_lock:
+        cache = emb_caches.get(embedding_model, None)
+    if cache is not None:
+        return cache
+
+    # a compact index is there to save Redis memory, so the float32 copies are
+    # only cached on local disk then
+    redis_conn = (
+        redis_helpers.get_new_conn() if REDIS_VECTOR_TYPE == "FLOAT32" else None
+    )
+
+    with emb_caches_lock:
+        if embedding_model not in emb_caches:
+            emb_caches[embedding_model] = EmbeddingCache(
+                embedding_model, redis_conn=redis_conn
+            )
+
+        return emb_caches[embedding_model]
+
+
+def get_cached_openai_embeddings(texts, embedding_model=CHOSEN_EMB_MODEL, batch=True):
+    if USE_EMB_CACHE != 1:
+        cache = None
+        embeddings = [None] * len(texts)
+    else:
+        cache = get_emb_cache(embedding_model)
+        embeddings = cache.get_many(texts)
+
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    missing_texts = [texts[i] for i in missing]
+
+    if len(missing_texts) > 0:
+        if batch:
+            new_embeddings = openai_helpers.get_openai_embeddings(
+                missing_texts, embedding_model
+            )
+        else:
+            new_embeddings = [
+                openai_helpers.get_openai_embedding(t, embedding_model)
+                for t in missing_texts
+            ]
+
+        for i, e in zip(missing, new_embeddings):
+            embeddings[i] = e
+
+        if cache is not None:
+            cache.set_many(missing_texts, new_embeddings)
+
+    if cache is not None:
+        logging.info(f"Embedding cache stats: {cache.get_stats()}")
+
+    return embeddings
+
+
+def get_emb_cache_stats():
+    with emb_caches_lock:
+        return {m: c.get_stats() for m, c in emb_caches.items()}
+
+
+rescore_store = None
+rescore_store_lock = threading.Lock()
+
+
+def get_rescore_store(embedding_model=CHOSEN_EMB_MODEL):
+    global rescore_store
+
+    with rescore_store_lock:
+        if rescore_store is None:
+            rescore_store = MmapEmbeddingStore(
+                RESCORE_STORE_DIR,
+                embedding_model,
+                RESCORE_STORE_CAPACITY,
+                openai_helpers.get_model_dims(embedding_model),
+            )
+
+    return rescore_store
+
+
+def store_rescore_vectors(emb_documents):
+    # the full-precision copies stay out of Redis, it only holds the compact index
+    if REDIS_VECTOR_TYPE == "FLOAT32":
+        return
+
+    store = get_rescore_store()
+    with rescore_store_lock:
+        for e in emb_documents:
+            if e.get(VECTOR_FIELD_IN_REDIS, None) is not None:
+                store.set(e["id"], e[VECTOR_FIELD_IN_REDIS])
+        store.flush()
+
+
+def get_rescore_vectors(ids):
+    store = get_rescore_store()
+    with rescore_store_lock:
+        vectors = {i: store.get(i) for i in ids}
+
+    missing = [i for i, v in vectors.items() if v is None]
+
+    # another instance ingested these chunks, Cosmos keeps the original vectors
+    if (len(missing) > 0) and (DATABASE_MODE == 1):
+        from utils import cosmos_helpers
+
+        found = cosmos_helpers.cosmos_get_embeddings(missing)
+        with rescore_store_lock:
+            for i, v in found.items():
+                store.set(i, v)
+                vectors[i] = v
+            store.flush()
+
+    return vectors
+
+
+def rescore_results(results, query_emb, topK, embedding_model=CHOSEN_EMB_MODEL):
+    if len(results) == 0:
+        return results
+
+    vectors = get_rescore_vectors([r["id"] for r in results])
+    query_vector = np.array(query_emb, dtype=np.float32)
+    query_vector /= np.linalg.norm(query_vector)
+
+    missing = 0
+    for r in results:
+        v = vectors.get(r["id"], None)
+        if v is None:
+            missing += 1
+            continue
+        v = np.array(v, dtype=np.float32)
+        r["vector_score"] = str(1 - float(np.dot(query_vector, v) / np.linalg.norm(v)))
+
+    if missing > 0:
+        logging.warning(
+            f"No full-precision vector for {missing} of {len(results)} results, kept their compact scores"
+        )
+
+    return sorted(results, key=lambda r: float(r["vector_score"]))[:topK]
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+
+class QueryEmbeddingCache:
+    def __init__(
+        self,
+        capacity=QUERY_EMB_CACHE_CAPACITY,
+        redis_conn=None,
+        redis_ttl=QUERY_EMB_CACHE_TTL_SECS,
+    ):
+        self.capacity = capacity
+        self.redis_conn = redis_conn
+        self.redis_ttl = redis_ttl
+        self.embeddings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.embeddings:
+                self.embeddings.move_to_end(key)
+                return self.embeddings[key]
+
+        if self.redis_conn is None:
+            return None
+
+        try:
+            v = self.redis_conn.get(QUERY_EMB_CACHE_PREFIX + key)
+        except Exception as e:
+            logging.warning(f"Query embedding cache Redis lookup failed: {e}")
+            return None
+
+        if v is None:
+            return None
+
+        embedding = np.frombuffer(v, dtype=np.float32).tolist()
+        self.set_local(key, embedding)
+        return embedding
+
+    def set_local(self, key, embedding):
+        with self.lock:
+            self.embeddings[key] = embedding
+            self.embeddings.move_to_end(key)
+            if len(self.embeddings) > self.capacity:
+                self.embeddings.popitem(last=False)
+
+    def set(self, key, embedding):
+        self.set_local(key, embedding)
+
+        if self.redis_conn is not None:
+            try:
+                self.redis_conn.set(
+                    QUERY_EMB_CACHE_PREFIX + key,
+                    np.array(embedding, dtype=np.float32).tobytes(),
+                    ex=self.redis_ttl,
+                )
+            except Exception as e:
+                logging.warning(f"Query embedding cache Redis write failed: {e}")
+
+
+query_emb_cache = None
+
+
+def get_query_embedding(query, embedding_model=CHOSEN_EMB_MODEL):
+    global query_emb_cache
+
+    # connecting to Redis is I/O, it happens outside the lock every caller takes
+    if query_emb_cache is None:
+        redis_conn = redis_helpers.get_new_conn()
+        with emb_caches_lock:
+            if query_emb_cache is None:
+                query_emb_cache = QueryEmbeddingCache(redis_conn=redis_conn)
+
+    key = get_cache_key(normalize_query(query), embedding_model)
+    embedding = query_emb_cache.get(key)
+
+    if embedding is None:
+        embedding = openai_helpers.get_openai_embedding(query, embedding_model)
+        query_emb_cache.set(key, embedding)
+
+    return embedding
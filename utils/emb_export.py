@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.env_vars import *
+from utils.kb_doc import KB_Doc
+
+VECTORS_FILENAME = "vectors.f32"
+METADATA_FILENAME = "metadata.parquet"
+EXTRA_FIELDS_COLUMN = "extra_fields"
+
+
+def get_export_files(path):
+    return os.path.join(path, VECTORS_FILENAME), os.path.join(path, METADATA_FILENAME)
+
+
+def get_metadata_schema(dims):
+    # the schema comes from KB_Doc so every batch writes the same columns, keys
+    # the documents carry beyond it are kept as JSON in a single column
+    fields = []
+    for k, v in KB_Doc().get_dict().items():
+        if k == VECTOR_FIELD_IN_REDIS:
+            continue
+        field_type = pa.list_(pa.float32()) if isinstance(v, list) else pa.string()
+        fields.append(pa.field(k, field_type))
+    fields.append(pa.field(EXTRA_FIELDS_COLUMN, pa.string()))
+
+    return pa.schema(fields).with_metadata(
+        {"vector_field": VECTOR_FIELD_IN_REDIS, "dims": str(dims)}
+    )
+
+
+def get_metadata_row(e, schema):
+    row = {}
+    extra_fields = {}
+
+    for k, v in e.items():
+        # a missing column is written as a Parquet null, not as the string "None"
+        if (k == VECTOR_FIELD_IN_REDIS) or (v is None):
+            continue
+        if k not in schema.names:
+            extra_fields[k] = v
+        elif pa.types.is_list(schema.field(k).type):
+            # KB_Doc gives every text chunk zero cv vectors, there is no need to keep them
+            if any(v):
+                row[k] = v
+        else:
+            row[k] = str(v)
+
+    if len(extra_fields) > 0:
+        row[EXTRA_FIELDS_COLUMN] = json.dumps(extra_fields, default=str)
+
+    return row
+
+
+def export_embedding_docs(emb_documents, path, batch_size=EMB_EXPORT_BATCH_SIZE):
+    os.makedirs(path, exist_ok=True)
+    vectors_file, metadata_file = get_export_files(path)
+
+    writer = None
+    exported = 0
+    batch = []
+    start = time.time()
+
+    def flush(batch):
+        nonlocal writer
+
+        vectors = np.array([e[VECTOR_FIELD_IN_REDIS] for e in batch], dtype=np.float32)
+        vf.write(vectors.tobytes())
+
+        if writer is None:
+            writer = pq.ParquetWriter(
+                metadata_file, get_metadata_schema(vectors.shape[1])
+            )
+        rows = [get_metadata_row(e, writer.schema) for e in batch]
+        writer.write_table(pa.Table.from_pylist(rows, schema=writer.schema))
+
+        return len(batch)
+
+    with open(vectors_file, "wb") as vf:
+        for e in emb_documents:
+            batch.append(e)
+            if len(batch) >= batch_size:
+                exported += flush(batch)
+                batch = []
+
+        if len(batch) > 0:
+            exported += flush(batch)
+
+    if writer is not None:
+        writer.close()
+
+    logging.info(
+        f"Exported {exported} embeddings to {path} in {time.time() - start:.2f} secs"
+    )
+    print(f"Exported {exported} embeddings to {path} in {time.time() - start:.2f} secs")
+
+    return exported
+
+
+def iter_embedding_doc_batches(path, batch_size=EMB_EXPORT_BATCH_SIZE):
+    vectors_file, metadata_file = get_export_files(path)
+
+    metadata = pq.ParquetFile(metadata_file)
+    schema_metadata = metadata.schema_arrow.metadata
+    vector_field = schema_metadata[b"vector_field"].decode("utf-8")
+    dims = int(schema_metadata[b"dims"])
+
+    vectors = np.memmap(vectors_file, dtype=np.float32, mode="r").reshape(-1, dims)
+    offset = 0
+
+    for record_batch in metadata.iter_batches(batch_size=batch_size):
+        rows = record_batch.to_pylist()
+        batch_vectors = np.array(vectors[offset : offset + len(rows)])
+        offset += len(rows)
+
+        for row, v in zip(rows, batch_vectors):
+            row[vector_field] = v
+            extra_fields = row.pop(EXTRA_FIELDS_COLUMN, None)
+            if extra_fields is not None:
+                row.update(json.loads(extra_fields))
+
+        yield [{k: v for k, v in row.items() if v is not None} for row in rows]
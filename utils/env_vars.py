@@ -18,6 +18,10 @@ SMALL_EMB_TOKEN_NUM = int(os.environ.get("SMALL_EMB_TOKEN_NUM", "750"))
 MEDIUM_EMB_TOKEN_NUM = int(os.environ.get("MEDIUM_EMB_TOKEN_NUM", "0"))
 LARGE_EMB_TOKEN_NUM = int(os.environ.get("LARGE_EMB_TOKEN_NUM", "0"))
 X_LARGE_EMB_TOKEN_NUM = int(os.environ.get("X_LARGE_EMB_TOKEN_NUM", "0"))
+EMB_BATCH_SIZE = int(os.environ.get("EMB_BATCH_SIZE", "16"))
+EMB_BATCH_MAX_TOKENS = int(os.environ.get("EMB_BATCH_MAX_TOKENS", "32000"))
+INGESTION_BATCH_SIZE = int(os.environ.get("INGESTION_BATCH_SIZE", "64"))
+INGESTION_QUEUE_SIZE = int(os.environ.get("INGESTION_QUEUE_SIZE", "4"))
 
 USE_BING = os.environ.get("USE_BING", "no")
 LIST_OF_COMMA_SEPARATED_URLS = os.environ.get("LIST_OF_COMMA_SEPARATED_URLS", "")
@@ -27,9 +31,49 @@ CONVERSATION_TTL_SECS = int(os.environ.get("CONVERSATION_TTL_SECS", "172800"))
 USE_COG_VECSEARCH = int(os.environ.get("USE_COG_VECSEARCH", "0"))
 
 DATABASE_MODE = int(os.environ.get("DATABASE_MODE", "0"))
+COSMOS_BULK_WORKERS = int(os.environ.get("COSMOS_BULK_WORKERS", "16"))
+COSMOS_BULK_MAX_ATTEMPTS = int(os.environ.get("COSMOS_BULK_MAX_ATTEMPTS", "10"))
+COSMOS_BULK_RETRY_ROUNDS = int(os.environ.get("COSMOS_BULK_RETRY_ROUNDS", "3"))
+COSMOS_RESTORE_PAGE_SIZE = int(os.environ.get("COSMOS_RESTORE_PAGE_SIZE", "500"))
+COSMOS_RESTORE_WORKERS = int(os.environ.get("COSMOS_RESTORE_WORKERS", "4"))
+COSMOS_RESTORE_LOCK_TTL_SECS = int(
+    os.environ.get("COSMOS_RESTORE_LOCK_TTL_SECS", "300")
+)
 
 USE_REDIS_CACHE = int(os.environ.get("USE_REDIS_CACHE", "1"))
 
+USE_EMB_CACHE = int(os.environ.get("USE_EMB_CACHE", "1"))
+EMB_CACHE_DIR = os.environ.get("EMB_CACHE_DIR", "/tmp/kmoai_emb_cache")
+EMB_CACHE_CAPACITY = int(os.environ.get("EMB_CACHE_CAPACITY", "20000"))
+EMB_CACHE_REDIS_TTL_SECS = int(os.environ.get("EMB_CACHE_REDIS_TTL_SECS", "2592000"))
+QUERY_EMB_CACHE_CAPACITY = int(os.environ.get("QUERY_EMB_CACHE_CAPACITY", "1000"))
+QUERY_EMB_CACHE_TTL_SECS = int(os.environ.get("QUERY_EMB_CACHE_TTL_SECS", "86400"))
+# full-precision vectors by chunk id for rescoring a compact Redis index, kept on
+# local disk and refilled from Cosmos
+RESCORE_STORE_DIR = os.environ.get("RESCORE_STORE_DIR", "/tmp/kmoai_rescore")
+RESCORE_STORE_CAPACITY = int(os.environ.get("RESCORE_STORE_CAPACITY", "100000"))
+
+# serves answers to paraphrased questions without an LLM call
+USE_ANSWER_CACHE = int(os.environ.get("USE_ANSWER_CACHE", "0"))
+ANSWER_CACHE_CAPACITY = int(os.environ.get("ANSWER_CACHE_CAPACITY", "5000"))
+ANSWER_CACHE_TTL_SECS = int(os.environ.get("ANSWER_CACHE_TTL_SECS", "86400"))
+ANSWER_CACHE_MIN_SIMILARITY = float(
+    os.environ.get("ANSWER_CACHE_MIN_SIMILARITY", "0.97")
+)
+
+# concurrent cache misses on the same tool query wait for a single computation
+USE_SINGLE_FLIGHT = int(os.environ.get("USE_SINGLE_FLIGHT", "1"))
+SINGLE_FLIGHT_TIMEOUT_SECS = int(os.environ.get("SINGLE_FLIGHT_TIMEOUT_SECS", "30"))
+SINGLE_FLIGHT_LEASE_SECS = int(os.environ.get("SINGLE_FLIGHT_LEASE_SECS", "60"))
+SINGLE_FLIGHT_POLL_MS = int(os.environ.get("SINGLE_FLIGHT_POLL_MS", "200"))
+
+# used instead of the Redis index when REDIS_ADDR is empty
+LOCAL_VECSTORE_DIR = os.environ.get("LOCAL_VECSTORE_DIR", "/tmp/kmoai_vecstore")
+EMB_EXPORT_BATCH_SIZE = int(os.environ.get("EMB_EXPORT_BATCH_SIZE", "1000"))
+
+USE_DEDUP = int(os.environ.get("USE_DEDUP", "1"))
+DEDUP_MAX_HAMMING_DISTANCE = int(os.environ.get("DEDUP_MAX_HAMMING_DISTANCE", "3"))
+
 PROCESS_IMAGES = int(os.environ.get("PROCESS_IMAGES", "0"))
 
 
@@ -57,6 +101,20 @@ SERVICEBUS_CONN_STR = os.environ.get("SERVICEBUS_CONN_STR", "")
 REDIS_ADDR = os.environ.get("REDIS_ADDR", "")
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", "")
 REDIS_PORT = os.environ.get("REDIS_PORT", "10000")
+# comma separated host:port list, chunk hashes and the vector index are spread over
+# these nodes while caches and registries stay on REDIS_ADDR
+REDIS_SHARDS = os.environ.get("REDIS_SHARDS", "")
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_HEALTH_CHECK_SECS = int(os.environ.get("REDIS_HEALTH_CHECK_SECS", "30"))
+REDIS_INDEX_CHECK_SECS = int(os.environ.get("REDIS_INDEX_CHECK_SECS", "300"))
+REDIS_INDEX_REBUILD_LOCK_TTL_SECS = int(
+    os.environ.get("REDIS_INDEX_REBUILD_LOCK_TTL_SECS", "300")
+)
+# entries kept in the RESP3 client-side cache (redis-py >= 5.1), 0 disables it
+REDIS_CLIENT_CACHE_SIZE = int(os.environ.get("REDIS_CLIENT_CACHE_SIZE", "0"))
+REDIS_CLIENT_CACHE_FIELDS = os.environ.get(
+    "REDIS_CLIENT_CACHE_FIELDS", "history"
+).split(",")
 
 BING_SUBSCRIPTION_KEY = os.environ.get("BING_SUBSCRIPTION_KEY", "")
 BING_SEARCH_URL = os.environ.get(
@@ -68,6 +126,7 @@ TRANSLATION_ENDPOINT = os.environ.get(
 )
 TRANSLATION_API_KEY = os.environ.get("TRANSLATION_API_KEY", COG_SERV_KEY)
 TRANSLATION_LOCATION = os.environ.get("TRANSLATION_LOCATION", "westeurope")
+TRANSLATION_CACHE_CAPACITY = int(os.environ.get("TRANSLATION_CACHE_CAPACITY", "10000"))
 
 if TRANSLATION_API_KEY == "":
     TRANSLATION_API_KEY = COG_SERV_KEY
@@ -100,6 +159,16 @@ COG_VEC_SEARCH_API_VERSION = os.environ.get(
     "COG_VEC_SEARCH_API_VERSION", "2023-07-01-Preview"
 )
 COG_VECSEARCH_VECTOR_INDEX = os.environ.get("COG_VECSEARCH_VECTOR_INDEX", "vec-index")
+COG_SEARCH_UPLOAD_BATCH_SIZE = int(
+    os.environ.get("COG_SEARCH_UPLOAD_BATCH_SIZE", "1000")
+)
+COG_SEARCH_UPLOAD_MAX_BYTES = int(
+    os.environ.get("COG_SEARCH_UPLOAD_MAX_BYTES", "15000000")
+)
+COG_SEARCH_UPLOAD_WORKERS = int(os.environ.get("COG_SEARCH_UPLOAD_WORKERS", "4"))
+COG_SEARCH_UPLOAD_RETRY_ROUNDS = int(
+    os.environ.get("COG_SEARCH_UPLOAD_RETRY_ROUNDS", "3")
+)
 
 
 ############################
@@ -120,8 +189,19 @@ KB_SKILLSET_NAME = os.environ.get("KB_SKILLSET_NAME", "km-openai-skills")
 REDIS_INDEX_NAME = os.environ.get("REDIS_INDEX_NAME", "acs_emb_index")
 VECTOR_FIELD_IN_REDIS = os.environ.get("VECTOR_FIELD_IN_REDIS", "item_vector")
 NUMBER_PRODUCTS_INDEX = int(os.environ.get("NUMBER_PRODUCTS_INDEX", "1000"))
+REDIS_BULK_BATCH_SIZE = int(os.environ.get("REDIS_BULK_BATCH_SIZE", "500"))
+REDIS_VECTOR_TYPE = os.environ.get("REDIS_VECTOR_TYPE", "FLOAT32")
+REDIS_RESCORE_OVERSAMPLE = int(os.environ.get("REDIS_RESCORE_OVERSAMPLE", "4"))
+REDIS_INDEX_ALGORITHM = os.environ.get("REDIS_INDEX_ALGORITHM", "HNSW")
+REDIS_FLAT_MAX_VECTORS = int(os.environ.get("REDIS_FLAT_MAX_VECTORS", "10000"))
+REDIS_HNSW_M = int(os.environ.get("REDIS_HNSW_M", "40"))
+REDIS_HNSW_EF_CONSTRUCTION = int(os.environ.get("REDIS_HNSW_EF_CONSTRUCTION", "200"))
+REDIS_HNSW_EF_RUNTIME = int(os.environ.get("REDIS_HNSW_EF_RUNTIME", "0"))
+REDIS_HYBRID_SEARCH = int(os.environ.get("REDIS_HYBRID_SEARCH", "0"))
+REDIS_HYBRID_RRF_K = int(os.environ.get("REDIS_HYBRID_RRF_K", "60"))
 CATEGORYID = os.environ.get("CATEGORYID", "KM_OAI_CATEGORY")
 EMBCATEGORYID = os.environ.get("EMBCATEGORYID", "KM_OAI_EMB_CATEGORY")
+CHUNKREGCATEGORYID = os.environ.get("CHUNKREGCATEGORYID", "KM_OAI_CHUNKREG_CATEGORY")
 COSMOS_DB_NAME = os.environ.get("COSMOS_DB_NAME", "KM_OAI_DB")
 KB_BLOB_CONTAINER = os.environ.get("KB_BLOB_CONTAINER", "kmoaidemo")
 OUTPUT_BLOB_CONTAINER = os.environ.get("OUTPUT_BLOB_CONTAINER", "kmoaiprocessed")
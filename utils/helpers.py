@@ -14,8 +14,9 @@ from langchain.callbacks.base import CallbackManager
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import AzureOpenAI
 
-from utils import (cosmos_helpers, language, openai_helpers, redis_helpers,
-                   storage)
+from utils import (cosmos_helpers, dedup, emb_cache, emb_export, language,
+                   local_vecstore, openai_helpers, redis_helpers,
+                   retrieval_context, storage)
 from utils.env_vars import *
 from utils.kb_doc import KB_Doc
 from utils.langchain_helpers import mod_agent
@@ -28,6 +29,7 @@ def generate_embeddings(
     previous_max_tokens=0,
     text_suffix="",
     gen_emb=True,
+    batch_emb=True,
 ):
     emb_documents = []
 
@@ -90,21 +92,27 @@ def generate_embeddings(
         print("Skipping generating embeddings as it is optional for this text")
         return emb_documents
 
-    suff = 0
-    for chunk in chunked_words(tokens, chunk_length=max_emb_tokens - OVERLAP_TEXT):
-        decoded_chunk = enc.decode(chunk)
+    decoded_chunks = [
+        enc.decode(chunk)
+        for chunk in chunked_words(tokens, chunk_length=max_emb_tokens - OVERLAP_TEXT)
+    ]
 
-        translated_chunk = decoded_chunk
-        if lang != "en":
-            translated_chunk = language.translate(decoded_chunk, lang)
+    if lang != "en":
+        translated_chunks = language.translate_batch(decoded_chunks, lang)
+    else:
+        translated_chunks = decoded_chunks
 
-        if gen_emb:
-            embedding = openai_helpers.get_openai_embedding(
-                translated_chunk, embedding_model
-            )
-        else:
-            embedding = ""
+    chunks = list(zip(decoded_chunks, translated_chunks))
 
+    if gen_emb:
+        embeddings = emb_cache.get_cached_openai_embeddings(
+            [c[1] for c in chunks], embedding_model, batch=batch_emb
+        )
+    else:
+        embeddings = [""] * len(chunks)
+
+    suff = 0
+    for (decoded_chunk, translated_chunk), embedding in zip(chunks, embeddings):
         dd = copy.deepcopy(json_object)
         dd["id"] = f"{doc_id}_{text_suffix}_{suff}"
         dd["text_en"] = translated_chunk
@@ -130,8 +138,166 @@ def generate_embeddings(
     return emb_documents
 
 
+def get_granularities():
+    granularities = [("S", SMALL_EMB_TOKEN_NUM, 0)]
+
+    if MEDIUM_EMB_TOKEN_NUM != 0:
+        granularities.append(("M", MEDIUM_EMB_TOKEN_NUM, SMALL_EMB_TOKEN_NUM))
+    if LARGE_EMB_TOKEN_NUM != 0:
+        granularities.append(("L", LARGE_EMB_TOKEN_NUM, MEDIUM_EMB_TOKEN_NUM))
+    if X_LARGE_EMB_TOKEN_NUM != 0:
+        granularities.append(("XL", X_LARGE_EMB_TOKEN_NUM, LARGE_EMB_TOKEN_NUM))
+
+    return granularities
+
+
+def chunked_text_by_offsets(
+    text, offsets, num_tokens, chunk_length, overlap=OVERLAP_TEXT
+):
+    num_slices = num_tokens // chunk_length + (num_tokens % chunk_length > 0)
+
+    for i in range(num_slices):
+        start = i * chunk_length
+        end = (i + 1) * chunk_length + overlap
+        end_char = offsets[end] if end < num_tokens else len(text)
+        yield text[offsets[start] : end_char]
+
+
+def prepare_multi_granularity_chunks(full_kbd_doc, embedding_model, granularities=None):
+    if granularities is None:
+        granularities = get_granularities()
+
+    json_object = dict(full_kbd_doc.get_dict())
+
+    try:
+        if isinstance(json_object["timestamp"], list):
+            json_object["timestamp"] = json_object["timestamp"][0]
+        elif not isinstance(json_object["timestamp"], str):
+            json_object["timestamp"] = "1/1/1970 00:00:00 AM"
+    except:
+        json_object["timestamp"] = "1/1/1970 00:00:00 AM"
+
+    #### FOR DEMO PURPOSES ONLY -- OF COURSE NOT SECURE
+    access = "public"
+
+    if (
+        (json_object["filename"] is None)
+        or (json_object["filename"] == "")
+        or (json_object["filename"] == "null")
+    ):
+        filename = storage.get_filename(json_object["doc_url"])
+    else:
+        filename = json_object["filename"]
+
+    if filename.startswith("PRIVATE_"):
+        access = "private"
+    #### FOR DEMO PURPOSES ONLY -- OF COURSE NOT SECURE
+
+    doc_id = json_object["id"]
+    enc = openai_helpers.get_encoder(embedding_model)
+    tokens = enc.encode(json_object["text"])
+    doc_text, offsets = enc.decode_with_offsets(tokens)
+    lang = language.detect_content_language(doc_text[:500])
+
+    if json_object.get("doc_url", False):
+        json_object["doc_url"] = storage.create_sas(json_object["doc_url"])
+    else:
+        json_object["doc_url"] = ""
+    json_object["access"] = access
+    json_object["orig_lang"] = lang
+
+    chunks = []
+    for text_suffix, max_emb_tokens, previous_max_tokens in granularities:
+        if (len(tokens) < previous_max_tokens - OVERLAP_TEXT) and (
+            previous_max_tokens > 0
+        ):
+            print(f"Skipping optional {text_suffix} embeddings for document {filename}")
+            continue
+
+        for suff, chunk_text in enumerate(
+            chunked_text_by_offsets(
+                doc_text, offsets, len(tokens), max_emb_tokens - OVERLAP_TEXT
+            )
+        ):
+            chunks.append([f"{doc_id}_{text_suffix}_{suff}", chunk_text, chunk_text])
+
+    if lang != "en":
+        translated_chunks = language.translate_batch([c[1] for c in chunks], lang)
+        for c, translated_chunk in zip(chunks, translated_chunks):
+            c[2] = translated_chunk
+
+    chunks = dedup.filter_duplicate_chunks(doc_id, chunks, embedding_model)
+
+    return json_object, chunks
+
+
+def generate_multi_granularity_embedding_batches(
+    full_kbd_doc,
+    embedding_model,
+    granularities=None,
+    gen_emb=True,
+    batch_emb=True,
+    batch_size=INGESTION_BATCH_SIZE,
+):
+    json_object, chunks = prepare_multi_granularity_chunks(
+        full_kbd_doc, embedding_model, granularities
+    )
+
+    for i in range(0, len(chunks), batch_size):
+        batch_chunks = chunks[i : i + batch_size]
+
+        if gen_emb:
+            embeddings = emb_cache.get_cached_openai_embeddings(
+                [c[2] for c in batch_chunks], embedding_model, batch=batch_emb
+            )
+        else:
+            embeddings = [""] * len(batch_chunks)
+
+        emb_documents = []
+
+        for (chunk_id, chunk_text, translated_chunk), embedding in zip(
+            batch_chunks, embeddings
+        ):
+            dd = dict(json_object)
+            dd["id"] = chunk_id
+            dd["text_en"] = translated_chunk
+            dd["text"] = chunk_text if json_object["orig_lang"] != "en" else ""
+            dd[VECTOR_FIELD_IN_REDIS] = embedding
+
+            chunk_kbd_doc = KB_Doc()
+            chunk_kbd_doc.load(dd)
+            emb_documents.append(chunk_kbd_doc.get_dict())
+
+        yield emb_documents
+
+
+def generate_multi_granularity_embeddings(
+    full_kbd_doc,
+    embedding_model,
+    granularities=None,
+    gen_emb=True,
+    batch_emb=True,
+):
+    emb_documents = []
+
+    for batch in generate_multi_granularity_embedding_batches(
+        full_kbd_doc, embedding_model, granularities, gen_emb, batch_emb
+    ):
+        emb_documents += batch
+
+    print(f"This doc generated {len(emb_documents)} chunks in a single pass")
+    logging.info(f"This doc generated {len(emb_documents)} chunks in a single pass")
+
+    return emb_documents
+
+
 def generate_embeddings_from_json_docs(
-    json_folder, embedding_model, max_emb_tokens, text_suffix="M", limit=-1
+    json_folder,
+    embedding_model,
+    max_emb_tokens,
+    text_suffix="M",
+    limit=-1,
+    batch_emb=True,
 ):
     emb_documents = []
 
@@ -149,6 +315,7 @@ def generate_embeddings_from_json_docs(
             embedding_model,
             max_emb_tokens=max_emb_tokens,
             text_suffix=text_suffix,
+            batch_emb=batch_emb,
         )
         emb_documents += doc_embs
         counter += 1
@@ -170,33 +337,47 @@ def load_object_from_pkl(filename):
     return object
 
 
+def save_embedding_docs(emb_documents, path):
+    return emb_export.export_embedding_docs(emb_documents, path)
+
+
 def load_embedding_docs_in_redis(emb_documents, emb_filename="", document_name=""):
     if (emb_documents is None) and (emb_filename != ""):
-        emb_documents = load_embedding_docs_from_pkl(emb_filename)
+        # exports are streamed back in batches so memory stays flat for large corpora
+        batches = emb_export.iter_embedding_doc_batches(emb_filename)
+        document_name = emb_filename if document_name == "" else document_name
+    else:
+        batches = [emb_documents]
 
     redis_conn = redis_helpers.get_new_conn()
 
-    print(f"Loading {len(emb_documents)} embeddings into Redis")
-    logging.info(f"Loading {len(emb_documents)} embeddings into Redis")
+    if redis_conn is None:
+        print(f"Loading embeddings of {document_name} into the local vector store")
+        logging.info(
+            f"Loading embeddings of {document_name} into the local vector store"
+        )
+        store = local_vecstore.get_local_vecstore()
+        return sum([store.upsert(batch) for batch in batches]), []
 
-    counter = 0
-    loaded = 0
+    print(f"Loading embeddings of {document_name} into Redis")
+    logging.info(f"Loading embeddings of {document_name} into Redis")
 
-    for e in emb_documents:
-        loaded += redis_helpers.redis_upsert_embedding(redis_conn, e)
+    def iter_docs():
+        for batch in batches:
+            emb_cache.store_rescore_vectors(batch)
+            yield from batch
 
-        counter += 1
-        if counter % 200 == 0:
-            print(
-                f"Processed: {counter} of {len(emb_documents)} for document {document_name}"
-            )
-            logging.info(
-                f"Processed: {counter} of {len(emb_documents)} for document {document_name}"
-            )
+    loaded, failed_ids = redis_helpers.redis_bulk_upsert_embeddings(
+        redis_conn, iter_docs(), document_name=document_name
+    )
 
-    print(f"Processed: {counter} of {len(emb_documents)} for document {document_name}")
+    if len(failed_ids) > 0:
+        print(f"Failed loading {len(failed_ids)} embeddings of {document_name}")
+        logging.error(
+            f"Failed loading embeddings of {document_name} into Redis: {failed_ids}"
+        )
 
-    return loaded
+    return loaded, failed_ids
 
 
 def chunked_words(tokens, chunk_length, overlap=OVERLAP_TEXT):
@@ -240,43 +421,132 @@ re_strs = [
 ]
 
 
-def redis_search(query: str, filter_param: str):
-    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
-        return ["Sorry, I couldn't find any information related to the question."]
+# search results render only these fields, the chunk text is loaded afterwards
+# for the hits that are actually used
+REDIS_SEARCH_FIELDS = ["container", "filename", "web_url"]
+REDIS_PAYLOAD_FIELDS = ["text_en"]
 
-    redis_conn = redis_helpers.get_new_conn()
-    completion_enc = openai_helpers.get_encoder(CHOSEN_COMP_MODEL)
-    embedding_enc = openai_helpers.get_encoder(CHOSEN_EMB_MODEL)
-
-    query = embedding_enc.decode(embedding_enc.encode(query)[:MAX_QUERY_TOKENS])
 
-    query_embedding = openai_helpers.get_openai_embedding(query, CHOSEN_EMB_MODEL)
-    results = redis_helpers.redis_query_embedding_index(
-        redis_conn, query_embedding, -1, topK=NUM_TOP_MATCHES, filter_param=filter_param
-    )
+def redis_knn_search(
+    redis_conn,
+    query_embedding,
+    topK,
+    filter_param,
+    fields=REDIS_SEARCH_FIELDS,
+    query=None,
+):
+    # without Redis the in-process store returns the payload with the hits
+    if redis_conn is None:
+        return local_vecstore.query_embedding_index(
+            local_vecstore.get_local_vecstore(),
+            query_embedding,
+            -1,
+            topK=topK,
+            filter_param=filter_param,
+            fields=list(fields) + REDIS_PAYLOAD_FIELDS,
+        )
 
-    if len(results) == 0:
-        logging.warning(
-            "No embeddings found in Redis, attempting to load embeddings from Cosmos"
+    if (REDIS_HYBRID_SEARCH == 1) and (query is not None):
+        rescore = None
+        if REDIS_VECTOR_TYPE != "FLOAT32":
+            rescore = lambda results, k: emb_cache.rescore_results(
+                results, query_embedding, k
+            )
+        return redis_helpers.redis_hybrid_query(
+            redis_conn,
+            query,
+            query_embedding,
+            topK=topK,
+            filter_param=filter_param,
+            fields=fields,
+            rescore=rescore,
         )
-        cosmos_helpers.cosmos_restore_embeddings()
-        results = redis_helpers.redis_query_embedding_index(
+
+    if REDIS_VECTOR_TYPE == "FLOAT32":
+        return redis_helpers.redis_query_embedding_index(
             redis_conn,
             query_embedding,
             -1,
-            topK=NUM_TOP_MATCHES,
+            topK=topK,
             filter_param=filter_param,
+            fields=fields,
         )
 
-    return process_search_results(results)
+    # rescoring looks up the full-precision vectors by chunk id
+    results = redis_helpers.redis_query_embedding_index(
+        redis_conn,
+        query_embedding,
+        -1,
+        topK=topK * REDIS_RESCORE_OVERSAMPLE,
+        filter_param=filter_param,
+        fields=fields,
+    )
+    return emb_cache.rescore_results(results, query_embedding, topK)
+
+
+INDEX_RESTORING_ANSWER = (
+    "The knowledge base is being loaded, please try again in a few minutes."
+)
 
 
-def process_search_results(results):
+def search_fallback(query, filter_param, lookup=False):
+    if COG_SEARCH_ENDPOINT == "":
+        return [INDEX_RESTORING_ANSWER]
+
+    # imported here since the Cognitive Search helpers import this module
+    from utils import cogsearch_helpers
+
+    try:
+        if lookup:
+            return cogsearch_helpers.cog_lookup(query, filter_param)
+        else:
+            return cogsearch_helpers.cog_search(query, filter_param)
+    except Exception as e:
+        logging.error(f"Cognitive Search fallback failed: {e}")
+        return [INDEX_RESTORING_ANSWER]
+
+
+def check_partial_index(redis_conn):
+    try:
+        if cosmos_helpers.check_index_readiness(redis_conn) == "restoring":
+            logging.warning(
+                "Redis index is only partially restored, results may be missing"
+            )
+    except Exception as e:
+        logging.warning(f"Failed to check the Redis index readiness: {e}")
+
+
+def redis_search(query: str, filter_param: str, ctx=None):
+    redis_conn = redis_helpers.get_new_conn()
+
+    ctx = retrieval_context.get_retrieval_context(query, ctx)
+    query = ctx.get_query()
+    query_embedding = ctx.get_embedding()
+    results = redis_knn_search(
+        redis_conn, query_embedding, NUM_TOP_MATCHES, filter_param, query=query
+    )
+
+    # no hits can also mean the filter matched nothing, only an empty index restores
+    if (len(results) == 0) and (redis_conn is not None):
+        if cosmos_helpers.get_index_readiness(redis_conn) == "restoring":
+            logging.warning("Redis index is being restored, answering from fallback")
+            return search_fallback(query, filter_param)
+    elif redis_conn is not None:
+        check_partial_index(redis_conn)
+
+    return process_search_results(results, redis_conn)
+
+
+def process_search_results(results, redis_conn=None):
     completion_enc = openai_helpers.get_encoder(CHOSEN_COMP_MODEL)
 
     if len(results) == 0:
         return ["Sorry, I couldn't find any information related to the question."]
 
+    results = results[:NUM_TOP_MATCHES]
+    if redis_conn is not None:
+        redis_helpers.redis_load_fields(redis_conn, results, REDIS_PAYLOAD_FIELDS)
+
     context = []
 
     for t in results:
@@ -324,30 +594,24 @@ def process_search_results(results):
     return final_context
 
 
-def redis_lookup(query: str, filter_param: str):
+def redis_lookup(query: str, filter_param: str, ctx=None):
     redis_conn = redis_helpers.get_new_conn()
     completion_enc = openai_helpers.get_encoder(CHOSEN_COMP_MODEL)
 
-    embedding_enc = openai_helpers.get_encoder(CHOSEN_EMB_MODEL)
-    query = embedding_enc.decode(embedding_enc.encode(query)[:MAX_QUERY_TOKENS])
+    ctx = retrieval_context.get_retrieval_context(query, ctx)
+    query = ctx.get_query()
+    query_embedding = ctx.get_embedding()
+    results = redis_knn_search(redis_conn, query_embedding, 1, filter_param)
 
-    query_embedding = openai_helpers.get_openai_embedding(query, CHOSEN_EMB_MODEL)
-    results = redis_helpers.redis_query_embedding_index(
-        redis_conn, query_embedding, -1, topK=1, filter_param=filter_param
-    )
+    if (len(results) == 0) and (redis_conn is not None):
+        if cosmos_helpers.get_index_readiness(redis_conn) == "restoring":
+            logging.warning("Redis index is being restored, answering from fallback")
+            return "\n".join(search_fallback(query, filter_param, lookup=True))
+    elif redis_conn is not None:
+        check_partial_index(redis_conn)
 
-    if len(results) == 0:
-        logging.warning(
-            "No embeddings found in Redis, attempting to load embeddings from Cosmos"
-        )
-        cosmos_helpers.cosmos_restore_embeddings()
-        results = redis_helpers.redis_query_embedding_index(
-            redis_conn,
-            query_embedding,
-            -1,
-            topK=NUM_TOP_MATCHES,
-            filter_param=filter_param,
-        )
+    if redis_conn is not None:
+        redis_helpers.redis_load_fields(redis_conn, results, REDIS_PAYLOAD_FIELDS)
 
     context = " \n".join(
         [
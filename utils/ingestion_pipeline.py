@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+import time
+
+from utils.env_vars import *
+
+
+class PipelineStage(threading.Thread):
+    def __init__(self, name, sink_func, max_queue_size=INGESTION_QUEUE_SIZE):
+        super().__init__(name=f"ingestion-{name}", daemon=True)
+        self.stage_name = name
+        self.sink_func = sink_func
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.stats = {
+            "batches": 0,
+            "docs": 0,
+            "errors": 0,
+            "busy_secs": 0.0,
+            "idle_secs": 0.0,
+            "backpressure_secs": 0.0,
+            "max_queue_depth": 0,
+        }
+
+    def put(self, batch):
+        self.stats["max_queue_depth"] = max(
+            self.stats["max_queue_depth"], self.queue.qsize()
+        )
+        b = time.time()
+        self.queue.put([dict(d) for d in batch])
+        self.stats["backpressure_secs"] += time.time() - b
+
+    def close(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            b = time.time()
+            batch = self.queue.get()
+            self.stats["idle_secs"] += time.time() - b
+
+            if batch is None:
+                break
+
+            # after a failure the queue is only drained so the producer never blocks
+            if self.error is not None:
+                continue
+
+            b = time.time()
+            try:
+                self.sink_func(batch)
+            except Exception as e:
+                self.error = e
+                self.stats["errors"] += 1
+                logging.error(f"Ingestion stage {self.stage_name} failed: {e}")
+                print(f"Ingestion stage {self.stage_name} failed: {e}")
+
+            self.stats["busy_secs"] += time.time() - b
+            self.stats["batches"] += 1
+            self.stats["docs"] += len(batch)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["docs_per_sec"] = (
+            stats["docs"] / stats["busy_secs"] if stats["busy_secs"] > 0 else 0.0
+        )
+        return stats
+
+
+def run_ingestion_pipeline(
+    batches, sinks, max_queue_size=INGESTION_QUEUE_SIZE, document_name=""
+):
+    stages = [PipelineStage(name, func, max_queue_size) for name, func in sinks.items()]
+
+    for stage in stages:
+        stage.start()
+
+    emb_documents = []
+    producer_stats = {"batches": 0, "docs": 0, "busy_secs": 0.0}
+    start = time.time()
+
+    b = time.time()
+    try:
+        for batch in batches:
+            producer_stats["busy_secs"] += time.time() - b
+            producer_stats["batches"] += 1
+            producer_stats["docs"] += len(batch)
+            emb_documents += batch
+
+            for stage in stages:
+                stage.put(batch)
+
+            b = time.time()
+    finally:
+        for stage in stages:
+            stage.close()
+
+        for stage in stages:
+            stage.join()
+
+    producer_stats["docs_per_sec"] = (
+        producer_stats["docs"] / producer_stats["busy_secs"]
+        if producer_stats["busy_secs"] > 0
+        else 0.0
+    )
+
+    stats = {"embedding": producer_stats, "wall_clock_secs": time.time() - start}
+    for stage in stages:
+        stats[stage.stage_name] = stage.get_stats()
+
+    for name, stage_stats in stats.items():
+        logging.info(f"Ingestion pipeline {document_name} - {name}: {stage_stats}")
+        print(f"Ingestion pipeline {document_name} - {name}: {stage_stats}")
+
+    # a failed sink must fail the whole document so the message is retried
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+    return emb_documents, stats
@@ -5,6 +5,7 @@ import os
 import pickle
 import re
 import sys
+import threading
 import urllib
 import uuid
 from datetime import date, datetime
@@ -30,7 +31,8 @@ from langchain.schema import (AgentAction, AgentFinish, AIMessage,
 from langchain.tools.base import BaseTool
 
 import utils.langchain_helpers.mod_react_prompt
-from utils import cv_helpers, helpers, openai_helpers, redis_helpers, storage
+from utils import (answer_cache, cv_helpers, helpers, openai_helpers,
+                   redis_helpers, storage)
 from utils.cogsearch_helpers import cog_lookup, cog_search, cog_vecsearch
 from utils.cogvecsearch_helpers import cogsearch_vecstore
 from utils.env_vars import *
@@ -40,6 +42,8 @@ from utils.langchain_helpers.mod_agent import (ModBingSearchAPIWrapper,
                                                ModConversationalChatAgent,
                                                ReAct, ZSReAct)
 from utils.langchain_helpers.oldschoolsearch import OldSchoolSearch
+from utils.retrieval_context import RetrievalContext
+from utils.single_flight import single_flight
 from utils.language import extract_entities
 
 openai.api_type = "azure"
@@ -70,6 +74,8 @@ class KMOAI_Agent:
         self.agent_name = agent_name
         self.verbose = verbose
         self.history = ""
+        self.retrieval_ctxs = {}
+        self.retrieval_ctxs_lock = threading.Lock()
 
         self.enable_unified_search = params_dict.get("enable_unified_search", False)
         self.enable_cognitive_search = params_dict.get("enable_cognitive_search", False)
@@ -287,116 +293,110 @@ class KMOAI_Agent:
     def get_date(self, query):
         return f"Today's date and time {datetime.now().strftime('%A %B %d, %Y %H:%M:%S')}. You can use this date to derive the day and date for any time-related questions, such as this afternoon, this evening, today, tomorrow, this weekend or next week."
 
-    def agent_redis_search(self, query):
+    def get_retrieval_context(self, query):
+        # the tools of one request often search the same query, they share its
+        # truncation and embedding
+        with self.retrieval_ctxs_lock:
+            if query not in self.retrieval_ctxs:
+                self.retrieval_ctxs[query] = RetrievalContext(query)
+            return self.retrieval_ctxs[query]
+
+    def get_cached_response(self, key, field):
         response = redis_helpers.redis_get(
-            self.redis_conn, query, "redis_search_response", verbose=self.verbose
+            self.redis_conn, key, field, verbose=self.verbose
         )
+        return response.decode("UTF-8") if response is not None else None
 
-        if response is None:
-            response = "\n\n".join(redis_search(query, self.redis_filter_param))
-            response = self.evaluate(query, response)
-            redis_helpers.redis_set(
-                self.redis_conn,
-                query,
-                "redis_search_response",
-                response,
-                CONVERSATION_TTL_SECS,
-                verbose=self.verbose,
-            )
-        else:
-            response = response.decode("UTF-8")
+    def get_tool_response(self, query, field, filter_param, search):
+        # the same query under another filter searches other documents
+        field = f"{field}:{answer_cache.get_filter_key(filter_param)}"
 
-        return response
-
-    def agent_redis_lookup(self, query):
-        response = redis_helpers.redis_get(
-            self.redis_conn, query, "redis_lookup_response", verbose=self.verbose
-        )
+        response = self.get_cached_response(query, field)
+        if response is not None:
+            return response
 
-        if response is None:
-            response = "\n\n".join(redis_lookup(query, self.redis_filter_param))
-            response = self.evaluate(query, response)
+        # concurrent misses on the same query wait for one search and evaluation
+        def compute():
+            response = self.evaluate(query, search())
             redis_helpers.redis_set(
                 self.redis_conn,
                 query,
-                "redis_lookup_response",
+                field,
                 response,
                 CONVERSATION_TTL_SECS,
                 verbose=self.verbose,
             )
-        else:
-            response = response.decode("UTF-8")
+            return response
 
-        return response
+        return single_flight(
+            self.redis_conn,
+            query,
+            field,
+            filter_param,
+            compute,
+            lambda: self.get_cached_response(query, field),
+        )
 
-    def agent_cog_search(self, query):
-        response = redis_helpers.redis_get(
-            self.redis_conn, query, "cog_search_response", verbose=self.verbose
+    def agent_redis_search(self, query):
+        return self.get_tool_response(
+            query,
+            "redis_search_response",
+            self.redis_filter_param,
+            lambda: "\n\n".join(
+                redis_search(
+                    query,
+                    self.redis_filter_param,
+                    ctx=self.get_retrieval_context(query),
+                )
+            ),
         )
 
-        if response is None:
+    def agent_redis_lookup(self, query):
+        return self.get_tool_response(
+            query,
+            "redis_lookup_response",
+            self.redis_filter_param,
+            lambda: "\n\n".join(
+                redis_lookup(
+                    query,
+                    self.redis_filter_param,
+                    ctx=self.get_retrieval_context(query),
+                )
+            ),
+        )
+
+    def agent_cog_search(self, query):
+        def search():
             if USE_COG_VECSEARCH:
-                response = "\n\n".join(
-                    cog_vecsearch(query, self.cogsearch_filter_param)
+                return "\n\n".join(
+                    cog_vecsearch(
+                        query,
+                        self.cogsearch_filter_param,
+                        ctx=self.get_retrieval_context(query),
+                    )
                 )
-            else:
-                response = "\n\n".join(cog_search(query, self.cogsearch_filter_param))
-            response = self.evaluate(query, response)
-            redis_helpers.redis_set(
-                self.redis_conn,
-                query,
-                "cog_search_response",
-                response,
-                CONVERSATION_TTL_SECS,
-                verbose=self.verbose,
-            )
-        else:
-            response = response.decode("UTF-8")
+            return "\n\n".join(cog_search(query, self.cogsearch_filter_param))
 
-        return response
+        return self.get_tool_response(
+            query, "cog_search_response", self.cogsearch_filter_param, search
+        )
 
     def agent_cog_lookup(self, query):
-        response = redis_helpers.redis_get(
-            self.redis_conn, query, "cog_lookup_response", verbose=self.verbose
+        return self.get_tool_response(
+            query,
+            "cog_lookup_response",
+            self.cogsearch_filter_param,
+            lambda: "\n\n".join(cog_lookup(query, self.cogsearch_filter_param)),
         )
 
-        if response is None:
-            response = "\n\n".join(cog_lookup(query, self.cogsearch_filter_param))
-            response = self.evaluate(query, response)
-            redis_helpers.redis_set(
-                self.redis_conn,
-                query,
-                "cog_lookup_response",
-                response,
-                CONVERSATION_TTL_SECS,
-                verbose=self.verbose,
-            )
-        else:
-            response = response.decode("UTF-8")
-
-        return response
-
     def agent_bing_search(self, query):
         if self.use_bing or (USE_BING == "yes"):
-            response = redis_helpers.redis_get(
-                self.redis_conn, query, "bing_search_response", verbose=self.verbose
+            return self.get_tool_response(
+                query,
+                "bing_search_response",
+                None,
+                lambda: "\n\n".join(self.bing_search.run(query)),
             )
-
-            if response is None:
-                response = "\n\n".join(self.bing_search.run(query))
-                response = self.evaluate(query, response)
-                redis_helpers.redis_set(
-                    self.redis_conn,
-                    query,
-                    "bing_search_response",
-                    response,
-                    CONVERSATION_TTL_SECS,
-                    verbose=self.verbose,
-                )
-            else:
-                response = response.decode("UTF-8")
-
-            return response
         else:
             return ""
 
@@ -496,59 +496,53 @@ class KMOAI_Agent:
         return response
 
     def unified_search(self, query):
-        response = redis_helpers.redis_get(
-            self.redis_conn, query, "response", verbose=self.verbose
+        # keyed on the tool query, a later Search in the same run can ask for
+        # something else than the question the run started with
+        return self.get_tool_response(
+            query,
+            "response",
+            self.get_search_filters(),
+            lambda: self.get_unified_search_context(query),
         )
 
-        if response is None:
-            list_f = ["redis_search", "cog_lookup", "cog_search"]
-            list_q = [query for f in list_f]
-
-            if USE_BING == "yes":
-                list_f += ["bing_lookup"]
-                list_q += [query]
-
-            # print(list_f, list_q)
+    def get_unified_search_context(self, query):
+        list_f = ["redis_search", "cog_lookup", "cog_search"]
+        list_q = [query for f in list_f]
 
-            results = pool.starmap(self.specific_search, zip(list_q, list_f))
-
-            max_items = max([len(r) for r in results])
+        if USE_BING == "yes":
+            list_f += ["bing_lookup"]
+            list_q += [query]
 
-            final_context = []
-            context_dict = {}
+        # print(list_f, list_q)
 
-            for i in range(max_items):
-                for j in range(len(results)):
-                    if i < len(results[j]):
-                        if results[j][i] not in context_dict:
-                            context_dict[results[j][i]] = 1
-                            final_context.append(results[j][i])
+        # the backends share one truncated query and embedding
+        ctx = self.get_retrieval_context(query)
+        results = pool.starmap(
+            self.specific_search, zip(list_q, list_f, [ctx for f in list_f])
+        )
 
-            response = "\n\n".join(final_context)
+        max_items = max([len(r) for r in results])
 
-            completion_enc = openai_helpers.get_encoder(CHOSEN_COMP_MODEL)
-            response = completion_enc.decode(
-                completion_enc.encode(response)[:MAX_SEARCH_TOKENS]
-            )
+        final_context = []
+        context_dict = {}
 
-            response = self.evaluate(query, response)
+        for i in range(max_items):
+            for j in range(len(results)):
+                if i < len(results[j]):
+                    if results[j][i] not in context_dict:
+                        context_dict[results[j][i]] = 1
+                        final_context.append(results[j][i])
 
-            redis_helpers.redis_set(
-                self.redis_conn,
-                self.intent_output,
-                "response",
-                response,
-                CONVERSATION_TTL_SECS,
-                verbose=self.verbose,
-            )
-        else:
-            response = response.decode("UTF-8")
+        response = "\n\n".join(final_context)
 
-        return response
+        completion_enc = openai_helpers.get_encoder(CHOSEN_COMP_MODEL)
+        return completion_enc.decode(
+            completion_enc.encode(response)[:MAX_SEARCH_TOKENS]
+        )
 
-    def specific_search(self, q, func_name):
+    def specific_search(self, q, func_name, ctx=None):
         if func_name == "redis_search":
-            return redis_search(q, self.redis_filter_param)
+            return redis_search(q, self.redis_filter_param, ctx=ctx)
         if func_name == "cog_lookup":
             return cog_lookup(q, self.cogsearch_filter_param)
         if func_name == "cog_search":
@@ -648,6 +642,7 @@ class KMOAI_Agent:
 
         if (self.agent_name == "os") or (self.agent_name == "zs"):
             self.memory.save_context({"input": query}, {"output": answer_with_sources})
+        self.answer_with_sources = answer_with_sources
 
         if answer == "Agent stopped due to max iterations.":
             answer = "I am sorry, I am not able to find an answer to your question. Please try again with a different question."
@@ -773,6 +768,10 @@ class KMOAI_Agent:
             self.redis_filter_param = filter_param
             self.cogsearch_filter_param = filter_param
 
+    def get_search_filters(self):
+        # results may come from either backend, they are cached under both filters
+        return f"{self.redis_filter_param}\n{self.cogsearch_filter_param}"
+
     def process_request(self, query, hist, pre_context):
         if self.verbose:
             print("agent_name", self.agent_name)
@@ -862,11 +861,10 @@ class KMOAI_Agent:
         if (intent is None) or (intent == ""):
             return ""
         else:
-            pre_context = redis_helpers.redis_get(
-                self.redis_conn, intent, "answer", verbose=self.verbose
-            )
-            sources = redis_helpers.redis_get(
-                self.redis_conn, intent, "sources", verbose=self.verbose
+            pre_context, sources = redis_helpers.redis_mget(
+                self.redis_conn,
+                [(intent, "answer"), (intent, "sources")],
+                verbose=self.verbose,
             )
 
             if pre_context is None:
@@ -923,9 +921,29 @@ class KMOAI_Agent:
 
         return resp
 
+    def cache_answer(self, query, query_emb, kb_version, answer):
+        if query_emb is None:
+            return
+
+        if answer.startswith(DEFAULT_RESPONSE) or answer.startswith("I am sorry"):
+            return
+
+        answer_cache.cache_answer(
+            query,
+            query_emb,
+            self.agent_name,
+            self.get_search_filters(),
+            self.answer_with_sources,
+            kb_version,
+        )
+
     def run(self, query, redis_conn, prompt_id=None, filter_param=None):
         self.redis_conn = redis_conn
 
+        # the agent object serves many requests, contexts only live for one run
+        with self.retrieval_ctxs_lock:
+            self.retrieval_ctxs = {}
+
         hist, prompt_id = self.get_history(prompt_id)
         self.history = hist.replace("\n", " ")
         if self.verbose:
@@ -933,6 +951,27 @@ class KMOAI_Agent:
         pre_context = ""
 
         self.intent_output = self.agent_name + ": " + query
+        self.assign_filter_param(filter_param)
+
+        # follow-up questions depend on the history, and a cached answer cannot
+        # be streamed, so only standalone questions go through the answer cache
+        query_emb = None
+        kb_version = None
+        if (
+            (hist == "")
+            and (not self.stream)
+            and (answer_cache.get_answer_cache() is not None)
+        ):
+            query_emb = self.get_retrieval_context(query).get_embedding()
+            cached, kb_version = answer_cache.get_cached_answer(
+                query_emb, self.agent_name, self.get_search_filters()
+            )
+            if cached is not None:
+                answer, sources, likely_sources = self.process_final_response(
+                    query, cached
+                )
+                self.manage_history(hist, sources, prompt_id)
+                return answer, sources, likely_sources, prompt_id
 
         if self.check_intent:
             if hist == "":
@@ -947,7 +986,6 @@ class KMOAI_Agent:
             if intent == "chit chat":
                 return self.chichat(query), [], [], prompt_id
 
-        self.assign_filter_param(filter_param)
         self.inform_agent_input_lengths(self.zs_chain.agent, query, hist, pre_context)
 
         answer, sources, likely_sources = self.process_request(query, hist, pre_context)
@@ -959,6 +997,7 @@ class KMOAI_Agent:
             print("************************")
 
         if not self.check_adequacy:
+            self.cache_answer(query, query_emb, kb_version, answer)
             self.manage_history(hist, sources, prompt_id)
             return answer, sources, likely_sources, prompt_id
 
@@ -980,5 +1019,6 @@ class KMOAI_Agent:
             if adequate == "no":
                 return DEFAULT_RESPONSE, [], [], prompt_id
 
+        self.cache_answer(query, query_emb, kb_version, answer)
         self.manage_history(hist, sources, prompt_id)
         return answer, sources, likely_sources, prompt_id
@@ -1,23 +1,126 @@
+import hashlib
 import logging
 import os
+import threading
 import typing
 import uuid
+from collections import OrderedDict
 
 import requests
 from azure.ai.textanalytics import TextAnalyticsClient
 from azure.core.credentials import AzureKeyCredential
 
+from utils import redis_helpers
 from utils.env_vars import *
 
-
-def detect_content_language(content):
-    path = "/detect"
-    constructed_url = TRANSLATION_ENDPOINT + path
-
-    params = {
-        "api-version": "3.0",
-    }
-
+TRANSLATOR_MAX_ELEMENTS = {"detect": 100, "translate": 1000}
+TRANSLATOR_MAX_CHARS = 50000
+TRANSLATION_CACHE_PREFIX = "translation_cache:"
+
+translator_session = requests.Session()
+translator_session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+)
+
+
+class TranslationCache:
+    def __init__(self, capacity=TRANSLATION_CACHE_CAPACITY, ttl=CONVERSATION_TTL_SECS):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.redis_conn = None
+        self.redis_checked = False
+
+    def get_redis_conn(self):
+        if not self.redis_checked:
+            self.redis_checked = True
+            try:
+                self.redis_conn = redis_helpers.get_new_conn()
+            except Exception as e:
+                logging.warning(f"Translation cache running without Redis: {e}")
+
+        return self.redis_conn
+
+    def get_many(self, keys):
+        values = [None] * len(keys)
+
+        with self.lock:
+            for i, k in enumerate(keys):
+                if k in self.entries:
+                    self.entries.move_to_end(k)
+                    values[i] = self.entries[k]
+
+        missing = [i for i, v in enumerate(values) if v is None]
+        redis_conn = self.get_redis_conn()
+
+        if (redis_conn is not None) and (len(missing) > 0):
+            try:
+                redis_values = redis_conn.mget(
+                    [TRANSLATION_CACHE_PREFIX + keys[i] for i in missing]
+                )
+                for i, v in zip(missing, redis_values):
+                    if v is not None:
+                        values[i] = v.decode("utf-8")
+                        self.set_local(keys[i], values[i])
+            except Exception as e:
+                logging.warning(f"Translation cache Redis lookup failed: {e}")
+
+        return values
+
+    def set_local(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def set_many(self, keys, values):
+        for k, v in zip(keys, values):
+            self.set_local(k, v)
+
+        redis_conn = self.get_redis_conn()
+
+        if redis_conn is not None:
+            try:
+                p = redis_conn.pipeline(transaction=False)
+                for k, v in zip(keys, values):
+                    p.set(TRANSLATION_CACHE_PREFIX + k, v, ex=self.ttl)
+                p.execute()
+            except Exception as e:
+                logging.warning(f"Translation cache Redis write failed: {e}")
+
+
+translation_cache = TranslationCache()
+
+
+def get_translation_cache_key(op, text, from_lang="", to_lang=""):
+    return hashlib.sha256(
+        f"{op}\n{from_lang}\n{to_lang}\n{text}".encode("utf-8")
+    ).hexdigest()
+
+
+def get_translator_batches(texts, op):
+    batch = []
+    batch_chars = 0
+
+    for i, t in enumerate(texts):
+        if (len(batch) > 0) and (
+            (batch_chars + len(t) > TRANSLATOR_MAX_CHARS)
+            or (len(batch) >= TRANSLATOR_MAX_ELEMENTS[op])
+        ):
+            yield batch
+            batch = []
+            batch_chars = 0
+
+        batch.append(i)
+        batch_chars += len(t)
+
+    if len(batch) > 0:
+        yield batch
+
+
+def call_translator(path, params, texts):
     headers = {
         "Ocp-Apim-Subscription-Key": TRANSLATION_API_KEY,
         "Ocp-Apim-Subscription-Region": TRANSLATION_LOCATION,
@@ -25,42 +128,78 @@ def detect_content_language(content):
         "X-ClientTraceId": str(uuid.uuid4()),
     }
 
-    # You can pass more than one object in body.
-    body = [{"text": content}]
+    body = [{"text": t} for t in texts]
 
-    request = requests.post(constructed_url, params=params, headers=headers, json=body)
-    response = request.json()
+    request = translator_session.post(
+        TRANSLATION_ENDPOINT + path, params=params, headers=headers, json=body
+    )
+    return request.json()
 
-    try:
-        lang = response[0]["language"]
-        return lang
-    except:
-        return "xx"
 
+def run_cached_translator_op(
+    texts, op, path, params, parse_item, from_lang="", to_lang=""
+):
+    keys = [get_translation_cache_key(op, t, from_lang, to_lang) for t in texts]
+    results = translation_cache.get_many(keys)
 
-def translate(text, from_lang, to_lang="en"):
-    path = "/translate"
-    constructed_url = TRANSLATION_ENDPOINT + path
-    body = [{"text": text}]
+    missing = [i for i, r in enumerate(results) if r is None]
+    missing_texts = [texts[i] for i in missing]
 
-    params = {"api-version": "3.0", "from": from_lang, "to": [to_lang]}
+    for batch in get_translator_batches(missing_texts, op):
+        batch_texts = [missing_texts[i] for i in batch]
+        response = call_translator(path, params, batch_texts)
 
-    headers = {
-        "Ocp-Apim-Subscription-Key": TRANSLATION_API_KEY,
-        "Ocp-Apim-Subscription-Region": TRANSLATION_LOCATION,
-        "Content-type": "application/json",
-        "X-ClientTraceId": str(uuid.uuid4()),
-    }
+        new_keys = []
+        new_values = []
+
+        for j, i in enumerate(batch):
+            try:
+                value = parse_item(response[j])
+                new_keys.append(keys[missing[i]])
+                new_values.append(value)
+            except Exception as e:
+                print(f"Translator {op} failed: {e} - {response}")
+                value = None
+
+            results[missing[i]] = value
 
-    request = requests.post(constructed_url, params=params, headers=headers, json=body)
-    response = request.json()
+        translation_cache.set_many(new_keys, new_values)
 
-    try:
-        # print(response)
-        return response[0]["translations"][0]["text"]
-    except Exception as e:
-        print(e)
-        return response
+    return results
+
+
+def detect_content_languages(contents):
+    results = run_cached_translator_op(
+        contents,
+        "detect",
+        "/detect",
+        {"api-version": "3.0"},
+        lambda r: r["language"],
+    )
+
+    return [r if r is not None else "xx" for r in results]
+
+
+def translate_batch(texts, from_lang, to_lang="en"):
+    results = run_cached_translator_op(
+        texts,
+        "translate",
+        "/translate",
+        {"api-version": "3.0", "from": from_lang, "to": [to_lang]},
+        lambda r: r["translations"][0]["text"],
+        from_lang,
+        to_lang,
+    )
+
+    return [r if r is not None else t for r, t in zip(results, texts)]
+
+
+def detect_content_language(content):
+    return detect_content_languages([content])[0]
+
+
+def translate(text, from_lang, to_lang="en"):
+    return translate_batch([text], from_lang, to_lang)[0]
 
 
 def extract_entities(text):
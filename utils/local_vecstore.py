@@ -0,0 +1,383 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils import openai_helpers
+from utils.env_vars import *
+
+VECTOR_FIELDS = [VECTOR_FIELD_IN_REDIS, "cv_image_vector", "cv_text_vector"]
+
+filter_clause_regex = re.compile(r"@(\w+):(\{[^}]*\}|[^\s()|]+)")
+filter_token_regex = re.compile(r"@\w+:(?:\{[^}]*\}|[^\s()|]+)|[()|]")
+
+
+class LocalVectorStore:
+    def __init__(self, store_dir, dims, initial_capacity=NUMBER_PRODUCTS_INDEX):
+        os.makedirs(store_dir, exist_ok=True)
+        self.vectors_file = os.path.join(store_dir, "vectors.npy")
+        self.metadata_file = os.path.join(store_dir, "metadata.json")
+        # the API and ingestion workers share the files, writes hold this lock
+        # exclusively and searches hold it shared
+        self.lock_file = open(os.path.join(store_dir, "store.lock"), "a")
+        self.lock = threading.Lock()
+        self.reset()
+
+        with self.locked(fcntl.LOCK_EX):
+            if os.path.exists(self.vectors_file) and os.path.exists(self.metadata_file):
+                self.vectors = np.lib.format.open_memmap(self.vectors_file, mode="r+")
+                self.load_metadata()
+            else:
+                self.vectors = np.lib.format.open_memmap(
+                    self.vectors_file,
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(max(initial_capacity, 1), dims),
+                )
+                self.write_snapshot()
+
+            self.disk_version = self.get_disk_version()
+
+    @contextmanager
+    def locked(self, operation):
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def reset(self):
+        self.count = 0
+        self.columns = {"id": []}
+        self.rows = {}
+        self.generation = 0
+        self.journal_size = 0
+        self.journal_offset = 0
+
+    def get_journal_file(self, generation):
+        return os.path.join(
+            os.path.dirname(self.metadata_file), f"metadata.{generation}.jsonl"
+        )
+
+    def get_disk_version(self):
+        # snapshots and grown matrices are moved into place, so they show up as
+        # a new file, while the journal of a generation only ever grows
+        metadata = os.stat(self.metadata_file)
+        vectors = os.stat(self.vectors_file)
+        journal_file = self.get_journal_file(self.generation)
+        journal_size = (
+            os.path.getsize(journal_file) if os.path.exists(journal_file) else 0
+        )
+        return (
+            (metadata.st_ino, metadata.st_mtime_ns),
+            (vectors.st_ino, vectors.st_size),
+            journal_size,
+        )
+
+    def refresh(self):
+        version = self.get_disk_version()
+        if version == self.disk_version:
+            return
+
+        if version[1] != self.disk_version[1]:
+            del self.vectors
+            self.vectors = np.lib.format.open_memmap(self.vectors_file, mode="r+")
+
+        if version[0] != self.disk_version[0]:
+            self.reset()
+            self.load_metadata()
+        else:
+            self.replay_journal()
+
+        self.disk_version = self.get_disk_version()
+
+    def load_metadata(self):
+        with open(self.metadata_file, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        self.generation = snapshot["generation"]
+        self.columns = snapshot["columns"]
+        self.count = len(self.columns["id"])
+        self.rows = {i: r for r, i in enumerate(self.columns["id"])}
+        self.replay_journal()
+
+    def replay_journal(self):
+        # the vectors file already holds the final rows, the journal only
+        # replays the metadata changes made since the snapshot
+        journal_file = self.get_journal_file(self.generation)
+        if not os.path.exists(journal_file):
+            return
+
+        with open(journal_file, "r", encoding="utf-8") as f:
+            f.seek(self.journal_offset)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a write cut short by a crash
+                    break
+                if "delete" in record:
+                    self.remove_row(record["delete"])
+                else:
+                    self.set_row(record["upsert"])
+                self.journal_size += 1
+                self.journal_offset += len(line.encode("utf-8"))
+
+    def write_snapshot(self):
+        # a new generation starts with the snapshot, the old journal is only
+        # removed once the snapshot that replaces it is in place
+        generation = self.generation + 1
+        tmp_file = self.metadata_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"generation": generation, "columns": self.columns}, f)
+        os.replace(tmp_file, self.metadata_file)
+
+        old_journal_file = self.get_journal_file(self.generation)
+        if os.path.exists(old_journal_file):
+            os.remove(old_journal_file)
+
+        self.generation = generation
+        self.journal_size = 0
+        self.journal_offset = 0
+
+    def grow(self, capacity):
+        # the grown matrix is written next to the current one and moved into
+        # place, a crash midway leaves the current file intact
+        tmp_file = self.vectors_file + ".tmp.npy"
+        vectors = np.lib.format.open_memmap(
+            tmp_file,
+            mode="w+",
+            dtype=np.float32,
+            shape=(capacity, self.vectors.shape[1]),
+        )
+        vectors[: self.count] = self.vectors[: self.count]
+        vectors.flush()
+        del vectors
+
+        del self.vectors
+        os.replace(tmp_file, self.vectors_file)
+        self.vectors = np.lib.format.open_memmap(self.vectors_file, mode="r+")
+
+    def flush(self, records):
+        self.vectors.flush()
+
+        if self.journal_size + len(records) > max(self.count, NUMBER_PRODUCTS_INDEX):
+            self.write_snapshot()
+            return
+
+        # appending keeps a flush proportional to the batch, the snapshot is only
+        # rewritten once the journal outgrows the store
+        with open(self.get_journal_file(self.generation), "a", encoding="utf-8") as f:
+            for r in records:
+                line = json.dumps(r) + "\n"
+                f.write(line)
+                self.journal_offset += len(line.encode("utf-8"))
+        self.journal_size += len(records)
+
+    def set_row(self, metadata):
+        row = self.rows.get(metadata["id"], None)
+
+        if row is None:
+            row = self.count
+            self.count += 1
+            self.rows[metadata["id"]] = row
+            for c in self.columns.values():
+                c.append("")
+
+        for k, v in metadata.items():
+            if k not in self.columns:
+                self.columns[k] = [""] * self.count
+            self.columns[k][row] = v
+
+        return row
+
+    def remove_row(self, doc_id):
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return None
+
+        # the last row is moved into the freed slot to keep rows dense
+        last = self.count - 1
+        if row != last:
+            for c in self.columns.values():
+                c[row] = c[last]
+            self.rows[self.columns["id"][row]] = row
+        for c in self.columns.values():
+            c.pop()
+
+        self.count -= 1
+        return row, last
+
+    def upsert(self, emb_documents):
+        with self.lock, self.locked(fcntl.LOCK_EX):
+            self.refresh()
+            records = []
+
+            for e in emb_documents:
+                metadata = {}
+                for k, v in e.items():
+                    if k in VECTOR_FIELDS:
+                        continue
+                    if isinstance(v, list):
+                        v = ", ".join([str(x) for x in v])
+                    metadata[k] = str(v)
+
+                if (e["id"] not in self.rows) and (self.count >= self.vectors.shape[0]):
+                    self.grow(self.vectors.shape[0] * 2)
+                row = self.set_row(metadata)
+
+                vector = np.array(e[VECTOR_FIELD_IN_REDIS], dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                self.vectors[row] = vector / norm if norm > 0 else vector
+
+                records.append({"upsert": metadata})
+
+            self.flush(records)
+            self.disk_version = self.get_disk_version()
+
+        return len(emb_documents)
+
+    def delete(self, ids):
+        with self.lock, self.locked(fcntl.LOCK_EX):
+            self.refresh()
+            records = []
+
+            for i in ids:
+                moved = self.remove_row(i)
+                if moved is None:
+                    continue
+
+                row, last = moved
+                if row != last:
+                    self.vectors[row] = self.vectors[last]
+
+                records.append({"delete": i})
+
+            self.flush(records)
+            self.disk_version = self.get_disk_version()
+
+        return len(records)
+
+    def get_clause_mask(self, clause):
+        field, value = filter_clause_regex.fullmatch(clause).groups()
+        values = value.strip("{}").replace("\\", "").split("|")
+        column = self.columns.get(field, [""] * self.count)
+        return np.isin(np.array(column, dtype=object), values)
+
+    def get_filter_mask(self, filter_param):
+        if (filter_param is None) or (filter_param.strip() in ["", "*"]):
+            return np.ones(self.count, dtype=bool)
+
+        if not filter_param.startswith("@"):
+            filter_param = "@" + filter_param
+
+        # the same subset of the RediSearch syntax the agents send: clauses next
+        # to each other are ANDed, | ORs them and parentheses group them
+        tokens = filter_token_regex.findall(filter_param)
+        if (len(tokens) == 0) or (
+            filter_token_regex.sub("", filter_param).strip() != ""
+        ):
+            raise ValueError(
+                f"Unsupported filter for the local vector store: {filter_param}"
+            )
+
+        pos = 0
+
+        def parse_or():
+            nonlocal pos
+            mask = parse_and()
+            while (pos < len(tokens)) and (tokens[pos] == "|"):
+                pos += 1
+                mask = mask | parse_and()
+            return mask
+
+        def parse_and():
+            nonlocal pos
+            mask = None
+            while (pos < len(tokens)) and (tokens[pos] not in ["|", ")"]):
+                if tokens[pos] == "(":
+                    pos += 1
+                    clause_mask = parse_or()
+                    if (pos >= len(tokens)) or (tokens[pos] != ")"):
+                        raise ValueError(f"Unbalanced parentheses in {filter_param}")
+                    pos += 1
+                else:
+                    clause_mask = self.get_clause_mask(tokens[pos])
+                    pos += 1
+                mask = clause_mask if mask is None else mask & clause_mask
+            if mask is None:
+                raise ValueError(f"Empty clause in {filter_param}")
+            return mask
+
+        mask = parse_or()
+        if pos != len(tokens):
+            raise ValueError(f"Unbalanced parentheses in {filter_param}")
+
+        return mask
+
+    def query(self, query_emb, t_id, topK=5, filter_param=None, fields=None):
+        with self.lock, self.locked(fcntl.LOCK_SH):
+            self.refresh()
+            if self.count == 0:
+                return []
+
+            if fields is None:
+                fields = [f for f in self.columns.keys() if f != "id"]
+
+            query_vector = np.array(query_emb, dtype=np.float32)
+            query_vector /= np.linalg.norm(query_vector)
+
+            scores = self.vectors[: self.count] @ query_vector
+            candidates = np.nonzero(self.get_filter_mask(filter_param))[0]
+            if len(candidates) == 0:
+                return []
+
+            k = min(topK + 1, len(candidates))
+            top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            top = top[np.argsort(-scores[top])]
+
+            results = []
+            for row in top:
+                doc_id = self.columns["id"][row]
+                if doc_id == t_id:
+                    continue
+                r = {"id": doc_id}
+                for f in fields:
+                    if f in self.columns:
+                        r[f] = self.columns[f][row]
+                # same cosine distance the Redis index reports
+                r["vector_score"] = str(1 - float(scores[row]))
+                results.append(r)
+
+            return results[:topK]
+
+
+local_vecstore = None
+local_vecstore_lock = threading.Lock()
+
+
+def get_local_vecstore():
+    global local_vecstore
+
+    with local_vecstore_lock:
+        if local_vecstore is None:
+            local_vecstore = LocalVectorStore(
+                LOCAL_VECSTORE_DIR, openai_helpers.get_model_dims(CHOSEN_EMB_MODEL)
+            )
+            logging.info(
+                f"Opened local vector store in {LOCAL_VECSTORE_DIR} with {local_vecstore.count} embeddings"
+            )
+
+    return local_vecstore
+
+
+def query_embedding_index(
+    store, query_emb, t_id, topK=5, filter_param=None, fields=None
+):
+    return store.query(
+        query_emb, t_id, topK=topK, filter_param=filter_param, fields=fields
+    )
@@ -215,6 +215,52 @@ def get_openai_embedding(query, embedding_model=CHOSEN_EMB_MODEL):
     ]["embedding"]
 
 
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(30))
+def get_openai_embeddings_batch(texts, embedding_model=CHOSEN_EMB_MODEL):
+    resp = openai.Embedding.create(input=texts, engine=embedding_deployment_id)
+    data = sorted(resp["data"], key=lambda d: d["index"])
+    return [d["embedding"] for d in data]
+
+
+def get_embedding_batches(
+    token_lengths, max_batch_tokens=EMB_BATCH_MAX_TOKENS, max_batch_size=EMB_BATCH_SIZE
+):
+    batch = []
+    batch_tokens = 0
+
+    for i, n in enumerate(token_lengths):
+        if (len(batch) > 0) and (
+            (batch_tokens + n > max_batch_tokens) or (len(batch) >= max_batch_size)
+        ):
+            yield batch
+            batch = []
+            batch_tokens = 0
+
+        batch.append(i)
+        batch_tokens += n
+
+    if len(batch) > 0:
+        yield batch
+
+
+def get_openai_embeddings(texts, embedding_model=CHOSEN_EMB_MODEL, verbose=False):
+    enc = get_encoder(embedding_model)
+    token_lengths = [len(enc.encode(t)) for t in texts]
+    embeddings = [None] * len(texts)
+
+    for batch in get_embedding_batches(token_lengths):
+        batch_embs = get_openai_embeddings_batch(
+            [texts[i] for i in batch], embedding_model
+        )
+        for i, emb in zip(batch, batch_embs):
+            embeddings[i] = emb
+
+        if verbose:
+            print(f"Embedded batch of {len(batch)} texts")
+
+    return embeddings
+
+
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(20))
 def openai_summarize(
     text, completion_model, max_output_tokens=MAX_OUTPUT_TOKENS, lang="en"
@@ -1,14 +1,22 @@
 import copy
 import logging
 import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import redis
 from redis import Redis
 from redis.commands.search.field import TagField, TextField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition
 from redis.commands.search.query import Query
 from redis.commands.search.result import Result
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from tenacity import (retry, retry_if_not_exception_type, stop_after_attempt,
+                      wait_random_exponential)
 
 from utils.env_vars import *
 from utils.kb_doc import KB_Doc
@@ -16,10 +24,18 @@ from utils.kb_doc import KB_Doc
 ## https://redis-py.readthedocs.io/en/stable/commands.html
 ## https://redis.io/docs/stack/search/reference/query_syntax/
 
-
-
-
-
+# reads a field of each key and refreshes the expiry of keys that have one,
+# ARGV holds the new expiry followed by one field per key
+GET_AND_TOUCH_SCRIPT = """
+local values = {}
+for i, key in ipairs(KEYS) do
+    values[i] = redis.call("HGET", key, ARGV[i + 1])
+    if redis.call("TTL", key) > 0 then
+        redis.call("EXPIRE", key, ARGV[1])
+    end
+end
+return values
+"""
 
 
 def get_model_dims(embedding_model):
@@ -31,35 +47,168 @@ def get_model_dims(embedding_model):
         return ADA_002_EMBED_NUM_DIMS
 
 
+def get_vector_dtype(vector_type=REDIS_VECTOR_TYPE):
+    if vector_type == "FLOAT16":
+        return np.float16
+    else:
+        return np.float32
+
+
+# filterable metadata is indexed as exact-match tags, large text and urls are
+# left out of the schema and only stored as plain hash fields for RETURN
+REDIS_TAG_FIELDS = [
+    "access",
+    "client",
+    "container",
+    "filename",
+    "orig_lang",
+    "contentType",
+]
+REDIS_UNSTORED_ZERO_VECTORS = ["cv_image_vector", "cv_text_vector"]
+
+
+def get_text_fields():
+    # hybrid search needs the english chunk text in the inverted index for BM25
+    return ["text_en"] if REDIS_HYBRID_SEARCH == 1 else []
+
+
+def get_metadata_fields():
+    return [TagField(f) for f in REDIS_TAG_FIELDS] + [
+        TextField(f) for f in get_text_fields()
+    ]
+
+
+def get_index_field_types(info):
+    field_types = {}
+
+    for attr in info.get("attributes", []):
+        attr = [a.decode("utf-8") if isinstance(a, bytes) else a for a in attr]
+        attr = dict(zip(attr[0::2], attr[1::2]))
+        field_types[attr["attribute"]] = attr["type"]
+
+    return field_types
+
+
+def is_legacy_index(info):
+    field_types = get_index_field_types(info)
+    return any([field_types.get(f, "TAG") != "TAG" for f in REDIS_TAG_FIELDS]) or (
+        "text" in field_types
+    )
+
+
+INDEX_CONFIG_PREFIX = "index_config:"
+index_configs = {}
+
+
+def get_index_algorithm(number_of_vectors, algorithm=REDIS_INDEX_ALGORITHM):
+    if algorithm == "AUTO":
+        return "FLAT" if number_of_vectors <= REDIS_FLAT_MAX_VECTORS else "HNSW"
+    else:
+        return algorithm
+
+
+def get_index_config(redis_conn, index_name=REDIS_INDEX_NAME):
+    # shards are separate nodes, each one is asked about its own index
+    cached = index_configs.get((redis_conn, index_name), None)
+    # another worker may have swapped a rebuilt index in behind the alias
+    if (cached is not None) and (time.time() - cached[1] < REDIS_INDEX_CHECK_SECS):
+        return cached[0]
+
+    # the config is recorded under the index the alias points at
+    config_name = index_name
+    if index_name == REDIS_INDEX_NAME:
+        config_name = get_aliased_index(redis_conn) or index_name
+    config = redis_conn.hgetall(INDEX_CONFIG_PREFIX + config_name)
+    config = {k.decode("utf-8"): v.decode("utf-8") for k, v in config.items()}
+    # indexes created before the config was recorded are HNSW
+    if len(config) == 0:
+        config = {"algorithm": "HNSW"}
+    index_configs[(redis_conn, index_name)] = (config, time.time())
+
+    return config
+
+
+def forget_index_config(index_name):
+    for k in [k for k in list(index_configs.keys()) if k[1] == index_name]:
+        index_configs.pop(k, None)
+
+
+def get_index_vector_type(redis_conn, info=None):
+    # newer RediSearch versions report the type of the vector field, older ones
+    # fall back to the type recorded when the index was created
+    for attr in [] if info is None else info.get("attributes", []):
+        attr = [a.decode("utf-8") if isinstance(a, bytes) else a for a in attr]
+        attr = dict(zip(attr[0::2], attr[1::2]))
+        if (attr.get("attribute") == VECTOR_FIELD_IN_REDIS) and ("data_type" in attr):
+            return str(attr["data_type"]).upper()
+
+    # indexes created before the type was recorded are FLOAT32
+    return get_index_config(redis_conn).get("vector_type", "FLOAT32")
+
+
+def get_query_dtype(redis_conn):
+    # queries match the index being served, which differs from REDIS_VECTOR_TYPE
+    # until a converted index is swapped in
+    return get_vector_dtype(get_index_vector_type(redis_conn))
+
+
+def get_query_vector(redis_conn, query_emb):
+    return np.array(query_emb).astype(get_query_dtype(redis_conn)).tobytes()
+
+
+def get_ef_runtime(redis_conn):
+    if get_index_config(redis_conn)["algorithm"] == "HNSW":
+        return REDIS_HNSW_EF_RUNTIME
+    return None
+
+
 def create_search_index(
     redis_new_conn,
     vector_field_name,
     number_of_vectors,
     vector_dimensions=512,
     distance_metric="L2",
+    vector_type=REDIS_VECTOR_TYPE,
+    index_name=REDIS_INDEX_NAME,
+    prefix=None,
+    algorithm=REDIS_INDEX_ALGORITHM,
+    m=REDIS_HNSW_M,
+    ef_construction=REDIS_HNSW_EF_CONSTRUCTION,
 ):
     if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
         return None
 
-    M = 40
-    EF = 200
+    algorithm = get_index_algorithm(number_of_vectors, algorithm)
+    attributes = {
+        "TYPE": vector_type,
+        "DIM": vector_dimensions,
+        "DISTANCE_METRIC": distance_metric,
+        "INITIAL_CAP": number_of_vectors,
+    }
+    config = {"algorithm": algorithm, "vector_type": vector_type}
+
+    if algorithm == "HNSW":
+        attributes.update({"M": m, "EF_CONSTRUCTION": ef_construction})
+        config.update({"m": m, "ef_construction": ef_construction})
 
     fields = [
-        VectorField(
-            vector_field_name,
-            "HNSW",
-            {
-                "TYPE": "FLOAT32",
-                "DIM": vector_dimensions,
-                "DISTANCE_METRIC": distance_metric,
-                "INITIAL_CAP": number_of_vectors,
-                "M": M,
-                "EF_CONSTRUCTION": EF,
-            },
+        VectorField(vector_field_name, algorithm, attributes)
+    ] + get_metadata_fields()
+
+    if prefix is None:
+        redis_new_conn.ft(index_name).create_index(fields)
+    else:
+        redis_new_conn.ft(index_name).create_index(
+            fields, definition=IndexDefinition(prefix=[prefix])
         )
-    ] + [TextField(f) for f in KB_Doc().get_fields() if f != VECTOR_FIELD_IN_REDIS]
 
-    redis_new_conn.ft(REDIS_INDEX_NAME).create_index(fields)
+    p = redis_new_conn.pipeline(transaction=True)
+    p.delete(INDEX_CONFIG_PREFIX + index_name)
+    p.hset(INDEX_CONFIG_PREFIX + index_name, mapping=config)
+    p.execute()
+    forget_index_config(index_name)
+
+    logging.info(f"Created Redis index {index_name} with {config}")
 
 
 def flush_cached_values_only():
@@ -77,76 +226,473 @@ def flush_cached_values_only():
             redis_conn.expire(name=k, time=1)
 
 
-def redis_reset_index(redis_new_conn):
-    # flush all data
-    redis_new_conn.flushall()
+def get_new_index_name():
+    return f"{REDIS_INDEX_NAME}_{uuid.uuid4().hex[:8]}"
+
+
+def get_aliased_index(redis_new_conn):
+    # REDIS_INDEX_NAME is an alias, queries keep using it while rebuilt indexes
+    # are swapped in behind it
+    try:
+        index_name = redis_new_conn.ft(REDIS_INDEX_NAME).info()["index_name"]
+    except redis.exceptions.ResponseError as e:
+        if is_missing_index_error(e):
+            return None
+        raise
 
-    # create flat index & load vectors
+    return index_name.decode("utf-8") if isinstance(index_name, bytes) else index_name
+
+
+def redis_drop_index(redis_new_conn, index_name):
+    # without DD the hashes stay, they are shared by every index
+    redis_new_conn.ft(index_name).dropindex(delete_documents=False)
+    redis_new_conn.delete(INDEX_CONFIG_PREFIX + index_name)
+
+
+def redis_create_index(redis_new_conn, number_of_vectors=NUMBER_PRODUCTS_INDEX):
+    index_name = get_new_index_name()
     create_search_index(
         redis_new_conn,
         VECTOR_FIELD_IN_REDIS,
-        NUMBER_PRODUCTS_INDEX,
+        number_of_vectors,
         get_model_dims(CHOSEN_EMB_MODEL),
         "COSINE",
+        index_name=index_name,
     )
 
+    try:
+        redis_new_conn.ft(index_name).aliasadd(REDIS_INDEX_NAME)
+    except redis.exceptions.ResponseError as e:
+        # another worker created the index first
+        logging.info(f"Redis index {REDIS_INDEX_NAME} already exists: {e}")
+        redis_drop_index(redis_new_conn, index_name)
+        return None
+
+    return index_name
+
+
+def redis_swap_index(redis_new_conn, index_name):
+    if get_aliased_index(redis_new_conn) == REDIS_INDEX_NAME:
+        # indexes created before aliases were used hold the name themselves, it is
+        # only missing between this drop and the alias update below
+        redis_drop_index(redis_new_conn, REDIS_INDEX_NAME)
+
+    previous = get_aliased_index(redis_new_conn)
+    redis_new_conn.ft(index_name).aliasupdate(REDIS_INDEX_NAME)
+    forget_index_config(REDIS_INDEX_NAME)
+
+    if (previous is not None) and (previous != index_name):
+        redis_drop_index(redis_new_conn, previous)
+
+
+def wait_for_indexing(redis_new_conn, index_name, lock_token=None):
+    while int(redis_new_conn.ft(index_name).info().get("indexing", 0)) == 1:
+        if lock_token is not None:
+            redis_new_conn.set(
+                INDEX_REBUILD_LOCK_KEY,
+                lock_token,
+                xx=True,
+                ex=REDIS_INDEX_REBUILD_LOCK_TTL_SECS,
+            )
+        time.sleep(1)
+
 
 def test_redis(redis_new_conn):
     if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
         return None
 
     try:
-        out = redis_new_conn.ft(REDIS_INDEX_NAME).info()
+        info = redis_new_conn.ft(REDIS_INDEX_NAME).info()
         # print(f"Found Redis Index {REDIS_INDEX_NAME}")
-    except Exception as e:
+    except redis.exceptions.ResponseError as e:
+        if not is_missing_index_error(e):
+            logging.error(f"Failed to check Redis index {REDIS_INDEX_NAME}: {e}")
+            return
         # print(f"Redis Index {REDIS_INDEX_NAME} not found. Creating a new index.")
         logging.error(
             f"Redis Index {REDIS_INDEX_NAME} not found. Creating a new index."
         )
-        redis_reset_index(redis_new_conn)
+        redis_create_index(redis_new_conn)
+        return
+    except Exception as e:
+        logging.error(f"Failed to check Redis index {REDIS_INDEX_NAME}: {e}")
+        return
+
+    try:
+        vector_type = get_index_vector_type(redis_new_conn, info)
+        if is_legacy_index(info):
+            start_background_rebuild(
+                redis_new_conn, migrate=True, convert_from=vector_type
+            )
+        elif vector_type != REDIS_VECTOR_TYPE:
+            start_background_rebuild(redis_new_conn, convert_from=vector_type)
+        elif needs_hnsw_index(redis_new_conn) or needs_text_index(info):
+            start_background_rebuild(redis_new_conn)
+    except Exception as e:
+        print(f"Failed to rebuild Redis index {REDIS_INDEX_NAME}: {e}")
+        logging.error(f"Failed to rebuild Redis index {REDIS_INDEX_NAME}: {e}")
+
+
+def needs_hnsw_index(redis_new_conn):
+    if REDIS_INDEX_ALGORITHM != "AUTO":
+        return False
+
+    if get_index_config(redis_new_conn)["algorithm"] != "FLAT":
+        return False
+
+    num_vectors = redis_count_vectors(redis_new_conn, REDIS_FLAT_MAX_VECTORS + 1)
+    return num_vectors > REDIS_FLAT_MAX_VECTORS
+
+
+def needs_text_index(info):
+    return (REDIS_HYBRID_SEARCH == 1) and ("text_en" not in get_index_field_types(info))
+
+
+INDEX_REBUILD_LOCK_KEY = "index_rebuild:lock"
+
+
+def start_background_rebuild(redis_new_conn, migrate=False, convert_from=None):
+    # one worker per node rebuilds, the others keep querying the current index
+    lock_token = str(uuid.uuid4())
+    if not redis_new_conn.set(
+        INDEX_REBUILD_LOCK_KEY,
+        lock_token,
+        nx=True,
+        ex=REDIS_INDEX_REBUILD_LOCK_TTL_SECS,
+    ):
+        return False
+
+    def run():
+        try:
+            if migrate:
+                redis_migrate_index(
+                    redis_new_conn, lock_token=lock_token, convert_from=convert_from
+                )
+            else:
+                redis_rebuild_index(
+                    redis_new_conn, lock_token=lock_token, convert_from=convert_from
+                )
+        except Exception as e:
+            print(f"Failed to rebuild Redis index {REDIS_INDEX_NAME}: {e}")
+            logging.error(f"Failed to rebuild Redis index {REDIS_INDEX_NAME}: {e}")
+        finally:
+            if redis_new_conn.get(INDEX_REBUILD_LOCK_KEY) == lock_token.encode("utf-8"):
+                redis_new_conn.delete(INDEX_REBUILD_LOCK_KEY)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    return True
+
+
+def redis_convert_vectors(redis_new_conn, from_type, batch_size=REDIS_BULK_BATCH_SIZE):
+    # hashes written since REDIS_VECTOR_TYPE changed already hold the new type,
+    # the byte length tells them apart
+    from_dtype = get_vector_dtype(from_type)
+    from_bytes = get_model_dims(CHOSEN_EMB_MODEL) * np.dtype(from_dtype).itemsize
+    converted = 0
+    p = redis_new_conn.pipeline(transaction=False)
+    keys = []
+
+    def convert(keys):
+        for k in keys:
+            p.hget(k, VECTOR_FIELD_IN_REDIS)
+        values = p.execute()
+
+        for k, v in zip(keys, values):
+            if (v is not None) and (len(v) == from_bytes):
+                v = np.frombuffer(v, dtype=from_dtype).astype(get_vector_dtype())
+                p.hset(k, VECTOR_FIELD_IN_REDIS, v.tobytes())
+        return len(p.execute())
+
+    for k in redis_new_conn.scan_iter(count=batch_size, _type="HASH"):
+        keys.append(k)
+        if len(keys) >= batch_size:
+            converted += convert(keys)
+            keys = []
+
+    if len(keys) > 0:
+        converted += convert(keys)
+
+    return converted
+
+
+def redis_rebuild_index(redis_new_conn, lock_token=None, convert_from=None):
+    # counting past the FLAT limit is enough to pick the algorithm, HNSW grows
+    # beyond its initial capacity
+    num_vectors = redis_count_vectors(
+        redis_new_conn, max(NUMBER_PRODUCTS_INDEX, REDIS_FLAT_MAX_VECTORS + 1)
+    )
+
+    if (convert_from is not None) and (convert_from != REDIS_VECTOR_TYPE):
+        # the current index stops matching each chunk once it is converted, the
+        # rebuilt one below picks them all up
+        start = time.time()
+        converted = redis_convert_vectors(redis_new_conn, convert_from)
+        print(
+            f"Converted {converted} vectors from {convert_from} to {REDIS_VECTOR_TYPE} in {time.time() - start:.2f} secs"
+        )
+        logging.info(
+            f"Converted {converted} vectors from {convert_from} to {REDIS_VECTOR_TYPE} in {time.time() - start:.2f} secs"
+        )
+
+    # the new index is built next to the current one and swapped in once it has
+    # scanned every hash, so the alias never points at a missing or partial index
+    index_name = get_new_index_name()
+    create_search_index(
+        redis_new_conn,
+        VECTOR_FIELD_IN_REDIS,
+        max(num_vectors, NUMBER_PRODUCTS_INDEX),
+        get_model_dims(CHOSEN_EMB_MODEL),
+        "COSINE",
+        index_name=index_name,
+    )
+
+    try:
+        wait_for_indexing(redis_new_conn, index_name, lock_token)
+        redis_swap_index(redis_new_conn, index_name)
+    except Exception:
+        redis_drop_index(redis_new_conn, index_name)
+        raise
+
+    print(f"Rebuilt Redis index {REDIS_INDEX_NAME} as {index_name}")
+    logging.info(f"Rebuilt Redis index {REDIS_INDEX_NAME} as {index_name}")
+
+
+def redis_migrate_index(
+    redis_new_conn, batch_size=REDIS_BULK_BATCH_SIZE, lock_token=None, convert_from=None
+):
+    start = time.time()
+    redis_rebuild_index(redis_new_conn, lock_token, convert_from)
+
+    stripped = 0
+    p = redis_new_conn.pipeline(transaction=False)
+    keys = []
+
+    def strip_zero_vectors(keys):
+        for k in keys:
+            p.hmget(k, REDIS_UNSTORED_ZERO_VECTORS)
+        values = p.execute()
+
+        for k, vectors in zip(keys, values):
+            fields = [
+                f
+                for f, v in zip(REDIS_UNSTORED_ZERO_VECTORS, vectors)
+                if (v is not None) and (not np.frombuffer(v, dtype=np.float32).any())
+            ]
+            if len(fields) > 0:
+                p.hdel(k, *fields)
+        return sum([v for v in p.execute() if isinstance(v, int)])
+
+    for k in redis_new_conn.scan_iter(count=batch_size, _type="HASH"):
+        keys.append(k)
+        if len(keys) >= batch_size:
+            stripped += strip_zero_vectors(keys)
+            keys = []
+
+    if len(keys) > 0:
+        stripped += strip_zero_vectors(keys)
+
+    print(
+        f"Migrated Redis index {REDIS_INDEX_NAME} to the lean schema ({stripped} zero vectors removed) in {time.time() - start:.2f} secs"
+    )
+    logging.info(
+        f"Migrated Redis index {REDIS_INDEX_NAME} to the lean schema ({stripped} zero vectors removed) in {time.time() - start:.2f} secs"
+    )
+
+
+conn_clients = {}
+conn_clients_lock = threading.Lock()
+cache_scripts = {}
+client_cache_conn = None
+index_checked_at = {}
+index_checked_lock = threading.Lock()
+
+
+def get_conn(host, port):
+    # clients are shared per node, their pools are thread-safe and keep the TLS
+    # connections open across queries
+    with conn_clients_lock:
+        if (host, str(port)) not in conn_clients:
+            if REDIS_PASSWORD == "":
+                pool = redis.ConnectionPool(
+                    host=host,
+                    port=int(port),
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    health_check_interval=REDIS_HEALTH_CHECK_SECS,
+                )
+            else:
+                pool = redis.ConnectionPool(
+                    host=host,
+                    port=int(port),
+                    password=REDIS_PASSWORD,
+                    connection_class=redis.SSLConnection,
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    health_check_interval=REDIS_HEALTH_CHECK_SECS,
+                )
+            conn_clients[(host, str(port))] = Redis(connection_pool=pool)
+
+        return conn_clients[(host, str(port))]
+
+
+def get_client_cache_conn():
+    global client_cache_conn
+
+    if REDIS_CLIENT_CACHE_SIZE <= 0:
+        return None
+
+    with conn_clients_lock:
+        if client_cache_conn is None:
+            # RESP3 client-side caching needs redis-py 5.1 or later, the server
+            # pushes invalidations for the keys this client has read
+            try:
+                from redis.cache import CacheConfig
+
+                client_cache_conn = Redis(
+                    host=REDIS_ADDR,
+                    port=int(REDIS_PORT),
+                    password=REDIS_PASSWORD if REDIS_PASSWORD != "" else None,
+                    ssl=REDIS_PASSWORD != "",
+                    protocol=3,
+                    cache_config=CacheConfig(max_size=REDIS_CLIENT_CACHE_SIZE),
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    health_check_interval=REDIS_HEALTH_CHECK_SECS,
+                )
+            except Exception as e:
+                logging.warning(f"Redis client-side caching is not available: {e}")
+                client_cache_conn = False
+
+        return client_cache_conn if client_cache_conn else None
+
+
+def redis_ensure_index(redis_conn):
+    try:
+        if get_aliased_index(redis_conn) is not None:
+            return
+        logging.error(f"Redis Index {REDIS_INDEX_NAME} was lost. Creating a new index.")
+        redis_create_index(redis_conn)
+    except Exception as e:
+        logging.warning(f"Failed to recreate the Redis index: {e}")
+
+
+def check_index(redis_conn, force=False):
+    now = time.time()
+
+    with index_checked_lock:
+        checked_at = index_checked_at.get(redis_conn, None)
+        if (
+            (not force)
+            and (checked_at is not None)
+            and (now - checked_at < REDIS_INDEX_CHECK_SECS)
+        ):
+            return
+        index_checked_at[redis_conn] = now
+
+    # a forced check comes from a failed search, it only restores a lost index
+    if force:
+        redis_ensure_index(redis_conn)
+    else:
+        test_redis(redis_conn)
+
+
+def is_missing_index_error(e):
+    msg = str(e).lower()
+    return ("no such index" in msg) or ("unknown index" in msg)
 
 
 def get_new_conn():
     if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
         return None
 
-    if REDIS_PASSWORD == "":
-        redis_conn = Redis(host=REDIS_ADDR, port=REDIS_PORT)
-    else:
-        redis_conn = redis.StrictRedis(
-            host=REDIS_ADDR, port=int(REDIS_PORT), password=REDIS_PASSWORD, ssl=True
-        )
+    redis_conn = get_conn(REDIS_ADDR, REDIS_PORT)
 
     # print('Connected to redis', redis_conn)
-    test_redis(redis_conn)
+    check_index(redis_conn)
 
     return redis_conn
 
 
+shard_conns = None
+shard_executor = None
+shard_conns_lock = threading.Lock()
+
+
+def get_shard_conns():
+    global shard_conns, shard_executor
+
+    with shard_conns_lock:
+        if shard_conns is None:
+            conns = []
+            for shard in REDIS_SHARDS.split(","):
+                host, port = shard.strip().rsplit(":", 1)
+                conns.append(get_conn(host, port))
+
+            check_shard_layout(conns)
+            shard_executor = ThreadPoolExecutor(max_workers=len(conns))
+            shard_conns = conns
+
+    return shard_conns
+
+
+SHARD_LAYOUT_KEY = "shard_layout"
+
+
+def check_shard_layout(conns):
+    # keys are placed by crc32 modulo the shard count, a different count or
+    # order would look every existing chunk up on the wrong shard
+    for position, conn in enumerate(conns):
+        layout = f"{position}/{len(conns)}"
+        conn.set(SHARD_LAYOUT_KEY, layout, nx=True)
+        recorded = conn.get(SHARD_LAYOUT_KEY).decode("utf-8")
+        if recorded != layout:
+            raise Exception(
+                f"Redis shard {position} of REDIS_SHARDS was recorded as shard {recorded}, the data has to be rebalanced before the shard count or order changes"
+            )
+
+
+def get_index_conns(redis_conn):
+    if REDIS_SHARDS == "":
+        return [redis_conn]
+
+    conns = get_shard_conns()
+    for c in conns:
+        check_index(c)
+
+    return conns
+
+
+def get_shard(key, num_shards):
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    return zlib.crc32(key) % num_shards
+
+
+def group_by_shard(redis_conn, items, key_func=lambda i: i):
+    conns = get_index_conns(redis_conn)
+    groups = [[] for _ in conns]
+
+    for i in items:
+        groups[get_shard(key_func(i), len(conns))].append(i)
+
+    return [(c, g) for c, g in zip(conns, groups) if len(g) > 0]
+
+
+def run_on_shards(func, shard_args):
+    if len(shard_args) <= 1:
+        return [func(*a) for a in shard_args]
+
+    return list(shard_executor.map(lambda a: func(*a), shard_args))
+
+
 @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
 def redis_upsert_embedding(redis_conn, e_dict):
     if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
         return None
 
     try:
-        # embeds = np.array(e[VECTOR_FIELD_IN_REDIS]).astype(np.float32).tobytes()
-        # meta = {'text_en': e['text_en'], 'text':e['text'], 'doc_url': e['doc_url'], 'timestamp': e['timestamp'], VECTOR_FIELD_IN_REDIS:embeds}
-        e = copy.deepcopy(e_dict)
-
-        for k in e:
-            if isinstance(e[k], list) and (len(e[k]) > 0):
-                if isinstance(e[k][0], float):
-                    e[k] = np.array(e[k]).astype(np.float32).tobytes()
-                if isinstance(e[k][0], str):
-                    e[k] = ", ".join(e[k])
-
-        # e[VECTOR_FIELD_IN_REDIS] = np.array(e[VECTOR_FIELD_IN_REDIS]).astype(np.float32).tobytes()
+        e = get_embedding_mapping(e_dict)
+        conns = get_index_conns(redis_conn)
 
-        for k in e:
-            if isinstance(e[k], list):
-                print(e[k])
-
-        p = redis_conn.pipeline(transaction=False)
+        p = conns[get_shard(e["id"], len(conns))].pipeline(transaction=False)
         p.hset(e["id"], mapping=e)
         p.execute()
         return 1
@@ -157,41 +703,442 @@ def redis_upsert_embedding(redis_conn, e_dict):
         return 0
 
 
+def get_embedding_mapping(e_dict):
+    e = {}
+
+    for k, v in e_dict.items():
+        if (k in REDIS_UNSTORED_ZERO_VECTORS) and (not any(v)):
+            continue
+
+        if isinstance(v, np.ndarray):
+            dtype = get_vector_dtype() if k == VECTOR_FIELD_IN_REDIS else np.float32
+            v = v.astype(dtype).tobytes()
+        elif isinstance(v, list) and (len(v) > 0):
+            if k == VECTOR_FIELD_IN_REDIS:
+                v = np.array(v, dtype=get_vector_dtype()).tobytes()
+            elif isinstance(v[0], float):
+                v = np.array(v, dtype=np.float32).tobytes()
+            elif isinstance(v[0], str):
+                v = ", ".join(v)
+        e[k] = v
+
+    return e
+
+
+def encode_embedding_doc(e_dict):
+    vector = e_dict.get(VECTOR_FIELD_IN_REDIS, None)
+    if (vector is None) or (len(vector) != get_model_dims(CHOSEN_EMB_MODEL)):
+        raise ValueError(
+            f"Embedding document {e_dict.get('id', None)} has no valid vector"
+        )
+
+    return get_embedding_mapping(e_dict)
+
+
+@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
+def redis_execute_upsert_batch(redis_conn, mappings):
+    p = redis_conn.pipeline(transaction=False)
+    for e in mappings:
+        p.hset(e["id"], mapping=e)
+    p.execute()
+    return len(mappings)
+
+
+def redis_bulk_upsert_embeddings(
+    redis_conn, emb_documents, batch_size=REDIS_BULK_BATCH_SIZE, document_name=""
+):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return 0, []
+
+    loaded = 0
+    failed_ids = []
+    batch = []
+    start = time.time()
+
+    def flush_shard(conn, batch):
+        try:
+            return redis_execute_upsert_batch(conn, batch), []
+        except Exception as e:
+            print(f"Bulk Embedding Except, upserting one by one: {e}")
+            logging.error(f"Bulk Embedding Except, upserting one by one: {e}")
+
+        # only the documents that fail on their own are reported
+        ok = 0
+        ko = []
+        for m in batch:
+            try:
+                conn.hset(m["id"], mapping=m)
+                ok += 1
+            except Exception as e:
+                logging.error(f"Embedding Except for {m['id']}: {e}")
+                ko.append(m["id"])
+
+        return ok, ko
+
+    def flush(batch):
+        results = run_on_shards(
+            flush_shard, group_by_shard(redis_conn, batch, lambda e: e["id"])
+        )
+        return sum([r[0] for r in results]), [i for r in results for i in r[1]]
+
+    for e in emb_documents:
+        try:
+            batch.append(encode_embedding_doc(e))
+        except Exception as ex:
+            print(f"Embedding Except: {ex}")
+            logging.error(f"Embedding Except: {ex}")
+            failed_ids.append(e.get("id", None))
+            continue
+
+        if len(batch) >= batch_size:
+            ok, ko = flush(batch)
+            loaded += ok
+            failed_ids += ko
+            batch = []
+
+    if len(batch) > 0:
+        ok, ko = flush(batch)
+        loaded += ok
+        failed_ids += ko
+
+    secs = time.time() - start
+    docs_per_sec = loaded / secs if secs > 0 else 0.0
+    print(
+        f"Bulk loaded {loaded} embeddings ({len(failed_ids)} failed) into Redis for document {document_name} at {docs_per_sec:.2f} docs/sec"
+    )
+    logging.info(
+        f"Bulk loaded {loaded} embeddings ({len(failed_ids)} failed) into Redis for document {document_name} at {docs_per_sec:.2f} docs/sec"
+    )
+
+    return loaded, failed_ids
+
+
+CHUNK_REGISTRY_PREFIX = "doc_chunks:"
+
+
 @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
-def redis_query_embedding_index(redis_conn, query_emb, t_id, topK=5, filter_param=None):
+def redis_register_chunks(redis_conn, doc_id, chunk_ids):
     if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
         return None
 
+    key = CHUNK_REGISTRY_PREFIX + doc_id
+    p = redis_conn.pipeline(transaction=True)
+    p.delete(key)
+    if len(chunk_ids) > 0:
+        p.sadd(key, *chunk_ids)
+    p.execute()
+
+
+@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
+def redis_get_chunk_ids(redis_conn, doc_id):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return None
+
+    key = CHUNK_REGISTRY_PREFIX + doc_id
+    if not redis_conn.exists(key):
+        return None
+
+    return set([c.decode("utf-8") for c in redis_conn.smembers(key)])
+
+
+def redis_get_missing_keys(redis_conn, keys):
+    def check_shard(conn, shard_keys):
+        p = conn.pipeline(transaction=False)
+        for k in shard_keys:
+            p.exists(k)
+        return [k for k, e in zip(shard_keys, p.execute()) if not e]
+
+    results = run_on_shards(check_shard, group_by_shard(redis_conn, keys))
+    return [k for r in results for k in r]
+
+
+def redis_count_vectors(redis_conn, limit):
+    # num_docs also counts every other hash since the index has no prefix, so
+    # probe with a KNN query which only matches documents that carry a vector,
+    # its total is the number of matches up to the limit
+    probe = np.zeros(get_model_dims(CHOSEN_EMB_MODEL))
+    probe[0] = 1.0
+    q = get_knn_query("*", limit, ["vector_score"]).paging(0, 0)
+    params_dict = {"vec_param": probe.astype(get_query_dtype(redis_conn)).tobytes()}
+
+    return redis_conn.ft(REDIS_INDEX_NAME).search(q, query_params=params_dict).total
+
+
+def redis_index_has_vectors(redis_conn):
+    for c in get_index_conns(redis_conn):
+        if redis_count_vectors(c, 1) > 0:
+            return True
+
+    return False
+
+
+def redis_bulk_delete(redis_conn, keys, batch_size=REDIS_BULK_BATCH_SIZE):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return 0
+
+    deleted = 0
+
+    for conn, shard_keys in group_by_shard(redis_conn, keys):
+        for i in range(0, len(shard_keys), batch_size):
+            deleted += conn.delete(*shard_keys[i : i + batch_size])
+
+    return deleted
+
+
+def escape_tag_value(value):
+    # characters the caller already escaped are kept as they are
+    return re.sub(
+        r"\\.|[^\w]",
+        lambda m: m.group(0) if m.group(0).startswith("\\") else "\\" + m.group(0),
+        value,
+    )
+
+
+def get_filter_query(filter_param=None):
     if (filter_param is None) or (filter_param == "*"):
-        filter_param = "*"
-    else:
-        if not filter_param.startswith("@"):
-            filter_param = "@" + filter_param
+        return "*"
 
-    filter_param = filter_param.replace("-", "\-")
-    fields = list(KB_Doc().get_fields()) + ["vector_score"]
-    query_vector = np.array(query_emb).astype(np.float32).tobytes()
-    query_string = f"({filter_param})=>[KNN {topK} @{VECTOR_FIELD_IN_REDIS} $vec_param AS vector_score]"
+    if not filter_param.startswith("@"):
+        filter_param = "@" + filter_param
 
-    q = (
-        Query(query_string)
+    def to_clause(m):
+        field, value = m.group(1), m.group(2)
+
+        if field in REDIS_TAG_FIELDS:
+            # | inside the braces ORs the tag values, everything else is escaped
+            values = value[1:-1].split("|") if value.startswith("{") else [value]
+            values = [escape_tag_value(v.strip()) for v in values]
+            return f"@{field}:{{{' | '.join(values)}}}"
+
+        if field in get_text_fields():
+            # an unescaped dash would negate the next term
+            value = re.sub(r"(?<!\\)-", r"\\-", value)
+            return f"@{field}:{value}"
+
+        raise ValueError(
+            f"Field {field} is not indexed in Redis, filters can use {REDIS_TAG_FIELDS + get_text_fields()}"
+        )
+
+    return re.sub(r"@(\w+):(\{[^}]*\}|[^\s()|]+)", to_clause, filter_param)
+
+
+def get_knn_query(
+    filter_query, topK, fields, ef_runtime=None, vector_field=VECTOR_FIELD_IN_REDIS
+):
+    knn = f"KNN {topK} @{vector_field} $vec_param"
+    if (ef_runtime is not None) and (ef_runtime > 0):
+        knn += f" EF_RUNTIME {ef_runtime}"
+
+    return (
+        Query(f"({filter_query})=>[{knn} AS vector_score]")
         .sort_by("vector_score")
         .paging(0, topK)
         .return_fields(*fields)
         .dialect(2)
     )
-    params_dict = {"vec_param": query_vector}
-    results = redis_conn.ft(REDIS_INDEX_NAME).search(q, query_params=params_dict)
+
+
+def get_default_result_fields():
+    vector_fields = [VECTOR_FIELD_IN_REDIS] + REDIS_UNSTORED_ZERO_VECTORS
+    return [f for f in KB_Doc().get_fields() if f not in vector_fields]
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=5),
+    stop=stop_after_attempt(4),
+    retry=retry_if_not_exception_type(ValueError),
+)
+def redis_query_embedding_index(
+    redis_conn, query_emb, t_id, topK=5, filter_param=None, fields=None
+):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return None
+
+    if fields is None:
+        fields = get_default_result_fields()
+
+    fields = list(fields) + ["vector_score"]
+    filter_query = get_filter_query(filter_param)
+
+    def search_shard(conn):
+        q = get_knn_query(filter_query, topK, fields, get_ef_runtime(conn))
+        params_dict = {"vec_param": get_query_vector(conn, query_emb)}
+
+        try:
+            return conn.ft(REDIS_INDEX_NAME).search(q, query_params=params_dict).docs
+        except redis.exceptions.ResponseError as e:
+            # the node lost its index (e.g. a restart), recreate it before the retry
+            if is_missing_index_error(e):
+                check_index(conn, force=True)
+            # another worker may have swapped in an index of a new vector type
+            forget_index_config(REDIS_INDEX_NAME)
+            raise
+
+    # every shard returns its own top-k, the global top-k is merged from those
+    docs = [
+        d
+        for shard_docs in run_on_shards(
+            search_shard, [(c,) for c in get_index_conns(redis_conn)]
+        )
+        for d in shard_docs
+    ]
+    docs = sorted(docs, key=lambda d: float(d.vector_score))
 
     return [
-        {
-            k: match.__dict__[k]
-            for k in (set(list(match.__dict__.keys())) - set([VECTOR_FIELD_IN_REDIS]))
-        }
-        for match in results.docs
+        {"id": match.id, **{f: getattr(match, f) for f in fields if hasattr(match, f)}}
+        for match in docs
         if match.id != t_id
+    ][:topK]
+
+
+def get_text_query(filter_query, query_text, topK, fields):
+    terms = re.findall(r"\w+", query_text.lower())
+    if len(terms) == 0:
+        return None
+
+    text_clause = f"@text_en:({'|'.join(terms)})"
+    if filter_query != "*":
+        text_clause = f"{filter_query} {text_clause}"
+
+    return (
+        Query(text_clause)
+        .scorer("BM25")
+        .with_scores()
+        .paging(0, topK)
+        .return_fields(*fields)
+        .dialect(2)
+    )
+
+
+def get_search_args(index_name, q, query_params=None):
+    args = [index_name] + q.get_args()
+
+    if query_params is not None:
+        args += ["PARAMS", len(query_params) * 2]
+        for k, v in query_params.items():
+            args += [k, v]
+
+    return args
+
+
+def fuse_rankings(rankings, fields, topK, k=REDIS_HYBRID_RRF_K):
+    # reciprocal rank fusion of the vector and BM25 rankings
+    fused = {}
+    for ranking in rankings:
+        for rank, match in enumerate(ranking):
+            if match.id not in fused:
+                fused[match.id] = {
+                    "id": match.id,
+                    **{f: getattr(match, f) for f in fields if hasattr(match, f)},
+                    "hybrid_score": 0.0,
+                }
+            fused[match.id]["hybrid_score"] += 1 / (k + rank + 1)
+
+    return sorted(fused.values(), key=lambda r: -r["hybrid_score"])[:topK]
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=5),
+    stop=stop_after_attempt(4),
+    retry=retry_if_not_exception_type(ValueError),
+)
+def redis_hybrid_query(
+    redis_conn,
+    query_text,
+    query_emb,
+    topK=5,
+    filter_param=None,
+    fields=None,
+    num_candidates=None,
+    rescore=None,
+):
+    if (REDIS_ADDR is None) or (REDIS_ADDR == ""):
+        return None
+
+    if fields is None:
+        fields = get_default_result_fields()
+    if num_candidates is None:
+        num_candidates = topK * 4
+    # a compact index only shortlists, rescore(results, k) reorders the
+    # shortlist by the full-precision vectors before it is fused
+    knn_candidates = num_candidates
+    if rescore is not None:
+        knn_candidates = num_candidates * REDIS_RESCORE_OVERSAMPLE
+
+    filter_query = get_filter_query(filter_param)
+    text_q = get_text_query(filter_query, query_text, num_candidates, fields)
+
+    # both rankings travel in one pipelined round trip per shard
+    def search_shard(conn):
+        knn_q = get_knn_query(
+            filter_query,
+            knn_candidates,
+            list(fields) + ["vector_score"],
+            get_ef_runtime(conn),
+        )
+        p = conn.pipeline(transaction=False)
+        p.execute_command(
+            "FT.SEARCH",
+            *get_search_args(
+                REDIS_INDEX_NAME,
+                knn_q,
+                {"vec_param": get_query_vector(conn, query_emb)},
+            ),
+        )
+        if text_q is not None:
+            p.execute_command("FT.SEARCH", *get_search_args(REDIS_INDEX_NAME, text_q))
+
+        try:
+            replies = p.execute()
+        except redis.exceptions.ResponseError as e:
+            if is_missing_index_error(e):
+                check_index(conn, force=True)
+            forget_index_config(REDIS_INDEX_NAME)
+            raise
+
+        knn_docs = Result(replies[0], True).docs
+        text_docs = []
+        if text_q is not None:
+            text_docs = Result(replies[1], True, with_scores=True).docs
+        return knn_docs, text_docs
+
+    shard_rankings = run_on_shards(
+        search_shard, [(c,) for c in get_index_conns(redis_conn)]
+    )
+    knn_docs = [d for r in shard_rankings for d in r[0]]
+    text_docs = [d for r in shard_rankings for d in r[1]]
+    knn_ranking = sorted(knn_docs, key=lambda d: float(d.vector_score))
+    if rescore is not None:
+        by_id = {d.id: d for d in knn_ranking}
+        rescored = rescore(
+            [{"id": d.id, "vector_score": d.vector_score} for d in knn_ranking],
+            num_candidates,
+        )
+        knn_ranking = [by_id[r["id"]] for r in rescored]
+
+    rankings = [
+        knn_ranking[:num_candidates],
+        sorted(text_docs, key=lambda d: -float(d.score))[:num_candidates],
     ]
 
+    return fuse_rankings(rankings, fields, topK)
+
+
+@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
+def redis_load_fields(redis_conn, results, fields):
+    results = [r for r in results if any([f not in r for f in fields])]
+    if len(results) == 0:
+        return
+
+    for conn, shard_results in group_by_shard(redis_conn, results, lambda r: r["id"]):
+        p = conn.pipeline(transaction=False)
+        for r in shard_results:
+            p.hmget(r["id"], fields)
+
+        for r, values in zip(shard_results, p.execute()):
+            for f, v in zip(fields, values):
+                r[f] = v.decode("utf-8") if v is not None else ""
+
 
 @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
 def redis_set(redis_conn, key, field, value, expiry=None, verbose=False):
@@ -199,23 +1146,58 @@ def redis_set(redis_conn, key, field, value, expiry=None, verbose=False):
         return None
 
     key = key.replace('"', "")
-    res = redis_conn.hset(key, field, value)
 
+    # the value and its expiry go out together in one round trip
+    p = redis_conn.pipeline(transaction=True)
+    p.hset(key, field, value)
     if expiry is not None:
-        redis_conn.expire(name=key, time=expiry)
+        p.expire(name=key, time=expiry)
+    res = p.execute()[0]
+
     if verbose:
         print("\nSetting Redis Key: ", key, field, expiry)
     return res
 
 
+def get_and_touch_script(redis_conn):
+    with conn_clients_lock:
+        if redis_conn not in cache_scripts:
+            cache_scripts[redis_conn] = redis_conn.register_script(GET_AND_TOUCH_SCRIPT)
+
+        return cache_scripts[redis_conn]
+
+
 @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(4))
-def redis_get(redis_conn, key, field, expiry=CONVERSATION_TTL_SECS, verbose=False):
+def redis_mget(redis_conn, key_fields, expiry=CONVERSATION_TTL_SECS, verbose=False):
     if (REDIS_ADDR is None) or (REDIS_ADDR == "") or (USE_REDIS_CACHE != 1):
-        return None
+        return [None] * len(key_fields)
 
-    key = key.replace('"', "")
+    key_fields = [(k.replace('"', ""), f) for k, f in key_fields]
     if verbose:
-        print("\nGetting Redis Key: ", key, field)
-    if redis_conn.ttl(key) > 0:
-        redis_conn.expire(name=key, time=expiry)
-    return redis_conn.hget(key, field)
+        print("\nGetting Redis Keys: ", key_fields)
+
+    values = [None] * len(key_fields)
+    cache_conn = get_client_cache_conn()
+    touched = []
+
+    for i, (k, f) in enumerate(key_fields):
+        # hot fields are rewritten with a fresh expiry on every turn, so they are
+        # served from the client-side cache without touching the key
+        if (cache_conn is not None) and (f in REDIS_CLIENT_CACHE_FIELDS):
+            values[i] = cache_conn.hget(k, f)
+        else:
+            touched.append(i)
+
+    if len(touched) > 0:
+        fetched = get_and_touch_script(redis_conn)(
+            keys=[key_fields[i][0] for i in touched],
+            args=[expiry] + [key_fields[i][1] for i in touched],
+        )
+        for i, v in zip(touched, fetched):
+            values[i] = v
+
+    return values
+
+
+def redis_get(redis_conn, key, field, expiry=CONVERSATION_TTL_SECS, verbose=False):
+    return redis_mget(redis_conn, [(key, field)], expiry, verbose=verbose)[0]
@@ -0,0 +1,40 @@
+import threading
+
+from utils import emb_cache, openai_helpers
+from utils.env_vars import *
+
+
+class RetrievalContext:
+    def __init__(self, query, embedding_model=CHOSEN_EMB_MODEL):
+        self.raw_query = query
+        self.embedding_model = embedding_model
+        self.query = None
+        self.embedding = None
+        self.lock = threading.Lock()
+
+    def get_query(self):
+        with self.lock:
+            if self.query is None:
+                enc = openai_helpers.get_encoder(self.embedding_model)
+                self.query = enc.decode(enc.encode(self.raw_query)[:MAX_QUERY_TOKENS])
+
+        return self.query
+
+    def get_embedding(self):
+        query = self.get_query()
+
+        # backends running in parallel wait here for the one embedding call
+        with self.lock:
+            if self.embedding is None:
+                self.embedding = emb_cache.get_query_embedding(
+                    query, self.embedding_model
+                )
+
+        return self.embedding
+
+
+def get_retrieval_context(query, ctx=None):
+    if (ctx is not None) and (ctx.raw_query == query):
+        return ctx
+
+    return RetrievalContext(query)
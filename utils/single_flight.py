@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from utils.env_vars import *
+
+SINGLE_FLIGHT_PREFIX = "single_flight:"
+
+# deletes the lease only if it is still held by the caller
+RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+flights = {}
+flights_lock = threading.Lock()
+
+
+def get_flight_key(cache_key, field, filter_param):
+    # followers poll the exact key and field the leader writes, so the flight
+    # must not coalesce requests that are cached apart
+    return hashlib.sha256(
+        f"{cache_key}\n{field}\n{filter_param}".encode("utf-8")
+    ).hexdigest()
+
+
+def wait_for_leader(redis_conn, lease_key, get_cached, timeout):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        value = get_cached()
+        if value is not None:
+            return value
+        # the leader either cached its result or gave up
+        if not redis_conn.exists(lease_key):
+            return get_cached()
+        time.sleep(SINGLE_FLIGHT_POLL_MS / 1000)
+
+    return None
+
+
+def compute_with_lease(redis_conn, key, compute, get_cached, timeout):
+    lease_key = SINGLE_FLIGHT_PREFIX + key
+    token = str(uuid.uuid4())
+
+    try:
+        leased = redis_conn.set(lease_key, token, nx=True, ex=SINGLE_FLIGHT_LEASE_SECS)
+    except Exception as e:
+        logging.warning(f"Single-flight lease failed, computing locally: {e}")
+        return compute()
+
+    if not leased:
+        value = wait_for_leader(redis_conn, lease_key, get_cached, timeout)
+        if value is not None:
+            return value
+        logging.warning(f"Timed out waiting for the single-flight leader of {key}")
+        return compute()
+
+    try:
+        return compute()
+    finally:
+        try:
+            redis_conn.register_script(RELEASE_LEASE_SCRIPT)(
+                keys=[lease_key], args=[token]
+            )
+        except Exception as e:
+            logging.warning(f"Failed to release single-flight lease {lease_key}: {e}")
+
+
+def single_flight(
+    redis_conn,
+    cache_key,
+    field,
+    filter_param,
+    compute,
+    get_cached=None,
+    timeout=SINGLE_FLIGHT_TIMEOUT_SECS,
+):
+    if USE_SINGLE_FLIGHT != 1:
+        return compute()
+
+    key = get_flight_key(cache_key, field, filter_param)
+
+    with flights_lock:
+        future = flights.get(key, None)
+        leader = future is None
+        if leader:
+            future = Future()
+            flights[key] = future
+
+    if not leader:
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            logging.warning(f"Single-flight wait for {field} failed, computing: {e}")
+            return compute()
+
+    try:
+        # other workers can only pick up the result through the Redis cache
+        if (
+            (redis_conn is not None)
+            and (USE_REDIS_CACHE == 1)
+            and (get_cached is not None)
+        ):
+            value = compute_with_lease(redis_conn, key, compute, get_cached, timeout)
+        else:
+            value = compute()
+        future.set_result(value)
+        return value
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with flights_lock:
+            flights.pop(key, None)
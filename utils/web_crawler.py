@@ -20,7 +20,7 @@ import requests
 from azure.storage.blob import BlobServiceClient, ContainerClient
 from bs4 import BeautifulSoup
 
-from utils import language
+from utils import dedup, language
 
 HTTP_URL_PATTERN = r"^http[s]*://.+"
 
@@ -125,6 +125,9 @@ def crawl(url, KB_BLOB_CONN_STR, KB_BLOB_CONTAINER, OUTPUT_BLOB_CONTAINER):
     # Create a set to store the URLs that have already been seen (no duplicates)
     seen = set()
 
+    # Create an in-memory signature index to skip near-duplicate pages
+    page_index = dedup.SignatureIndex()
+
     # While the queue is not empty, continue crawling
     while queue:
         # Get the next URL from the queue
@@ -156,39 +159,50 @@ def crawl(url, KB_BLOB_CONN_STR, KB_BLOB_CONTAINER, OUTPUT_BLOB_CONTAINER):
                     doc_id = str(uuid.uuid3(uuid.NAMESPACE_DNS, text))
                     timestamp = (str(datetime.now()),)
                     doc_text = remove_urls(remove_newlines(text))
-                    lang = language.detect_content_language(doc_text[:500])
-                    new_doc = {
-                        "id": doc_id,
-                        "categoryId": "CATEGORYID",
-                        "timestamp": timestamp,
-                        "web_url": url,
-                        "text": doc_text,
-                        "source_language": lang,
-                    }
-                    try:
-                        container = ContainerClient.from_connection_string(
-                            KB_BLOB_CONN_STR, OUTPUT_BLOB_CONTAINER
-                        )
+
+                    page_sig = dedup.simhash(doc_text)
+                    duplicate_of = page_index.find_duplicate("page", page_sig)
+                    # duplicates are not uploaded, but their links are still crawled
+                    if duplicate_of is not None:
+                        print(f"Skipping near-duplicate of {duplicate_of}")
+                    else:
+                        page_index.add("page", url, page_sig)
+
+                        lang = language.detect_content_language(doc_text[:500])
+                        new_doc = {
+                            "id": doc_id,
+                            "categoryId": "CATEGORYID",
+                            "timestamp": timestamp,
+                            "web_url": url,
+                            "text": doc_text,
+                            "source_language": lang,
+                        }
                         try:
-                            container_properties = container.get_container_properties()
+                            container = ContainerClient.from_connection_string(
+                                KB_BLOB_CONN_STR, OUTPUT_BLOB_CONTAINER
+                            )
+                            try:
+                                container_properties = (
+                                    container.get_container_properties()
+                                )
+                            except Exception as e:
+                                container.create_container()
+
+                            filename = local_domain + "_" + doc_id
+                            blob_name = filename + ".json"
+                            blob_client = container.get_blob_client(blob=blob_name)
+                            blob_client.upload_blob(
+                                json.dumps(new_doc, indent=4, ensure_ascii=False),
+                                overwrite=True,
+                            )
+                            logging.info(
+                                f"Document {doc_id} was successfully saved to the {OUTPUT_BLOB_CONTAINER} container"
+                            )
+
                         except Exception as e:
-                            container.create_container()
-
-                        filename = local_domain + "_" + doc_id
-                        blob_name = filename + ".json"
-                        blob_client = container.get_blob_client(blob=blob_name)
-                        blob_client.upload_blob(
-                            json.dumps(new_doc, indent=4, ensure_ascii=False),
-                            overwrite=True,
-                        )
-                        logging.info(
-                            f"Document {doc_id} was successfully saved to the {OUTPUT_BLOB_CONTAINER} container"
-                        )
-
-                    except Exception as e:
-                        logging.error(
-                            f"Exception: Document {doc_id} created an exception.\n{e}"
-                        )
+                            logging.error(
+                                f"Exception: Document {doc_id} created an exception.\n{e}"
+                            )
 
                 except Exception as e:
                     print(e)